@@ -3,7 +3,6 @@ from mpworks.snl_utils.mpsnl import SNLGroup
 from matgendb.builders.core import Builder
 from matgendb.builders.util import get_builder_log
 from mpworks.check_snl.utils import div_plus_mod
-from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator
 from init_plotly import py, stream_ids, categories
 if py is not None:
     from plotly.graph_objs import *
@@ -26,10 +25,6 @@ class SNLGroupBaseChecker(Builder):
         :param ncols: number of columns for 2D plotly
         :type ncols: int
         """
-        self._matcher = StructureMatcher(
-            ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=True, scale=True,
-            attempt_supercell=False, comparator=ElementComparator()
-        )
         self._lock = self._mgr.Lock() if not self._seq else None
         self._ncols = ncols if not self._seq else 1
         self._nrows = div_plus_mod(self._ncores, self._ncols) if not self._seq else 1
@@ -1,8 +1,8 @@
 from matgendb.builders.util import get_builder_log
 from base import SNLGroupBaseChecker
 from init_plotly import categories
-from mpworks.snl_utils.mpsnl import MPStructureNL
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from mpworks.snl_utils.mpsnl import MPStructureNL, fit_reduced
+from mpworks.snl_utils.symmetry_cache import SPACEGROUP_TOLERANCE, get_symmetry
 
 _log = get_builder_log("snl_group_checks")
 
@@ -18,9 +18,9 @@ class SNLGroupCrossChecker(SNLGroupBaseChecker):
             for secondary_id in item['snlgroup_ids'][idx+1:]:
                 secondary_group = snlgroups[secondary_id]
                 secondary_sg_num = secondary_group.canonical_snl.snlgroup_key.split('--')[1]
-                if not self._matcher.fit(
-                    primary_group.canonical_structure,
-                    secondary_group.canonical_structure
+                if not fit_reduced(
+                    primary_group.canonical_snl.reduced_primitive,
+                    secondary_group.canonical_snl.reduced_primitive
                 ): continue
                 cat_key = 'same SGs' if primary_sg_num == secondary_sg_num else 'diff. SGs'
                 local_mismatch_dict[cat_key].append('(%d,%d)' % (primary_id, secondary_id))
@@ -56,17 +56,17 @@ class SNLGroupIcsdChecker(SNLGroupBaseChecker):
                         secondary_icsd_id = secondary_mpsnl_dict['about']['_icsd']['icsd_id']
                         if primary_icsd_id != secondary_icsd_id: continue
                         cat_key = 'same ICSDs'
-                        primary_structure = MPStructureNL.from_dict(primary_mpsnl_dict).structure
-                        secondary_structure = MPStructureNL.from_dict(secondary_mpsnl_dict).structure
-                        match = self._matcher.fit(primary_structure, secondary_structure)
+                        primary_structure = MPStructureNL.from_dict(primary_mpsnl_dict).reduced_primitive
+                        secondary_structure = MPStructureNL.from_dict(secondary_mpsnl_dict).reduced_primitive
+                        match = fit_reduced(primary_structure, secondary_structure)
                         if match:
-                            primary_match = self._matcher.fit(
-                                primary_structure, primary_group.canonical_structure)
-                            secondary_match = self._matcher.fit(
-                                secondary_structure, secondary_group.canonical_structure)
-                            canonical_match = self._matcher.fit(
-                                primary_group.canonical_structure,
-                                secondary_group.canonical_structure)
+                            primary_match = fit_reduced(
+                                primary_structure, primary_group.canonical_snl.reduced_primitive)
+                            secondary_match = fit_reduced(
+                                secondary_structure, secondary_group.canonical_snl.reduced_primitive)
+                            canonical_match = fit_reduced(
+                                primary_group.canonical_snl.reduced_primitive,
+                                secondary_group.canonical_snl.reduced_primitive)
                         local_mismatch_dict[cat_key].append(
                             '({}, {}): ({}, {}) -> {} ({}{})'.format(
                                 primary_id, secondary_id,
@@ -101,7 +101,7 @@ class SNLGroupMemberChecker(SNLGroupBaseChecker):
                     _log.info('%r %r', exc_type, exc_value)
                     local_mismatch_dict[categories[self.checker_name][-1]].append('%s%d' % (entry, snl_id))
                     continue
-                if self._matcher.fit(mpsnl.structure, snlgrp.canonical_structure): continue
+                if fit_reduced(mpsnl.reduced_primitive, snlgrp.canonical_snl.reduced_primitive): continue
                 mismatch_snls.append(str(snl_id))
                 _log.info('%s %d', entry, snl_id)
             if len(mismatch_snls) > 0:
@@ -119,10 +119,9 @@ class SNLSpaceGroupChecker(SNLGroupBaseChecker):
         try:
             mpsnl_dict = self._snls.collection.find_one({ 'snl_id': item })
             mpsnl = MPStructureNL.from_dict(mpsnl_dict)
-            mpsnl.structure.remove_oxidation_states()
-            sf = SpacegroupAnalyzer(mpsnl.structure, symprec=0.1)
-            if sf.get_spacegroup_number() != mpsnl.sg_num:
-                category = categories[self.checker_name][int(sf.get_spacegroup_number() == 0)]
+            sg_num = get_symmetry(mpsnl.structure, SPACEGROUP_TOLERANCE)['number']
+            if sg_num != mpsnl.sg_num:
+                category = categories[self.checker_name][int(sg_num == -1)]
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             category = categories[0][2]
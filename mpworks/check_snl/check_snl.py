@@ -14,9 +14,12 @@ from collections import OrderedDict
 from argparse import ArgumentParser
 from fnmatch import fnmatch
 from collections import Counter
-from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
-from mpworks.snl_utils.mpsnl import MPStructureNL, SNLGroup
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from mpworks.snl_utils.snl_mongo import SNLMongoAdapter, SNL_STRUCTURE_FIELDS, \
+    SNLGROUP_MATCH_FIELDS
+from mpworks.snl_utils.mpsnl import MPStructureNL, SNLGroup, LazyMPStructureNL, LazySNLGroup, \
+    fit_reduced
+from mpworks.snl_utils.symmetry_cache import SPACEGROUP_TOLERANCE, get_symmetry, \
+    set_persistent_backend
 from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator, SpeciesComparator
 import plotly.plotly as py
 import plotly.tools as tls
@@ -30,6 +33,8 @@ stream_ids = creds['stream_ids']
 min_sleep = 0.052
 
 sma = SNLMongoAdapter.auto_load()
+# the checks are re-run over the same SNLs, keep their symmetry results
+set_persistent_backend(sma.database.symmetry_cache)
 matcher = StructureMatcher(
     ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=True, scale=True,
     attempt_supercell=False, comparator=ElementComparator()
@@ -217,11 +222,11 @@ def check_snl_spacegroups(args):
         exc_raised = False
         try:
             mpsnl = MPStructureNL.from_dict(mpsnl_dict)
-            sf = SpacegroupAnalyzer(mpsnl.structure, symprec=0.1)
+            sg_num = get_symmetry(mpsnl.structure, SPACEGROUP_TOLERANCE)['number']
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             exc_raised = True
-        is_good = (not exc_raised and sf.get_spacegroup_number() == mpsnl.sg_num)
+        is_good = (not exc_raised and sg_num == mpsnl.sg_num)
         if is_good: # Bar (good)
             num_good_ids += 1
             data = dict(x=[num_good_ids], y=[range_index])
@@ -230,8 +235,8 @@ def check_snl_spacegroups(args):
                 category = 2 if fnmatch(str(exc_type), '*pybtex*') else 3
                 text = ' '.join([str(exc_type), str(exc_value)])
             else:
-                category = int(sf.get_spacegroup_number() == 0)
-                text = '%s: %d' % (mpsnl.snlgroup_key, sf.get_spacegroup_number())
+                category = int(sg_num == -1)
+                text = '%s: %d' % (mpsnl.snlgroup_key, sg_num)
             colors.append(category_colors[category])
             data = dict(
                 x=mpsnl_dict['snl_id']%num_ids_per_stream,
@@ -249,13 +254,14 @@ def check_snls_in_snlgroups(args):
     for i in range(len(idxs)): s[i].open()
     end = num_snlgroups if args.end > num_snlgroups else args.end
     id_range = {"$gt": args.start, "$lte": end}
-    snlgrp_cursor = sma.snlgroups.find({ "snlgroup_id": id_range})
+    # only the structures are compared, don't decode the rest of the SNLs
+    snlgrp_cursor = sma.snlgroups.find({ "snlgroup_id": id_range}, SNLGROUP_MATCH_FIELDS)
     colors = []
     num_good_ids = 0
     for snlgrp_dict in snlgrp_cursor:
         start_time = time.clock()
         try:
-            snlgrp = SNLGroup.from_dict(snlgrp_dict)
+            snlgrp = LazySNLGroup(snlgrp_dict)
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             text = ' '.join([str(exc_type), str(exc_value)])
@@ -277,10 +283,10 @@ def check_snls_in_snlgroups(args):
         all_snls_good = True
         for snl_id in snlgrp.all_snl_ids:
             if snl_id == snlgrp.canonical_snl.snl_id: continue
-            mpsnl_dict = sma.snl.find_one({ "snl_id": snl_id })
+            mpsnl_dict = sma.snl.find_one({ "snl_id": snl_id }, SNL_STRUCTURE_FIELDS)
             try:
-                mpsnl = MPStructureNL.from_dict(mpsnl_dict)
-                is_match = matcher.fit(mpsnl.structure, snlgrp.canonical_structure)
+                mpsnl = LazyMPStructureNL(mpsnl_dict)
+                is_match = fit_reduced(mpsnl.reduced_primitive, snlgrp.canonical_snl.reduced_primitive)
             except:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 exc_raised = True
@@ -393,10 +399,8 @@ def analyze(args):
                         scenario = 'different' if (
                             float(delta_energy) > 0.01 or float(delta_bandgap) > 0.1
                         ) else 'similar'
-                        snlgrp1_dict = sma.snlgroups.find_one({ "snlgroup_id": primary_id })
-                        snlgrp2_dict = sma.snlgroups.find_one({ "snlgroup_id": secondary_id })
-                        snlgrp1 = SNLGroup.from_dict(snlgrp1_dict)
-                        snlgrp2 = SNLGroup.from_dict(snlgrp2_dict)
+                        snlgrp1 = sma.find_snlgroup({ "snlgroup_id": primary_id })
+                        snlgrp2 = sma.find_snlgroup({ "snlgroup_id": secondary_id })
                         primary_structure = snlgrp1.canonical_structure
                         secondary_structure = snlgrp2.canonical_structure
                         rms_dist = matcher.get_rms_dist(primary_structure, secondary_structure)
@@ -444,13 +448,12 @@ def analyze(args):
                     sg_num = mpsnl.snlgroup_key.split('--')[1]
                     if (bad_snls[mpsnl.snl_id] == 'SG default' and sg_num != '-1') or \
                        bad_snls[mpsnl.snl_id] == 'SG change':
-                        mpsnl.structure.remove_oxidation_states()
-                        sf = SpacegroupAnalyzer(mpsnl.structure, symprec=0.1)
+                        new_sg_num = get_symmetry(mpsnl.structure, SPACEGROUP_TOLERANCE)['number']
                         badsnls_trace['x'].append(mpsnl.sg_num)
-                        badsnls_trace['y'].append(sf.get_spacegroup_number())
+                        badsnls_trace['y'].append(new_sg_num)
                         badsnls_trace['text'].append(mpsnl.snl_id)
                         if bad_snls[mpsnl.snl_id] == 'SG default':
-                            print sg_num, sf.get_spacegroup_number()
+                            print sg_num, new_sg_num
                 print 'plotting out-fig ...'
                 out_fig['data'] = Data([bisectrix, badsnls_trace])
                 out_fig['layout'] = Layout(
@@ -476,16 +479,16 @@ def analyze(args):
                     fields = entry.split(':')
                     snlgroup_id = int(fields[0].split(',')[0])
                     print snlgroup_id
-                    snlgrp_dict = sma.snlgroups.find_one({ 'snlgroup_id': snlgroup_id })
-                    snlgrp = SNLGroup.from_dict(snlgrp_dict)
+                    snlgrp = sma.find_snlgroup({ 'snlgroup_id': snlgroup_id })
                     s1 = snlgrp.canonical_structure.get_primitive_structure()
                     bad_snls[snlgroup_id] = []
                     for i, snl_id in enumerate(fields[1].split(',')):
-                        mpsnl_dict = sma.snl.find_one({ 'snl_id': int(snl_id) })
+                        mpsnl_dict = sma.snl.find_one({ 'snl_id': int(snl_id) },
+                                                      SNL_STRUCTURE_FIELDS + ['about.projects'])
                         if 'CederDahn Challenge' in mpsnl_dict['about']['projects']:
                             print 'skip CederDahn: %s' % snl_id
                             continue
-                        mpsnl = MPStructureNL.from_dict(mpsnl_dict)
+                        mpsnl = LazyMPStructureNL(mpsnl_dict)
                         s2 = mpsnl.structure.get_primitive_structure()
                         is_match = matcher2.fit(s1, s2)
                         if is_match: continue
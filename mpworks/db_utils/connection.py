@@ -0,0 +1,123 @@
+import os
+import threading
+from pymongo import MongoClient
+
+'''
+A process-wide registry of MongoClient objects.
+
+MongoClient is thread-safe and keeps its own connection pool, so a single
+client per (host, port, options) is enough for a whole process. Clients are
+*not* safe to use across fork(), so the registry remembers the pid that
+created them and silently drops everything it holds when it finds itself in
+a new process (e.g. a multiprocessing worker).
+'''
+
+_lock = threading.RLock()
+_pid = None
+_clients = {}
+_authenticated = set()
+_done_once = set()
+_shared = {}
+
+
+def _check_pid():
+    # must be called with _lock held
+    global _pid
+    if _pid != os.getpid():
+        # clients inherited from the parent process must not be reused; we
+        # don't close them either since the parent still owns the sockets
+        _clients.clear()
+        _authenticated.clear()
+        _shared.clear()
+        _pid = os.getpid()
+
+
+def _client_key(host, port, kwargs):
+    return host, port, tuple(sorted(kwargs.items()))
+
+
+def get_client(host='localhost', port=27017, **kwargs):
+    """
+    Get the shared MongoClient for this process, creating it on first use.
+
+    :param host: (str) hostname of the Mongo server
+    :param port: (int) port of the Mongo server
+    :param kwargs: extra keyword args passed to MongoClient (e.g. j=False).
+        Clients with different options are kept separately.
+    """
+    key = _client_key(host, port, kwargs)
+    with _lock:
+        _check_pid()
+        client = _clients.get(key)
+        if client is None:
+            client = MongoClient(host, port, **kwargs)
+            _clients[key] = client
+        return client
+
+
+def get_database(host, port, db_name, user=None, password=None, **kwargs):
+    """
+    Get a database from the shared client, authenticating at most once per
+    process for each (client, database, user).
+    """
+    client = get_client(host, port, **kwargs)
+    db = client[db_name]
+    if user:
+        auth_key = (_client_key(host, port, kwargs), db_name, user)
+        with _lock:
+            if auth_key not in _authenticated:
+                db.authenticate(user, password)
+                _authenticated.add(auth_key)
+    return db
+
+
+def client_settings_key(client):
+    """
+    A key for the servers a MongoClient was configured with, for registries
+    of per-server objects. Unlike client.address, it doesn't need a
+    connection and works for clients of several mongos routers or a replica
+    set.
+    """
+    # the repr of a MongoClient lists its seed hosts and options
+    return repr(client)
+
+
+def get_shared(key, factory):
+    """
+    Get a per-process singleton built by factory(), e.g. a LaunchPad or a
+    Mongo adapter that owns its own client. Like the clients themselves,
+    these objects are rebuilt after a fork.
+    """
+    with _lock:
+        _check_pid()
+        if key not in _shared:
+            _shared[key] = factory()
+        return _shared[key]
+
+
+def run_once(key, func, *args, **kwargs):
+    """
+    Run func only the first time this key is seen. Used for server-side setup
+    such as ensure_index(), which does not need to be repeated in forked
+    children. Returns True if func was run.
+    """
+    with _lock:
+        if key in _done_once:
+            return False
+        func(*args, **kwargs)
+        _done_once.add(key)
+        return True
+
+
+def reset_connections():
+    """
+    Close and forget every client owned by this process.
+    """
+    with _lock:
+        if _pid == os.getpid():
+            for client in _clients.values():
+                client.close()
+        _clients.clear()
+        _authenticated.clear()
+        _shared.clear()
+        _done_once.clear()
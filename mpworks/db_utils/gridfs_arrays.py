@@ -0,0 +1,255 @@
+import json
+import struct
+import numpy as np
+from pymatgen import MontyEncoder
+from mpworks.db_utils.gridfs_io import ARRAY_CONTENT_TYPE, read_json
+
+'''
+Array-native GridFS storage for band structures and DOS.
+
+Eigenvalues, projections and densities are pulled out of the as_dict() of a
+BandStructure or CompleteDos and stored as raw typed blocks; the rest of the
+document goes into a small JSON header. Layout of the GridFS file:
+
+    MAGIC (8 bytes) | header length (uint64, little endian) | header JSON | blocks
+
+Every block is a C-ordered little-endian array. The header keeps the dtype,
+shape and offset of each block, so a reader can seek straight to what it
+needs: only one spin channel, only the bands around the Fermi level, or
+nothing of the projections.
+
+All blocks are float64 by default, like the numbers in the JSON formats.
+put_arrays(..., single_precision=True) stores projections and densities as
+float32 instead, halving the biggest blocks at the cost of precision.
+'''
+
+MAGIC = b'MPARRAY1'
+# keys holding numeric arrays, either directly or as a {spin: array} dict
+ARRAY_FIELDS = ['bands', 'projections', 'energies', 'densities']
+ARRAY_DTYPES = {'bands': '<f8', 'energies': '<f8', 'projections': '<f8',
+                'densities': '<f8'}
+# the dtypes with single_precision=True (lossy)
+SINGLE_PRECISION_DTYPES = dict(ARRAY_DTYPES, projections='<f4', densities='<f4')
+PROJECTION_FIELDS = {'projections': {}, 'pdos': []}  # and their empty values
+
+
+def _to_array(value, field, dtypes):
+    try:
+        arr = np.asarray(value, dtype=dtypes[field])
+    except (TypeError, ValueError):
+        return None  # ragged or not numeric, leave it in the JSON header
+    return arr if arr.ndim > 0 and arr.size > 0 else None
+
+
+def _split_arrays(obj, path, arrays, dtypes=ARRAY_DTYPES):
+    # returns a copy of obj in which arrays are replaced by {'@array': name}
+    if isinstance(obj, dict):
+        new = {}
+        for k, v in obj.items():
+            k_path = path + [str(k)]
+            if k in ARRAY_FIELDS:
+                if isinstance(v, dict):
+                    new[k] = {}
+                    for spin, spin_v in v.items():
+                        arr = _to_array(spin_v, k, dtypes)
+                        if arr is None:
+                            new[k][spin] = _split_arrays(spin_v, k_path + [str(spin)], arrays,
+                                                         dtypes)
+                        else:
+                            name = '/'.join(k_path + [str(spin)])
+                            arrays.append((name, k, arr))
+                            new[k][spin] = {'@array': name}
+                    continue
+                arr = _to_array(v, k, dtypes)
+                if arr is not None:
+                    name = '/'.join(k_path)
+                    arrays.append((name, k, arr))
+                    new[k] = {'@array': name}
+                    continue
+            new[k] = _split_arrays(v, k_path, arrays, dtypes)
+        return new
+    if isinstance(obj, (list, tuple)):
+        return [_split_arrays(v, path + [str(i)], arrays, dtypes) for i, v in enumerate(obj)]
+    return obj
+
+
+def put_arrays(fs, doc, single_precision=False, **kwargs):
+    """
+    Store a band structure or DOS dict in the array format.
+
+    :param fs: a gridfs.GridFS instance
+    :param doc: the as_dict() of a BandStructure, BandStructureSymmLine or
+        (Complete)Dos
+    :param single_precision: (bool) store projections and densities as
+        float32 (lossy)
+    :param kwargs: extra fields for the GridFS file document
+    :return: the id of the new GridFS file
+    """
+    arrays = []
+    dtypes = SINGLE_PRECISION_DTYPES if single_precision else ARRAY_DTYPES
+    header_doc = _split_arrays(doc, [], arrays, dtypes)
+
+    blocks = {}
+    offset = 0
+    for name, field, arr in arrays:
+        info = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+        if field == 'bands' and arr.ndim == 2:
+            # per-band energy range, so that band windows can be picked
+            # without reading the eigenvalues
+            info['band_min'] = arr.min(axis=1).tolist()
+            info['band_max'] = arr.max(axis=1).tolist()
+        blocks[name] = info
+        offset += arr.nbytes
+
+    header = json.dumps({'doc': header_doc, 'arrays': blocks},
+                        cls=MontyEncoder).encode('utf-8')
+
+    kwargs['contentType'] = ARRAY_CONTENT_TYPE
+    grid_in = fs.new_file(**kwargs)
+    try:
+        grid_in.write(MAGIC + struct.pack('<Q', len(header)))
+        grid_in.write(header)
+        for name, field, arr in arrays:
+            grid_in.write(np.ascontiguousarray(arr).tobytes())
+    except:
+        grid_in.abort()
+        raise
+    grid_in.close()
+    return grid_in._id
+
+
+class ArrayFile(object):
+    """
+    Random access to a GridFS file written by put_arrays().
+    """
+
+    def __init__(self, fs, file_id):
+        self.grid_out = fs.get(file_id)
+        preamble = self.grid_out.read(len(MAGIC) + 8)
+        if preamble[:len(MAGIC)] != MAGIC:
+            raise ValueError('GridFS file {} is not in the MP array format'.format(file_id))
+        header_len = struct.unpack('<Q', preamble[len(MAGIC):])[0]
+        header = json.loads(self.grid_out.read(header_len).decode('utf-8'))
+        self.doc = header['doc']
+        self.arrays = header['arrays']
+        self.data_start = len(MAGIC) + 8 + header_len
+
+    def read_array(self, name, start=None, stop=None):
+        """
+        Read one block, or only the rows [start:stop] of its first axis.
+        """
+        info = self.arrays[name]
+        dtype = np.dtype(str(info['dtype']))
+        shape = list(info['shape'])
+        row_bytes = dtype.itemsize * int(np.prod(shape[1:]))
+        start = 0 if start is None else max(0, start)
+        stop = shape[0] if stop is None else min(shape[0], stop)
+        stop = max(start, stop)
+        self.grid_out.seek(self.data_start + info['offset'] + start * row_bytes)
+        data = self.grid_out.read((stop - start) * row_bytes)
+        shape[0] = stop - start
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def band_range(self, name, emin, emax):
+        """
+        Index range [start, stop) of the bands in block name that have any
+        eigenvalue between emin and emax.
+        """
+        info = self.arrays[name]
+        idx = [i for i, (lo, hi) in enumerate(zip(info['band_min'], info['band_max']))
+               if hi >= emin and lo <= emax]
+        return (idx[0], idx[-1] + 1) if idx else (0, 0)
+
+
+def _spin_filter(spins):
+    return None if spins is None else set([str(s) for s in spins])
+
+
+def _drop_projections(doc):
+    for field, empty in PROJECTION_FIELDS.items():
+        if field in doc:
+            doc[field] = empty
+
+
+def _filter_json_doc(doc, spins, band_window, projections):
+    # same selections as for array files, applied after a full JSON read
+    if not projections:
+        _drop_projections(doc)
+    spins = _spin_filter(spins)
+    for field in ARRAY_FIELDS:
+        if isinstance(doc.get(field), dict) and spins is not None:
+            doc[field] = dict([(k, v) for k, v in doc[field].items() if str(k) in spins])
+    for site_pdos in doc.get('pdos', []):
+        for orb_dos in site_pdos.values():
+            if spins is not None and isinstance(orb_dos.get('densities'), dict):
+                orb_dos['densities'] = dict([(k, v) for k, v in orb_dos['densities'].items()
+                                             if str(k) in spins])
+    if band_window is not None and isinstance(doc.get('bands'), dict):
+        emin, emax = doc['efermi'] + band_window[0], doc['efermi'] + band_window[1]
+        doc['band_window'] = {}
+        for spin, bands in doc['bands'].items():
+            idx = [i for i, b in enumerate(bands) if max(b) >= emin and min(b) <= emax]
+            start, stop = (idx[0], idx[-1] + 1) if idx else (0, 0)
+            doc['bands'][spin] = bands[start:stop]
+            if doc.get('projections') and spin in doc['projections']:
+                doc['projections'][spin] = doc['projections'][spin][start:stop]
+            doc['band_window'][spin] = [start, stop]
+    return doc
+
+
+def read_doc(fs, file_id, spins=None, band_window=None, projections=True):
+    """
+    Read a band structure or DOS dict from GridFS, in either the array or the
+    (compressed) JSON format. With the array format, only the requested parts
+    are read from the database.
+
+    :param spins: list of spins to load (e.g. [1] or ['1', '-1']), None for all
+    :param band_window: (lower, upper) energies relative to the Fermi level;
+        only bands with eigenvalues inside this window are loaded. The index
+        range kept for each spin is stored in doc['band_window'].
+    :param projections: False to skip band projections and projected DOS
+    :return: a dict, as stored
+    """
+    grid_out = fs.get(file_id)
+    if getattr(grid_out, 'contentType', None) != ARRAY_CONTENT_TYPE:
+        return _filter_json_doc(read_json(fs, file_id), spins, band_window, projections)
+
+    af = ArrayFile(fs, file_id)
+    doc = af.doc
+    if not projections:
+        _drop_projections(doc)
+    spins = _spin_filter(spins)
+
+    windows = {}
+    if band_window is not None and isinstance(doc.get('bands'), dict):
+        emin, emax = doc['efermi'] + band_window[0], doc['efermi'] + band_window[1]
+        for spin, ref in doc['bands'].items():
+            if spins is not None and str(spin) not in spins:
+                continue
+            if isinstance(ref, dict) and '@array' in ref:
+                windows[spin] = af.band_range(ref['@array'], emin, emax)
+        doc['band_window'] = dict([(k, list(v)) for k, v in windows.items()])
+
+    def fill(obj, field=None, spin=None):
+        if isinstance(obj, dict):
+            if '@array' in obj:
+                start, stop = windows.get(spin, (None, None)) \
+                    if field in ['bands', 'projections'] else (None, None)
+                return af.read_array(obj['@array'], start, stop).tolist()
+            new = {}
+            for k, v in obj.items():
+                # a {spin: array} dict, not a single array like the DOS energies
+                by_spin = k in ARRAY_FIELDS and isinstance(v, dict) and '@array' not in v
+                if by_spin and spins is not None:
+                    v = dict([(s, sv) for s, sv in v.items() if str(s) in spins])
+                if by_spin:
+                    new[k] = dict([(s, fill(sv, k, s)) for s, sv in v.items()])
+                else:
+                    new[k] = fill(v, k if k in ARRAY_FIELDS else field, spin)
+            return new
+        if isinstance(obj, list):
+            return [fill(v, field, spin) for v in obj]
+        return obj
+
+    return fill(doc)
+
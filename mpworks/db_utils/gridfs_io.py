@@ -0,0 +1,139 @@
+import json
+import zlib
+from pymatgen import MontyEncoder
+
+'''
+Streaming JSON storage in GridFS, used for DOS and band structures.
+
+put_json() encodes an object piece by piece and compresses it on the fly, so
+the full JSON string never has to exist in memory. The compression used is
+stored in the contentEncoding field of the GridFS file document; files
+written by plain fs.put(json_string) have no such field and are read back
+unchanged by read_json().
+
+Compression is off by default: readers outside of MPWorks (e.g. the web
+frontend or matgendb) that load these files with a plain json.loads(fs.get(...)
+.read()) can't read compressed files. Only set GRIDFS_COMPRESSION once every
+reader of the DOS and band structure files goes through read_json().
+
+read_json() parses the file while it is being read if the optional ijson
+package (>= 3.1) is installed. Without it, the decompressed JSON text is
+buffered once before parsing.
+'''
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+GRIDFS_COMPRESSION = None  # one of COMPRESSIONS, or None for plain JSON; see above
+COMPRESSIONS = ['zlib', 'gzip']
+PLAIN = 'plain'  # put_json(..., compression=PLAIN) ignores GRIDFS_COMPRESSION
+CHUNK_SIZE = 1048576  # bytes handed to the compressor / GridFS at a time
+ARRAY_CONTENT_TYPE = 'application/x-mp-arrays'  # see gridfs_arrays.py
+
+
+def _wbits(compression):
+    if compression == 'zlib':
+        return zlib.MAX_WBITS
+    if compression == 'gzip':
+        return 16 + zlib.MAX_WBITS
+    raise ValueError('Unsupported GridFS compression {}, must be one of {}'.format(compression, COMPRESSIONS))
+
+
+def put_json(fs, obj, compression=None, cls=MontyEncoder, **kwargs):
+    """
+    Write obj as (compressed) JSON into GridFS without building the whole
+    string in memory.
+
+    :param fs: a gridfs.GridFS instance
+    :param obj: a JSON-serializable object
+    :param compression: 'zlib', 'gzip', PLAIN, or None for GRIDFS_COMPRESSION
+    :param cls: the JSONEncoder class to use
+    :param kwargs: extra fields for the GridFS file document
+    :return: the id of the new GridFS file
+    """
+    if compression is None:
+        compression = GRIDFS_COMPRESSION  # looked up now, it may be set at run time
+    if compression and compression != PLAIN:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, _wbits(compression))
+        kwargs['contentEncoding'] = compression
+    else:
+        compressor = None
+
+    grid_in = fs.new_file(**kwargs)
+    try:
+        buf = []
+        size = 0
+        for piece in cls().iterencode(obj):
+            piece = piece.encode('utf-8')
+            buf.append(piece)
+            size += len(piece)
+            if size >= CHUNK_SIZE:
+                data = b''.join(buf)
+                grid_in.write(compressor.compress(data) if compressor else data)
+                buf = []
+                size = 0
+        data = b''.join(buf)
+        grid_in.write(compressor.compress(data) if compressor else data)
+        if compressor:
+            grid_in.write(compressor.flush())
+    except:
+        grid_in.abort()
+        raise
+    grid_in.close()
+    return grid_in._id
+
+
+def iter_file_bytes(grid_out, chunk_size=CHUNK_SIZE):
+    """
+    Yield the decompressed content of a GridFS file, chunk by chunk.
+    """
+    compression = getattr(grid_out, 'contentEncoding', None)
+    decompressor = zlib.decompressobj(_wbits(compression)) if compression else None
+    while True:
+        chunk = grid_out.read(chunk_size)
+        if not chunk:
+            break
+        yield decompressor.decompress(chunk) if decompressor else chunk
+    if decompressor:
+        yield decompressor.flush()
+
+
+class _GridFSReader(object):
+    # a file-like view of the decompressed content of a GridFS file
+
+    def __init__(self, grid_out):
+        self._chunks = iter_file_bytes(grid_out)
+        self._buf = b''
+
+    def read(self, n=-1):
+        while n < 0 or len(self._buf) < n:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+        if n < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+
+def read_json(fs, file_id):
+    """
+    Read back a JSON document written by put_json() or by a plain fs.put().
+    Files in the array format of gridfs_arrays.py are also read in full.
+    """
+    grid_out = fs.get(file_id)
+    if getattr(grid_out, 'contentType', None) == ARRAY_CONTENT_TYPE:
+        # numpy is only needed for this format
+        from mpworks.db_utils.gridfs_arrays import read_doc
+        return read_doc(fs, file_id)
+    if ijson is not None:
+        try:
+            return next(ijson.items(_GridFSReader(grid_out), '', use_float=True))
+        except TypeError:
+            # ijson < 3.1 has no use_float and would return Decimals
+            grid_out.seek(0)
+    return json.loads(b''.join(iter_file_bytes(grid_out)).decode('utf-8'))
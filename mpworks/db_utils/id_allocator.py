@@ -0,0 +1,99 @@
+import threading
+from mpworks.db_utils.connection import client_settings_key, get_shared
+
+'''
+Block ("hi-lo") allocation of integer ids from a counter document.
+
+Task ids, SNL ids, SNL group ids and submission ids all come from a counter
+field that is incremented with find_one_and_update. Instead of one round
+trip per id, an IdAllocator reserves a range of ids with a single $inc and
+hands them out locally. Counter semantics are unchanged: the value stored
+in the counter is always the next id that has not been reserved.
+
+The first reservation of a process is a single id and every refill doubles
+the block, up to ID_BLOCK_SIZE. A process that inserts one task (the usual
+VASP db insertion Firework) therefore uses exactly the ids it needs, while
+bulk imports quickly stop contending on the counter document.
+
+Reserved ids are never given back. If a process dies, the rest of its block
+is lost, so ids stay unique but may have gaps and are not strictly ordered
+in time across processes.
+
+Blocks only exist in the memory of the process that reserved them. Resetting
+a counter (the restart_id_assigner_at() methods of the adapters) only resets
+the allocator of the calling process: every other process using the same
+counter must be restarted, or it keeps handing out ids from its old block
+and creates duplicates.
+'''
+
+ID_BLOCK_SIZE = 100  # largest number of ids reserved in one $inc
+
+
+class IdAllocator(object):
+    """
+    Hands out ids from ranges reserved on a counter field.
+    """
+
+    def __init__(self, collection, query, field, block_size=ID_BLOCK_SIZE):
+        """
+        :param collection: the pymongo collection holding the counter
+        :param query: (dict) selects the counter document, e.g. {'_id': 'taskid'}
+        :param field: (str) the counter field, holding the next free id
+        :param block_size: (int) maximum number of ids reserved at a time
+        """
+        self.collection = collection
+        self.query = query
+        self.field = field
+        self.block_size = block_size
+        self._next_block = 1
+        self._next = 0
+        self._end = 0  # ids in [_next, _end) are reserved for this process
+        self._lock = threading.Lock()
+
+    def _reserve(self, n):
+        # returns the first id of a freshly reserved range of n ids
+        return self.collection.find_one_and_update(
+            self.query, {'$inc': {self.field: n}})[self.field]
+
+    def next_id(self):
+        return self.next_ids(1)[0]
+
+    def next_ids(self, n):
+        """
+        Get n ids. They are consecutive unless the local range runs out
+        part-way.
+        """
+        with self._lock:
+            ids = range(self._next, min(self._end, self._next + n))
+            self._next += len(ids)
+            ids = list(ids)
+            missing = n - len(ids)
+            if missing > 0:
+                block = max(missing, self._next_block)
+                first = self._reserve(block)
+                self._next_block = min(self.block_size, self._next_block * 2)
+                ids.extend(range(first, first + missing))
+                self._next = first + missing
+                self._end = first + block
+            return ids
+
+    def reset(self):
+        """
+        Forget the ids reserved locally, e.g. after the counter was reset.
+        This doesn't reach other processes, which must be restarted (see the
+        module docstring).
+        """
+        with self._lock:
+            self._next = self._end = 0
+            self._next_block = 1
+
+
+def get_id_allocator(collection, query, field, block_size=ID_BLOCK_SIZE):
+    """
+    Get the IdAllocator of this process for a counter field. Allocators are
+    shared by all adapters/drones in a process and are rebuilt after a fork,
+    so that parent and child never hand out ids from the same range.
+    """
+    key = ('id_allocator', client_settings_key(collection.database.client), collection.full_name,
+           tuple(sorted(query.items())), field)
+    return get_shared(key, lambda: IdAllocator(collection, query, field, block_size))
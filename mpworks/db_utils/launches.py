@@ -0,0 +1,72 @@
+from mpworks.db_utils.connection import client_settings_key, run_once
+from mpworks.workflows.wf_utils import get_block_part
+
+'''
+Exact, index-backed lookup of FireWorks launches by run directory.
+
+Launch directories move around (scratch -> garden, different RUN_LOCS), so
+launches used to be found with an unanchored $regex on launch_dir, which no
+index can serve. Here the normalized directory, get_block_part(launch_dir),
+is stored in a 'block_part' field of the launch document and looked up with
+an exact match on (fw_id, block_part).
+
+FireWorks does not know about this field, so new launches don't have it yet.
+A miss falls back to the launches of that fw_id (a short list, fw_id is
+indexed by FireWorks) and fills in block_part on them, so each launch is
+only ever scanned once. fix_scripts/add_launch_block_parts.py does the same
+for all existing launches in one go.
+'''
+
+BLOCK_PART_FIELD = 'block_part'
+
+
+def ensure_launch_indices(launches_coll):
+    launches_coll.ensure_index([('fw_id', 1), (BLOCK_PART_FIELD, 1)])
+
+
+def _ensure_indices_once(launches_coll):
+    run_once(('launch_indices', client_settings_key(launches_coll.database.client),
+              launches_coll.full_name),
+             ensure_launch_indices, launches_coll)
+
+
+def set_block_part(launches_coll, launch_doc):
+    """
+    Store the block part of launch_doc['launch_dir'] on the launch document.
+    """
+    block_part = get_block_part(launch_doc['launch_dir'])
+    launches_coll.update_one({'_id': launch_doc['_id']},
+                             {'$set': {BLOCK_PART_FIELD: block_part}})
+    return block_part
+
+
+def find_launch_by_block_part(launches_coll, fw_id, dir_name, projection=None):
+    """
+    Find the launch of Firework fw_id that ran in dir_name.
+
+    :param launches_coll: the FireWorks launches collection
+    :param fw_id: (int) the Firework id
+    :param dir_name: (str) the run directory, full path or block part
+    :param projection: (dict) fields to return, as for find_one()
+    :return: the launch document, or None
+    """
+    _ensure_indices_once(launches_coll)
+    block_part = get_block_part(dir_name)
+    launch_doc = launches_coll.find_one({'fw_id': fw_id, BLOCK_PART_FIELD: block_part},
+                                        projection)
+    if launch_doc is not None:
+        return launch_doc
+
+    # not backfilled yet; check the launches of this fw_id and remember the
+    # block part of each so the next lookup is an exact match
+    fields = dict(projection) if projection else None
+    if fields is not None:
+        fields.update({'launch_dir': 1, BLOCK_PART_FIELD: 1})
+    match = None
+    for l in launches_coll.find({'fw_id': fw_id, BLOCK_PART_FIELD: {'$exists': False}}, fields):
+        if not l.get('launch_dir'):
+            continue
+        l_block_part = set_block_part(launches_coll, l)
+        if match is None and (l_block_part == block_part or block_part in l['launch_dir']):
+            match = l
+    return match
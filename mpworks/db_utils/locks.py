@@ -0,0 +1,140 @@
+import datetime
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from mpworks.db_utils.connection import client_settings_key, get_shared
+
+'''
+Named locks stored in a Mongo collection, one document per lock:
+
+    {'_id': <lock name>, 'owner': <owner id>, 'expires': <utc datetime>}
+
+A lock is a lease: if its owner dies without releasing it, anybody may take
+it over once it has expired. Acquiring is a single upsert that only matches
+a free or expired lock; when the lock is held, the upsert fails on the
+unique _id and the caller retries with exponential backoff and jitter.
+
+While a lock is held, a heartbeat thread renews the lease every
+lease / HEARTBEAT_RATE seconds, so long work under the lock (e.g. structure
+matching a large snlgroup_key bucket) keeps it, and the lease only runs out
+when the owner process is gone. Expiry times are on the clock of the Mongo
+server, so that clock differences between hosts don't matter.
+'''
+
+LOCK_LEASE = 300  # seconds a lock survives its owner before others may take it over
+HEARTBEAT_RATE = 3  # lease renewals per lease period
+LOCK_TIMEOUT = 600  # seconds to keep trying before giving up
+MIN_BACKOFF = 0.05  # seconds to wait after the first failed attempt
+MAX_BACKOFF = 5  # longest wait between two attempts
+
+
+def new_owner_id():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+
+def _measure_clock_offset(database):
+    t0 = datetime.datetime.utcnow()
+    server_time = database.command('isMaster')['localTime']
+    t1 = datetime.datetime.utcnow()
+    return server_time.replace(tzinfo=None) - (t0 + (t1 - t0) / 2)
+
+
+def server_utcnow(collection):
+    """
+    The current UTC time of the server of collection, from the local clock
+    and an offset measured once per process and server.
+    """
+    database = collection.database
+    offset = get_shared(('server_clock_offset', client_settings_key(database.client)),
+                        lambda: _measure_clock_offset(database))
+    return datetime.datetime.utcnow() + offset
+
+
+class LockTimeoutError(ValueError):
+    pass
+
+
+class LeaseLock(object):
+    """
+    A lease on lock name in collection. Use as a context manager, or call
+    acquire() and release().
+    """
+
+    def __init__(self, collection, name, owner=None, lease=LOCK_LEASE,
+                 timeout=LOCK_TIMEOUT):
+        self.collection = collection
+        self.name = name
+        self.owner = owner if owner else new_owner_id()
+        self.lease = lease
+        self.timeout = timeout
+        self._stop_heartbeat = None
+        self._heartbeat_thread = None
+
+    def _try_acquire(self):
+        now = server_utcnow(self.collection)
+        try:
+            self.collection.update_one(
+                {'_id': self.name,
+                 '$or': [{'expires': {'$lt': now}}, {'owner': self.owner}]},
+                {'$set': {'owner': self.owner,
+                          'expires': now + datetime.timedelta(seconds=self.lease)}},
+                upsert=True)
+            return True
+        except DuplicateKeyError:
+            # held (and not expired) by somebody else
+            return False
+
+    def acquire(self):
+        deadline = time.time() + self.timeout
+        backoff = MIN_BACKOFF
+        while not self._try_acquire():
+            if time.time() >= deadline:
+                holder = self.collection.find_one({'_id': self.name}) or {}
+                raise LockTimeoutError('Could not get lock {} within {} seconds, held by {}'.format(
+                    self.name, self.timeout, holder.get('owner')))
+            time.sleep(min(backoff * random.uniform(0.5, 1.5), max(0, deadline - time.time())))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat,
+                                                  args=(self._stop_heartbeat,))
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def _heartbeat(self, stop):
+        while not stop.wait(self.lease / float(HEARTBEAT_RATE)):
+            try:
+                if not self.renew():
+                    print 'WARNING - lost lock {} (owner {})'.format(self.name, self.owner)
+                    return
+            except PyMongoError:
+                pass  # try again at the next beat, the lease isn't over yet
+
+    def renew(self):
+        """
+        Extend the lease, for work that might outlive it. Returns False if
+        the lock has been lost in the meantime.
+        """
+        now = server_utcnow(self.collection)
+        result = self.collection.update_one(
+            {'_id': self.name, 'owner': self.owner},
+            {'$set': {'expires': now + datetime.timedelta(seconds=self.lease)}})
+        return result.matched_count == 1
+
+    def release(self):
+        if self._heartbeat_thread is not None:
+            self._stop_heartbeat.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        self.collection.delete_one({'_id': self.name, 'owner': self.owner})
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
@@ -0,0 +1,124 @@
+import copy
+import io
+from unittest import TestCase
+
+from mpworks.db_utils.gridfs_arrays import put_arrays, read_doc
+from mpworks.db_utils.gridfs_io import put_json
+
+
+class _GridIn(object):
+    def __init__(self, fs, kwargs):
+        self.fs = fs
+        self.kwargs = kwargs
+        self.data = []
+        self._id = len(fs.files)
+
+    def write(self, data):
+        self.data.append(data)
+
+    def abort(self):
+        pass
+
+    def close(self):
+        self.fs.files[self._id] = (b''.join(self.data), self.kwargs)
+
+
+class _GridOut(io.BytesIO):
+    def __init__(self, data, kwargs):
+        io.BytesIO.__init__(self, data)
+        self.contentType = kwargs.get('contentType')
+        self.contentEncoding = kwargs.get('contentEncoding')
+
+
+class _GridFS(object):
+    # the parts of gridfs.GridFS used by gridfs_io and gridfs_arrays, in memory
+    def __init__(self):
+        self.files = {}
+
+    def new_file(self, **kwargs):
+        return _GridIn(self, kwargs)
+
+    def get(self, file_id):
+        return _GridOut(*self.files[file_id])
+
+
+def _bands(shift):
+    return [[-2.0 + shift, -1.5 + shift, -1.0 + shift],
+            [-0.5 + shift, 0.0 + shift, 0.25 + shift],
+            [1.0 + shift, 1.5 + shift, 2.0 + shift],
+            [3.0 + shift, 3.5 + shift, 4.0 + shift]]
+
+
+def _projections(shift):
+    # bands x kpoints x orbitals x sites
+    return [[[[0.125 * b + k + shift, 0.5 * o + shift] for o in range(2)]
+             for k in range(3)] for b in range(4)]
+
+
+BAND_STRUCTURE = {'@class': 'BandStructure', 'efermi': 0.0,
+                  'kpoints': [[0.0, 0.0, 0.0], [0.25, 0.0, 0.0], [0.5, 0.0, 0.0]],
+                  'is_spin_polarized': True,
+                  'bands': {'1': _bands(0.0), '-1': _bands(0.125)},
+                  'projections': {'1': _projections(0.0), '-1': _projections(0.5)}}
+
+DOS = {'@class': 'CompleteDos', 'efermi': 0.5,
+       'energies': [-1.0, -0.5, 0.0, 0.5, 1.0],
+       'densities': {'1': [0.0, 0.25, 1.0, 0.5, 0.0], '-1': [0.0, 0.5, 0.75, 0.25, 0.0]},
+       'pdos': [{'s': {'densities': {'1': [0.0, 0.125, 0.5, 0.25, 0.0],
+                                     '-1': [0.0, 0.25, 0.375, 0.125, 0.0]}}}]}
+
+
+class TestArrayFormat(TestCase):
+    """
+    Docs written with put_arrays() read back like the same docs written as
+    JSON, with every selection of read_doc().
+    """
+
+    def setUp(self):
+        self.fs = _GridFS()
+        self.ids = {}
+        for name, doc in [('bs', BAND_STRUCTURE), ('dos', DOS)]:
+            self.ids[name] = (put_json(self.fs, copy.deepcopy(doc)),
+                              put_arrays(self.fs, copy.deepcopy(doc)))
+
+    def _read_both(self, name, **kwargs):
+        json_id, arrays_id = self.ids[name]
+        from_json = read_doc(self.fs, json_id, **kwargs)
+        from_arrays = read_doc(self.fs, arrays_id, **kwargs)
+        self.assertEqual(from_arrays, from_json)
+        return from_arrays
+
+    def test_full(self):
+        self.assertEqual(self._read_both('bs'), BAND_STRUCTURE)
+        self.assertEqual(self._read_both('dos'), DOS)
+
+    def test_no_projections(self):
+        doc = self._read_both('bs', projections=False)
+        self.assertEqual(doc['projections'], {})
+        self.assertEqual(doc['bands'], BAND_STRUCTURE['bands'])
+        doc = self._read_both('dos', projections=False)
+        self.assertEqual(doc['pdos'], [])
+        self.assertEqual(doc['densities'], DOS['densities'])
+
+    def test_single_spin(self):
+        doc = self._read_both('bs', spins=[1])
+        self.assertEqual(list(doc['bands']), ['1'])
+        self.assertEqual(list(doc['projections']), ['1'])
+        self.assertEqual(doc['projections']['1'], BAND_STRUCTURE['projections']['1'])
+        doc = self._read_both('dos', spins=['-1'])
+        self.assertEqual(doc['densities'], {'-1': DOS['densities']['-1']})
+        self.assertEqual(list(doc['pdos'][0]['s']['densities']), ['-1'])
+
+    def test_band_window(self):
+        # spin up: only the band crossing the Fermi level; spin down is
+        # shifted up by 0.125, so its lowest band reaches -0.875 as well
+        doc = self._read_both('bs', band_window=(-0.9, 0.6))
+        self.assertEqual(doc['band_window'], {'1': [1, 2], '-1': [0, 2]})
+        self.assertEqual(doc['bands']['1'], BAND_STRUCTURE['bands']['1'][1:2])
+        self.assertEqual(doc['projections']['-1'], BAND_STRUCTURE['projections']['-1'][0:2])
+
+    def test_band_window_single_spin_no_projections(self):
+        doc = self._read_both('bs', spins=['-1'], band_window=(-0.5, 0.5), projections=False)
+        self.assertEqual(doc['band_window'], {'-1': [1, 2]})
+        self.assertEqual(doc['bands'], {'-1': BAND_STRUCTURE['bands']['-1'][1:2]})
+        self.assertEqual(doc['projections'], {})
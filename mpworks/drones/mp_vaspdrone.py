@@ -7,22 +7,33 @@ import re
 import traceback
 import six
 from monty.io import zopen
-from monty.os.path import zpath
-from pymongo import MongoClient
 import gridfs
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from matgendb import creator as matgendb_creator
 from matgendb.creator import VaspToDbTaskDrone
+from mpworks.db_utils.connection import get_database, get_shared
+from mpworks.db_utils.gridfs_arrays import put_arrays
+from mpworks.db_utils.gridfs_io import put_json
+from mpworks.db_utils.id_allocator import get_id_allocator
+from mpworks.db_utils.launches import find_launch_by_block_part
+from mpworks.drones.output_cache import cached_parsers, get_output_cache, \
+    get_outcar, get_vasprun, output_cache_scope
+from mpworks.drones.perf import StageTimer, add_bytes, has_metrics_sinks, stage
 from mpworks.drones.signals import VASPInputsExistSignal, \
     VASPOutputsExistSignal, VASPOutSignal, HitAMemberSignal, SegFaultSignal, \
     VASPStartedCompletedSignal, WallTimeSignal, DiskSpaceExceededSignal, \
-    SignalDetectorList, Relax2ExistsSignal
+    SignalDetectorList, SignalScanner, Relax2ExistsSignal
 from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
-from mpworks.workflows.wf_utils import get_block_part
-from pymatgen import Composition, MontyEncoder
+from mpworks.workflows.wf_settings import GRIDFS_ARRAY_FORMAT, STORE_PERF_DATA
+from mpworks.workflows.wf_utils import dir_snapshot, get_block_part, \
+    get_dir_snapshot
+from pymatgen import Composition
 from pymatgen.core.structure import Structure
 from pymatgen.entries.compatibility import MaterialsProjectCompatibility
 from pymatgen.entries.computed_entries import ComputedEntry
 from pymatgen.matproj.snl import StructureNL
-from pymatgen.io.vasp.outputs import Vasprun, Outcar
+from pymatgen.io.vasp.outputs import Vasprun
 from pymatgen.analysis.structure_analyzer import oxide_type
 
 
@@ -39,10 +50,12 @@ logger = logging.getLogger(__name__)
 def is_valid_vasp_dir(mydir):
     # note that the OUTCAR and POSCAR are known to be empty in some
     # situations
+    snapshot = get_dir_snapshot()
     files = ["OUTCAR", "POSCAR", "INCAR", "KPOINTS"]
     for f in files:
         m_file = os.path.join(mydir, f)
-        if not os.path.exists(zpath(m_file)) or not(os.stat(m_file).st_size > 0 or os.stat(m_file+'.gz').st_size > 0):
+        if not snapshot.exists(snapshot.zpath(m_file)) or \
+                not (snapshot.getsize(m_file) > 0 or snapshot.getsize(m_file + '.gz') > 0):
             return False
     return True
 
@@ -58,7 +71,240 @@ class MPVaspDrone(VaspToDbTaskDrone):
             purposes. Else, only the task_id of the inserted doc is returned.
         """
 
-        d = self.get_task_doc(path)
+        # one listing per directory for all the file lookups of this run, and
+        # one parse per output file
+        with StageTimer() as timer, dir_snapshot(), output_cache_scope():
+            d = self._parse_dir(path)
+
+            if not self.simulate:
+                # Perform actual insertion into db. Because db connections cannot
+                # be pickled, the connection is looked up in the process-wide
+                # registry rather than stored on the drone.
+                db = self._get_db()
+                coll = db[self.collection]
+
+                with timer.stage('duplicate_check'):
+                    result = coll.find_one({"dir_name": d["dir_name"]})
+
+                if result is None or self.update_duplicates:
+                    self._store_dos(d, db)
+
+                    d["last_updated"] = datetime.datetime.today()
+                    if result is None:
+                        if ("task_id" not in d) or (not d["task_id"]):
+                            with timer.stage('task_id'):
+                                d["task_id"] = "mp-{}".format(
+                                    self._get_task_id_allocator(db).next_id())
+                        logger.info("Inserting {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+                    elif self.update_duplicates:
+                        d["task_id"] = result["task_id"]
+                        logger.info("Updating {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+
+                    self._post_process(path, d, db, launches_coll)
+
+                    # the upsert can't time itself into the doc it writes;
+                    # its time only goes to the metrics sinks
+                    if STORE_PERF_DATA:
+                        d['_perf'] = timer.as_dict()
+                    with timer.stage('upsert'):
+                        coll.update_one({"dir_name": d["dir_name"]}, {'$set': d}, upsert=True)
+                    timer.report(path)
+
+                    return d["task_id"], d
+                else:
+                    logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                    timer.report(path)
+                    return result["task_id"], result
+
+            else:
+                d["task_id"] = 0
+                logger.info("Simulated insert into database for {} with task_id {}"
+                .format(d["dir_name"], d["task_id"]))
+                if STORE_PERF_DATA:
+                    d['_perf'] = timer.as_dict()
+                timer.report(path)
+                return 0, d
+
+    def assimilate_many(self, paths, launches_coll=None, batch_size=50):
+        """
+        Bulk version of assimilate(). Directories are parsed one at a time
+        from the (possibly lazy) iterable paths, but the database work is done
+        per batch: a single $in query for duplicates, a single reservation of
+        a block of task ids and a single bulk_write of the upserts.
+
+        A directory that fails to parse, post-process or be written is logged
+        and skipped so that one bad run does not stop a re-ingest job.
+
+        Returns:
+            A generator of (path, task_id, doc) tuples, in the order of paths.
+            Nothing is parsed or inserted until the generator is consumed.
+        """
+        batch = []
+        for path in paths:
+            timer = StageTimer()
+            try:
+                # the band structure is only extracted once the whole batch
+                # is parsed, after this scope is gone: don't parse the
+                # projections here, _post_process() parses them on its own
+                with timer, dir_snapshot(), output_cache_scope():
+                    batch.append((path, self._parse_dir(path, hint_projections=False), timer))
+            except:
+                logger.error("Could not parse {}:\n{}".format(
+                    path, traceback.format_exc()))
+                continue
+
+            if len(batch) >= batch_size:
+                for r in self._insert_batch(batch, launches_coll):
+                    yield r
+                batch = []
+
+        if batch:
+            for r in self._insert_batch(batch, launches_coll):
+                yield r
+
+    def _insert_batch(self, batch, launches_coll):
+        if self.simulate:
+            results = []
+            for path, d, timer in batch:
+                d["task_id"] = 0
+                logger.info("Simulated insert into database for {} with task_id {}"
+                .format(d["dir_name"], d["task_id"]))
+                if STORE_PERF_DATA:
+                    d['_perf'] = timer.as_dict()
+                timer.report(path)
+                results.append((path, 0, d))
+            return results
+
+        db = self._get_db()
+        coll = db[self.collection]
+        batch_timer = StageTimer()
+
+        with batch_timer.stage('duplicate_check'):
+            dir_names = list(set([d["dir_name"] for path, d, timer in batch]))
+            existing = dict([(r["dir_name"], r) for r in
+                             coll.find({"dir_name": {"$in": dir_names}})])
+
+        # directories needing a brand new task_id get one from the block
+        # reserved on the counter rather than one round trip each
+        new_dirs = set()
+        for path, d, timer in batch:
+            if d["dir_name"] not in existing and not d.get("task_id"):
+                new_dirs.add(d["dir_name"])
+        new_ids = {}
+        if new_dirs:
+            with batch_timer.stage('task_id'):
+                ids = self._get_task_id_allocator(db).next_ids(len(new_dirs))
+            for dir_name, task_id in zip(sorted(new_dirs), ids):
+                new_ids[dir_name] = "mp-{}".format(task_id)
+
+        results = []
+        requests = []
+        written = []  # (path, doc, timer) of each request
+        request_of = {}  # dir_name -> index in requests
+        seen = {}  # dir_name -> (task_id, doc) for repeats inside this batch
+        for path, d, timer in batch:
+            result = existing.get(d["dir_name"])
+            if d["dir_name"] in seen and not self.update_duplicates:
+                logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                results.append((path,) + seen[d["dir_name"]])
+                continue
+            if result is not None and not self.update_duplicates:
+                logger.info("Skipping duplicate {}".format(d["dir_name"]))
+                results.append((path, result["task_id"], result))
+                continue
+
+            try:
+                with timer, dir_snapshot():
+                    self._store_dos(d, db)
+                    d["last_updated"] = datetime.datetime.today()
+                    if d["dir_name"] in seen:
+                        d["task_id"] = seen[d["dir_name"]][0]
+                    elif result is None:
+                        if not d.get("task_id"):
+                            d["task_id"] = new_ids[d["dir_name"]]
+                        logger.info("Inserting {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+                    else:
+                        d["task_id"] = result["task_id"]
+                        logger.info("Updating {} with taskid = {}"
+                        .format(d["dir_name"], d["task_id"]))
+
+                    self._post_process(path, d, db, launches_coll)
+            except:
+                # the reserved task_id (if any) is simply left unused
+                logger.error("Could not process {}:\n{}".format(
+                    path, traceback.format_exc()))
+                continue
+
+            if STORE_PERF_DATA:
+                d['_perf'] = timer.as_dict()
+            seen[d["dir_name"]] = (d["task_id"], d)
+            request = UpdateOne({"dir_name": d["dir_name"]}, {'$set': d}, upsert=True)
+            if d["dir_name"] in request_of:
+                # a repeat with update_duplicates: only the last one is
+                # written, the unordered bulk write could apply them in any order
+                i = request_of[d["dir_name"]]
+                self._delete_gridfs(written[i][1], db)
+                requests[i] = request
+                written[i] = (path, d, timer)
+            else:
+                request_of[d["dir_name"]] = len(requests)
+                requests.append(request)
+                written.append((path, d, timer))
+            results.append((path, d["task_id"], d))
+
+        failed = set()
+        if requests:
+            with batch_timer.stage('upsert'):
+                try:
+                    coll.bulk_write(requests, ordered=False)
+                except BulkWriteError as e:
+                    # the other upserts went through
+                    for error in e.details['writeErrors']:
+                        path, d, timer = written[error['index']]
+                        logger.error("Could not insert {}: {}".format(path, error['errmsg']))
+                        self._delete_gridfs(d, db)
+                        failed.add(d["dir_name"])
+        for path, d, timer in written:
+            if d["dir_name"] not in failed:
+                timer.report(path)
+        batch_timer.report(None)
+        return [r for r in results if r[2]["dir_name"] not in failed]
+
+    @staticmethod
+    def _get_task_id_allocator(db):
+        return get_id_allocator(db.counter, {"_id": "taskid"}, "c")
+
+    def _get_db(self):
+        return get_database(self.host, self.port, self.database,
+                            self.user, self.password)
+
+    def _parse_dir(self, path, hint_projections=True):
+        # band structure runs need the projections later on; if _post_process()
+        # runs in the same output_cache_scope(), parse them the first time
+        # round so vasprun.xml is only read once
+        snapshot = get_dir_snapshot()
+        if hint_projections:
+            try:
+                with zopen(snapshot.zpath(os.path.join(path, 'FW.json'))) as f:
+                    task_type = json.load(f)['spec'].get('task_type', '')
+                if 'band structure' in task_type or 'Uniform' in task_type:
+                    get_output_cache().hint(Vasprun, snapshot.zpath(os.path.join(path, "vasprun.xml")),
+                                            parse_projected_eigen=True)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+
+        with stage('parse'):
+            with cached_parsers(matgendb_creator):
+                d = self.get_task_doc(path)
+        if STORE_PERF_DATA or has_metrics_sinks():
+            parsed_files = []
+            for m_dir in [path, os.path.join(path, 'relax1'), os.path.join(path, 'relax2')]:
+                for pattern in ['vasprun.xml*', 'OUTCAR*']:
+                    parsed_files.extend(snapshot.glob(os.path.join(m_dir, pattern)))
+            add_bytes('parse', sum([snapshot.getsize(f) for f in parsed_files]))
         if self.additional_fields:
             d.update(self.additional_fields)  # always add additional fields, even for failed jobs
 
@@ -71,164 +317,153 @@ class MPVaspDrone(VaspToDbTaskDrone):
             pprint.pprint(d)
             print traceback.format_exc()
             raise ValueError('IMPROPER PARSING OF {}'.format(path))
+        return d
+
+    def _store_dos(self, d, db):
+        # Insert dos data into gridfs and then remove it from the dict.
+        # DOS data tends to be above the 4Mb limit for mongo docs. A ref
+        # to the dos file is in the dos_fs_id.
+        if self.parse_dos and "calculations" in d:
+            for calc in d["calculations"]:
+                if "dos" in calc:
+                    fs = gridfs.GridFS(db, "dos_fs")
+                    with stage('gridfs_dos'):
+                        dosid = self._put_gridfs(fs, calc["dos"])
+                    calc["dos_fs_id"] = dosid
+                    del calc["dos"]
+
+    @staticmethod
+    def _delete_gridfs(d, db):
+        # the DOS and band structure files of a doc that wasn't written
+        for calc in d.get("calculations", []):
+            for key, fs_name in [("dos_fs_id", "dos_fs"), ("band_structure_fs_id", "band_structure_fs")]:
+                if key in calc:
+                    gridfs.GridFS(db, fs_name).delete(calc[key])
+
+    @staticmethod
+    def _put_gridfs(fs, doc):
+        if GRIDFS_ARRAY_FORMAT:
+            return put_arrays(fs, doc)
+        return put_json(fs, doc)
+
+    def _post_process(self, path, d, db, launches_coll):
+        # everything that happens to a doc between getting its task_id and
+        # writing it to the tasks collection
+
+        #Fireworks processing
+
+        self.process_fw(path, d)
+
+        with stage('oxide_type'):
+            try:
+                #Add oxide_type
+                struct=Structure.from_dict(d["output"]["crystal"])
+                d["oxide_type"]=oxide_type(struct)
+            except:
+                logger.error("can't get oxide_type for {}".format(d["task_id"]))
+                d["oxide_type"] = None
+
+        #Override incorrect outcar subdocs for two step relaxations
+        snapshot = get_dir_snapshot()
+        if "optimize structure" in d['task_type'] and \
+            snapshot.exists(os.path.join(path, "relax2")):
+            try:
+                run_stats = {}
+                for i in [1,2]:
+                    o_path = os.path.join(path,"relax"+str(i),"OUTCAR")
+                    o_path = o_path if snapshot.exists(o_path) else o_path+".gz"
+                    with stage('parse'):
+                        outcar = get_outcar(o_path)
+                    d["calculations"][i-1]["output"]["outcar"] = outcar.as_dict()
+                    run_stats["relax"+str(i)] = outcar.run_stats
+            except:
+                logger.error("Bad OUTCAR for {}.".format(path))
+
+            try:
+                overall_run_stats = {}
+                for key in ["Total CPU time used (sec)", "User time (sec)",
+                            "System time (sec)", "Elapsed time (sec)"]:
+                    overall_run_stats[key] = sum([v[key]
+                                      for v in run_stats.values()])
+                run_stats["overall"] = overall_run_stats
+            except:
+                logger.error("Bad run stats for {}.".format(path))
+
+            d["run_stats"] = run_stats
+
+        # add is_compatible
+        mpc = MaterialsProjectCompatibility("Advanced")
 
-        if not self.simulate:
-            # Perform actual insertion into db. Because db connections cannot
-            # be pickled, every insertion needs to create a new connection
-            # to the db.
-            conn = MongoClient(self.host, self.port)
-            db = conn[self.database]
-            if self.user:
-                db.authenticate(self.user, self.password)
-            coll = db[self.collection]
-
-            # Insert dos data into gridfs and then remove it from the dict.
-            # DOS data tends to be above the 4Mb limit for mongo docs. A ref
-            # to the dos file is in the dos_fs_id.
-            result = coll.find_one({"dir_name": d["dir_name"]})
-
-            if result is None or self.update_duplicates:
-                if self.parse_dos and "calculations" in d:
-                    for calc in d["calculations"]:
-                        if "dos" in calc:
-                            dos = json.dumps(calc["dos"], cls=MontyEncoder)
-                            fs = gridfs.GridFS(db, "dos_fs")
-                            dosid = fs.put(dos)
-                            calc["dos_fs_id"] = dosid
-                            del calc["dos"]
-
-                d["last_updated"] = datetime.datetime.today()
-                if result is None:
-                    if ("task_id" not in d) or (not d["task_id"]):
-                        d["task_id"] = "mp-{}".format(
-                            db.counter.find_one_and_update(
-                                {"_id": "taskid"}, {"$inc": {"c": 1}}
-			    )["c"])
-                    logger.info("Inserting {} with taskid = {}"
-                    .format(d["dir_name"], d["task_id"]))
-                elif self.update_duplicates:
-                    d["task_id"] = result["task_id"]
-                    logger.info("Updating {} with taskid = {}"
-                    .format(d["dir_name"], d["task_id"]))
-
-                #Fireworks processing
-
-                self.process_fw(path, d)
+        try:
+            func = d["pseudo_potential"]["functional"]
+            labels = d["pseudo_potential"]["labels"]
+            symbols = ["{} {}".format(func, label) for label in labels]
+            parameters = {"run_type": d["run_type"],
+                      "is_hubbard": d["is_hubbard"],
+                      "hubbards": d["hubbards"],
+                      "potcar_symbols": symbols}
+            entry = ComputedEntry(Composition(d["unit_cell_formula"]),
+                                  0.0, 0.0, parameters=parameters,
+                                  entry_id=d["task_id"])
+
+            with stage('compatibility'):
+                d['is_compatible'] = bool(mpc.process_entry(entry))
+        except:
+            traceback.print_exc()
+            print 'ERROR in getting compatibility'
+            d['is_compatible'] = None
 
-                try:
-                    #Add oxide_type
-                    struct=Structure.from_dict(d["output"]["crystal"])
-                    d["oxide_type"]=oxide_type(struct)
-                except:
-                    logger.error("can't get oxide_type for {}".format(d["task_id"]))
-                    d["oxide_type"] = None
-
-                #Override incorrect outcar subdocs for two step relaxations
-                if "optimize structure" in d['task_type'] and \
-                    os.path.exists(os.path.join(path, "relax2")):
-                    try:
-                        run_stats = {}
-                        for i in [1,2]:
-                            o_path = os.path.join(path,"relax"+str(i),"OUTCAR")
-                            o_path = o_path if os.path.exists(o_path) else o_path+".gz"
-                            outcar = Outcar(o_path)
-                            d["calculations"][i-1]["output"]["outcar"] = outcar.as_dict()
-                            run_stats["relax"+str(i)] = outcar.run_stats
-                    except:
-                        logger.error("Bad OUTCAR for {}.".format(path))
-
-                    try:
-                        overall_run_stats = {}
-                        for key in ["Total CPU time used (sec)", "User time (sec)",
-                                    "System time (sec)", "Elapsed time (sec)"]:
-                            overall_run_stats[key] = sum([v[key]
-                                              for v in run_stats.values()])
-                        run_stats["overall"] = overall_run_stats
-                    except:
-                        logger.error("Bad run stats for {}.".format(path))
-
-                    d["run_stats"] = run_stats
-
-                # add is_compatible
-                mpc = MaterialsProjectCompatibility("Advanced")
 
+        #task_type dependent processing
+        if 'static' in d['task_type']:
+            with stage('launch_lookup'):
+                launch_doc = find_launch_by_block_part(launches_coll, d['fw_id'], d["dir_name"], {"action.stored_data": 1})
+            for i in ["conventional_standard_structure", "symmetry_operations",
+                      "symmetry_dataset", "refined_structure"]:
                 try:
-                    func = d["pseudo_potential"]["functional"]
-                    labels = d["pseudo_potential"]["labels"]
-                    symbols = ["{} {}".format(func, label) for label in labels]
-                    parameters = {"run_type": d["run_type"],
-                              "is_hubbard": d["is_hubbard"],
-                              "hubbards": d["hubbards"],
-                              "potcar_symbols": symbols}
-                    entry = ComputedEntry(Composition(d["unit_cell_formula"]),
-                                          0.0, 0.0, parameters=parameters,
-                                          entry_id=d["task_id"])
-
-                    d['is_compatible'] = bool(mpc.process_entry(entry))
+                    d['stored_data'][i] = launch_doc['action']['stored_data'][i]
                 except:
-                    traceback.print_exc()
-                    print 'ERROR in getting compatibility'
-                    d['is_compatible'] = None
-
-
-                #task_type dependent processing
-                if 'static' in d['task_type']:
-                    launch_doc = launches_coll.find_one({"fw_id": d['fw_id'], "launch_dir": {"$regex": d["dir_name"]}}, {"action.stored_data": 1})
-                    for i in ["conventional_standard_structure", "symmetry_operations",
-                              "symmetry_dataset", "refined_structure"]:
-                        try:
-                            d['stored_data'][i] = launch_doc['action']['stored_data'][i]
-                        except:
-                            pass
-
-                #parse band structure if necessary
-                if ('band structure' in d['task_type'] or "Uniform" in d['task_type'])\
-                    and d['state'] == 'successful':
-                    launch_doc = launches_coll.find_one({"fw_id": d['fw_id'], "launch_dir": {"$regex": d["dir_name"]}},
-                                                        {"action.stored_data": 1})
-                    vasp_run = Vasprun(zpath(os.path.join(path, "vasprun.xml")), parse_projected_eigen=True)
-
-                    if 'band structure' in d['task_type']:
-                        def string_to_numlist(stringlist):
-                            g=re.search('([0-9\-\.eE]+)\s+([0-9\-\.eE]+)\s+([0-9\-\.eE]+)', stringlist)
-                            return [float(g.group(i)) for i in range(1,4)]
-
-                        for i in ["kpath_name", "kpath"]:
-                            d['stored_data'][i] = launch_doc['action']['stored_data'][i]
-                        kpoints_doc = d['stored_data']['kpath']['kpoints']
-                        for i in kpoints_doc:
-                            if isinstance(kpoints_doc[i], six.string_types):
-                                kpoints_doc[i]=string_to_numlist(kpoints_doc[i])
-                        bs=vasp_run.get_band_structure(efermi=d['calculations'][0]['output']['outcar']['efermi'],
-                                                       line_mode=True)
-                    else:
-                        bs=vasp_run.get_band_structure(efermi=d['calculations'][0]['output']['outcar']['efermi'],
-                                                       line_mode=False)
-                    bs_json = json.dumps(bs.as_dict(), cls=MontyEncoder)
-                    fs = gridfs.GridFS(db, "band_structure_fs")
-                    bs_id = fs.put(bs_json)
-                    d['calculations'][0]["band_structure_fs_id"] = bs_id
-
-                    # also override band gap in task doc
-                    gap = bs.get_band_gap()
-                    vbm = bs.get_vbm()
-                    cbm = bs.get_cbm()
-                    update_doc = {'bandgap': gap['energy'], 'vbm': vbm['energy'], 'cbm': cbm['energy'], 'is_gap_direct': gap['direct']}
-                    d['analysis'].update(update_doc)
-                    d['calculations'][0]['output'].update(update_doc)
-
-		coll.update_one({"dir_name": d["dir_name"]}, {'$set': d}, upsert=True)
-
-                return d["task_id"], d
+                    pass
+
+        #parse band structure if necessary
+        if ('band structure' in d['task_type'] or "Uniform" in d['task_type'])\
+            and d['state'] == 'successful':
+            with stage('launch_lookup'):
+                launch_doc = find_launch_by_block_part(launches_coll, d['fw_id'], d["dir_name"],
+                                                       {"action.stored_data": 1})
+            with stage('parse'):
+                vasp_run = get_vasprun(snapshot.zpath(os.path.join(path, "vasprun.xml")), parse_projected_eigen=True)
+
+            if 'band structure' in d['task_type']:
+                def string_to_numlist(stringlist):
+                    g=re.search('([0-9\-\.eE]+)\s+([0-9\-\.eE]+)\s+([0-9\-\.eE]+)', stringlist)
+                    return [float(g.group(i)) for i in range(1,4)]
+
+                for i in ["kpath_name", "kpath"]:
+                    d['stored_data'][i] = launch_doc['action']['stored_data'][i]
+                kpoints_doc = d['stored_data']['kpath']['kpoints']
+                for i in kpoints_doc:
+                    if isinstance(kpoints_doc[i], six.string_types):
+                        kpoints_doc[i]=string_to_numlist(kpoints_doc[i])
+                with stage('band_structure'):
+                    bs=vasp_run.get_band_structure(efermi=d['calculations'][0]['output']['outcar']['efermi'],
+                                                   line_mode=True)
             else:
-                logger.info("Skipping duplicate {}".format(d["dir_name"]))
-                return result["task_id"], result
-
-        else:
-            d["task_id"] = 0
-            logger.info("Simulated insert into database for {} with task_id {}"
-            .format(d["dir_name"], d["task_id"]))
-            return 0, d
+                with stage('band_structure'):
+                    bs=vasp_run.get_band_structure(efermi=d['calculations'][0]['output']['outcar']['efermi'],
+                                                   line_mode=False)
+            fs = gridfs.GridFS(db, "band_structure_fs")
+            with stage('gridfs_band_structure'):
+                bs_id = self._put_gridfs(fs, bs.as_dict())
+            d['calculations'][0]["band_structure_fs_id"] = bs_id
+
+            # also override band gap in task doc
+            gap = bs.get_band_gap()
+            vbm = bs.get_vbm()
+            cbm = bs.get_cbm()
+            update_doc = {'bandgap': gap['energy'], 'vbm': vbm['energy'], 'cbm': cbm['energy'], 'is_gap_direct': gap['direct']}
+            d['analysis'].update(update_doc)
+            d['calculations'][0]['output'].update(update_doc)
 
     def process_fw(self, dir_name, d):
         d["task_id_deprecated"] = int(d["task_id"].split('-')[-1])  # useful for WC and AJ
@@ -240,7 +475,8 @@ class MPVaspDrone(VaspToDbTaskDrone):
                 break
 
         # custom Materials Project post-processing for FireWorks
-        with zopen(zpath(os.path.join(dir_name, 'FW.json'))) as f:
+        snapshot = get_dir_snapshot()
+        with zopen(snapshot.zpath(os.path.join(dir_name, 'FW.json'))) as f:
             fw_dict = json.load(f)
             d['fw_id'] = fw_dict['fw_id']
             d['snl'] = fw_dict['spec']['mpsnl']
@@ -268,11 +504,12 @@ class MPVaspDrone(VaspToDbTaskDrone):
                                           old_snl.data, history)
 
                     # enter new SNL into SNL db
-                    # get the SNL mongo adapter
-                    sma = SNLMongoAdapter.auto_load()
+                    # get the SNL mongo adapter (one per process)
+                    sma = get_shared('snl_db', SNLMongoAdapter.auto_load)
 
                     # add snl
-                    mpsnl, snlgroup_id, spec_group = sma.add_snl(new_snl, snlgroup_guess=d['snlgroup_id'])
+                    with stage('snl_add'):
+                        mpsnl, snlgroup_id, spec_group = sma.add_snl(new_snl, snlgroup_guess=d['snlgroup_id'])
                     d['snl_final'] = mpsnl.as_dict()
                     d['snlgroup_id_final'] = snlgroup_id
                     d['snlgroup_changed'] = (d['snlgroup_id'] !=
@@ -283,7 +520,7 @@ class MPVaspDrone(VaspToDbTaskDrone):
                     d['snlgroup_changed'] = False
 
         # custom processing for detecting errors
-        new_style = os.path.exists(zpath(os.path.join(dir_name, 'FW.json')))
+        new_style = snapshot.exists(snapshot.zpath(os.path.join(dir_name, 'FW.json')))
         vasp_signals = {}
         critical_errors = ["INPUTS_DONT_EXIST",
                            "OUTPUTS_DONT_EXIST", "INCOHERENT_POTCARS",
@@ -324,17 +561,20 @@ class MPVaspDrone(VaspToDbTaskDrone):
         if d['state'] == 'successful' and 'optimize structure' in d['task_type']:
             sl.append(Relax2ExistsSignal())
 
-        signals = sl.detect_all(last_relax_dir)
+        # all detectors share one scanner so that vasp.out, OUTCAR and the
+        # *.error files are each read only once
+        scanner = SignalScanner()
+        scanner.add_all(sl, last_relax_dir)
 
-        signals = signals.union(WallTimeSignal().detect(dir_name))
+        scanner.add(WallTimeSignal(), dir_name)
+        scanner.add(DiskSpaceExceededSignal(), dir_name)
         if not new_style:
             root_dir = os.path.dirname(dir_name)  # one level above dir_name
-            signals = signals.union(WallTimeSignal().detect(root_dir))
+            scanner.add(WallTimeSignal(), root_dir)
+            scanner.add(DiskSpaceExceededSignal(), root_dir)
 
-        signals = signals.union(DiskSpaceExceededSignal().detect(dir_name))
-        if not new_style:
-            root_dir = os.path.dirname(dir_name)  # one level above dir_name
-            signals = signals.union(DiskSpaceExceededSignal().detect(root_dir))
+        with stage('signals'):
+            signals = scanner.scan()
 
         if d.get('output',{}).get('final_energy', None) > 0:
             signals.add('POSITIVE_ENERGY')
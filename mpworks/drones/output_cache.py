@@ -0,0 +1,189 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pymatgen.io.vasp.outputs import Vasprun, Outcar
+
+'''
+A small per-process cache of parsed VASP outputs.
+
+A single task gets its vasprun.xml parsed by the pymatgen-db drone, again by
+MPVaspDrone for band structures and a third time by the custodian
+UnconvergedErrorHandler in VaspToDBTask. Going through this cache, each file
+is parsed once. Entries are keyed on the real path, mtime and size of the
+file plus the parser options, so a file that changes on disk is always
+re-parsed.
+
+Parsed objects are only kept inside an output_cache_scope() block (e.g. one
+assimilate() call) and are dropped when the outermost block exits, so that a
+long-lived process doesn't hold on to big Vasprun objects between runs.
+Outside of a scope, the cache parses without storing anything.
+'''
+
+MAX_CACHED_OUTPUTS = 4  # parsed Vasprun objects with projections are big
+
+# Vasprun options for which a parse with True can answer a request for False
+_SUPERSET_OPTIONS = {'parse_dos': True, 'parse_eigen': True,
+                     'parse_projected_eigen': False}
+
+
+def _normalize_options(parser_cls, kwargs):
+    options = dict(kwargs)
+    if parser_cls is Vasprun:
+        for k, default in _SUPERSET_OPTIONS.items():
+            options[k] = bool(options.get(k, default))
+    return options
+
+
+def _satisfies(cached_options, options):
+    if set(cached_options.keys()) != set(options.keys()):
+        return False
+    for k, v in options.items():
+        if cached_options[k] == v:
+            continue
+        if k in _SUPERSET_OPTIONS and cached_options[k] and not v:
+            continue
+        return False
+    return True
+
+
+class VaspOutputCache(object):
+    """
+    LRU cache of Vasprun/Outcar objects, limited to maxsize entries.
+    """
+
+    def __init__(self, maxsize=MAX_CACHED_OUTPUTS):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # (cls, path, mtime, size) -> [(options, obj)]
+        self._hints = {}  # (cls, path) -> options to use for the next parse
+        self._lock = threading.RLock()
+        self._depth = 0  # nesting level of scope()
+
+    @staticmethod
+    def _file_key(parser_cls, filename):
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        return parser_cls, path, st.st_mtime, st.st_size
+
+    def hint(self, parser_cls, filename, **kwargs):
+        """
+        Ask for the next parse of filename to also include these options,
+        e.g. parse_projected_eigen=True when it is known that a band
+        structure will be extracted later from the same vasprun.xml.
+        """
+        if not os.path.exists(filename):
+            return
+        with self._lock:
+            if not self._depth:
+                return  # nothing would be kept for the later use
+            key = (parser_cls, os.path.realpath(filename))
+            self._hints.setdefault(key, {}).update(kwargs)
+
+    def get(self, parser_cls, filename, **kwargs):
+        options = _normalize_options(parser_cls, kwargs)
+        file_key = self._file_key(parser_cls, filename)
+        with self._lock:
+            for cached_options, obj in self._entries.get(file_key, []):
+                if _satisfies(cached_options, options):
+                    self._entries[file_key] = self._entries.pop(file_key)
+                    return obj
+
+            hint = self._hints.pop(file_key[:2], {})
+            for k, v in hint.items():
+                if k in _SUPERSET_OPTIONS:
+                    options[k] = options[k] or bool(v)
+                else:
+                    options.setdefault(k, v)
+
+        # parse outside of the lock, this is the slow part
+        obj = parser_cls(filename, **options)
+
+        with self._lock:
+            if not self._depth:
+                return obj
+            entries = self._entries.pop(file_key, [])
+            entries.append((options, obj))
+            self._entries[file_key] = entries
+            while sum([len(v) for v in self._entries.values()]) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._entries[oldest].pop(0)
+                if not self._entries[oldest]:
+                    del self._entries[oldest]
+        return obj
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._hints.clear()
+
+    @contextmanager
+    def scope(self):
+        """
+        Keep parsed objects until the outermost scope exits
+        """
+        with self._lock:
+            self._depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if not self._depth:
+                    self.clear()
+
+
+_cache = VaspOutputCache()
+
+
+def get_output_cache():
+    return _cache
+
+
+def output_cache_scope():
+    """
+    Share parses within this block, see the module docstring
+    """
+    return _cache.scope()
+
+
+def get_vasprun(filename, **kwargs):
+    """
+    A cached replacement for Vasprun(filename, **kwargs)
+    """
+    return _cache.get(Vasprun, filename, **kwargs)
+
+
+def get_outcar(filename):
+    """
+    A cached replacement for Outcar(filename)
+    """
+    return _cache.get(Outcar, filename)
+
+
+@contextmanager
+def cached_parsers(*modules):
+    """
+    Within this block, Vasprun(...) and Outcar(...) calls made by code in the
+    given modules (e.g. matgendb.creator, custodian.vasp.handlers) go through
+    the cache. This is how parses done by third-party code get shared; it
+    swaps module globals, so only use it around single-threaded code.
+    """
+    def cached_factory(parser_cls):
+        def factory(filename, *args, **kwargs):
+            if args:
+                # positional options, don't try to be clever
+                return parser_cls(filename, *args, **kwargs)
+            return _cache.get(parser_cls, filename, **kwargs)
+        return factory
+
+    saved = []
+    for m in modules:
+        for name, parser_cls in [('Vasprun', Vasprun), ('Outcar', Outcar)]:
+            if hasattr(m, name):
+                saved.append((m, name, getattr(m, name)))
+                setattr(m, name, cached_factory(parser_cls))
+    try:
+        yield
+    finally:
+        for m, name, orig in reversed(saved):
+            setattr(m, name, orig)
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+
+'''
+Lightweight per-stage timing of task insertion.
+
+The drone opens a StageTimer for every directory it processes and wraps each
+step (parsing, signal detection, SNL grouping, GridFS writes, ...) in
+stage(name). Code that runs inside a timed block does not need a reference
+to the timer: stage() looks up the timer of the current thread and does
+nothing when there is none, so process_fw() etc. can still be called on
+their own.
+
+The drone stores the timings in the task doc under '_perf' if
+STORE_PERF_DATA is set in wf_settings, and passes them to every registered
+metrics sink. Byte counts that cost extra filesystem calls are only
+collected when one of the two will use them.
+'''
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_sinks = []
+
+
+def add_metrics_sink(sink):
+    """
+    Register a callable sink(path, perf) that is called with the directory
+    and the timing dict (see StageTimer.as_dict()) of every processed task,
+    e.g. to push the numbers to statsd or a log file. Database work shared by
+    a whole batch in MPVaspDrone.assimilate_many() is reported once, with
+    path=None. Errors raised by a sink are logged and otherwise ignored.
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_metrics_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def has_metrics_sinks():
+    return bool(_sinks)
+
+
+class StageTimer(object):
+    """
+    Accumulates wall time and bytes read per named stage. The timer can be
+    entered several times (e.g. once to parse a directory and again to insert
+    it with its batch); total_time only counts the time spent inside.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.bytes_read = OrderedDict()
+        self.active_time = 0
+        self._entered = None
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'timer', None)
+        _local.timer = self
+        self._entered = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.timer = self._previous
+        self._previous = None
+        self.active_time += time.time() - self._entered
+        self._entered = None
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.time()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.time() - t0
+
+    def add_bytes(self, name, nbytes):
+        self.bytes_read[name] = self.bytes_read.get(name, 0) + nbytes
+
+    def as_dict(self):
+        total = self.active_time
+        if self._entered is not None:
+            total += time.time() - self._entered
+        return {'stages': dict(self.stages), 'bytes_read': dict(self.bytes_read),
+                'total_time': total}
+
+    def report(self, path):
+        """
+        Send the timings to the metrics sinks.
+        """
+        perf = self.as_dict()
+        for sink in list(_sinks):
+            try:
+                sink(path, perf)
+            except:
+                logger.error('Metrics sink {} failed:\n{}'.format(sink, traceback.format_exc()))
+        return perf
+
+
+def current_timer():
+    return getattr(_local, 'timer', None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as stage name of the current thread's StageTimer, if any.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield None
+    else:
+        with timer.stage(name):
+            yield timer
+
+
+def add_bytes(name, nbytes):
+    timer = current_timer()
+    if timer is not None:
+        timer.add_bytes(name, nbytes)
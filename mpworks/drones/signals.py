@@ -1,9 +1,8 @@
-import glob
 import os
 import re
 from monty.io import zopen
-from monty.os.path import zpath
-from mpworks.workflows.wf_utils import last_relax
+from mpworks.drones.perf import add_bytes
+from mpworks.workflows.wf_utils import dir_snapshot, get_dir_snapshot
 
 __author__ = 'Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -14,6 +13,10 @@ __date__ = 'Apr 29, 2013'
 
 # TODO: This is all really ugly...
 
+SEARCH_MODES = ['forward', 'tail']
+TAIL_BYTES = 65536  # how much of the end of a plain file a 'tail' search reads first
+BLOCK_SIZE = 1048576  # read size for block scans of compressed files
+
 
 def string_list_in_file(s_list, filename, ignore_case=True):
     #based on Michael's code
@@ -26,49 +29,230 @@ def string_list_in_file(s_list, filename, ignore_case=True):
 
     Note: this is going to be slow as mud for huge files (e.g., OUTCAR)
     Using grep via subprocess might be better, but has dependency of
-    shell (i.e., non-windows)
+    shell (i.e., non-windows). To look for strings from several detectors at
+    once, use a SignalScanner, which reads each file only once.
 
     """
-    matches = set()
+    found = find_patterns_in_file(filename, [(s, ignore_case) for s in s_list])
+    return [s for s in s_list if (s, ignore_case) in found]
+
+
+def _compile_prefilter(patterns):
+    # a single regex that matches any line containing at least one of the
+    # patterns. It is only a cheap prefilter: candidate lines are then checked
+    # pattern by pattern, which also handles overlapping patterns.
+    flags = re.IGNORECASE if any([ic for s, ic in patterns]) else 0
+    return re.compile('|'.join([re.escape(s) for s, ic in patterns]), flags)
+
+
+def find_patterns_in_file(filename, patterns):
+    """
+    Read a file once, line by line, looking for several strings at a time.
+
+    :param filename: (str) path of the file, may be compressed
+    :param patterns: iterable of (target_string, ignore_case) tuples
+    :return: the set of (target_string, ignore_case) tuples that were found.
+        Reading stops as soon as every pattern has been found.
+    """
+    remaining = set(patterns)
+    found = set()
+    if not remaining:
+        return found
+
+    prefilter = _compile_prefilter(remaining)
+    nbytes = 0
     with zopen(filename, 'r') as f:
         for line in f:
-            for s in s_list:
-                if (ignore_case and s.lower() in line.lower()) or s in line:
-                    matches.add(s)
-                    if len(matches) == len(s_list):
-                        return s_list
+            nbytes += len(line)
+            if not prefilter.search(line):
+                continue
+            new = _search_text(line, remaining)
+            if not new:
+                continue
+            found.update(new)
+            remaining.difference_update(new)
+            if not remaining:
+                break
+            prefilter = _compile_prefilter(remaining)
+    add_bytes('signals', nbytes)
+    return found
+
+
+def _search_text(text, patterns):
+    l_text = text.lower()
+    return set([(s, ignore_case) for s, ignore_case in patterns
+                if (ignore_case and s.lower() in l_text) or s in text])
+
+
+def _find_patterns_in_blocks(filename, patterns, block_size):
+    # forward scan in large blocks rather than lines, stopping as soon as
+    # every pattern is found. Used for compressed files, which cannot be
+    # read from the end.
+    remaining = set(patterns)
+    found = set()
+    overlap = max([len(s) for s, ic in remaining]) - 1
+    tail = u''
+    nbytes = 0
+    with zopen(filename, 'rb') as f:
+        while remaining:
+            block = f.read(block_size)
+            if not block:
+                break
+            nbytes += len(block)
+            text = tail + block.decode('utf-8', 'ignore')
+            new = _search_text(text, remaining)
+            found.update(new)
+            remaining.difference_update(new)
+            tail = text[-overlap:] if overlap > 0 else u''
+    add_bytes('signals', nbytes)
+    return found
+
+
+def find_patterns_in_tail(filename, patterns, tail_bytes=TAIL_BYTES,
+                          block_size=BLOCK_SIZE):
+    """
+    Like find_patterns_in_file(), but for markers that are expected near the
+    end of the file (e.g. the timing summary at the end of an OUTCAR).
+
+    Plain files are searched in their last tail_bytes first, by seeking from
+    the end. Compressed files can't be seeked, so they are read in large
+    blocks and reading stops as soon as every marker has been found. Markers
+    that are not found in the tail are looked for with a regular forward
+    scan, so the result is always the same as find_patterns_in_file().
+    """
+    remaining = set(patterns)
+    if not remaining:
+        return set()
+
+    if os.path.splitext(filename)[1].lower() in ['.gz', '.bz2', '.z']:
+        return _find_patterns_in_blocks(filename, remaining, block_size)
+
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - tail_bytes))
+        found = _search_text(f.read().decode('utf-8', 'ignore'), remaining)
+    add_bytes('signals', min(size, tail_bytes))
+
+    remaining.difference_update(found)
+    if remaining and size > tail_bytes:
+        found.update(find_patterns_in_file(filename, remaining))
+    return found
+
+
+def _find_patterns(filename, patterns, search_mode):
+    if search_mode == 'tail':
+        return find_patterns_in_tail(filename, patterns)
+    return find_patterns_in_file(filename, patterns)
 
-    return list(matches)
 
 class SignalDetector(object):
     '''
     A SignalDetector is an abstract class that takes in a directory name and returns a set of Strings.
     Each String represents an error code that was detected during the run
+
+    Detectors that only look for strings in files should not read the files themselves; instead they
+    implement get_scan_patterns() and signals_from_matches(), so that a SignalScanner can serve all
+    detectors looking at the same file with a single read.
+
+    search_mode is either 'forward' (read from the start, stopping as soon as every requested
+    marker has been found) or 'tail' (look at the end of the file first, see find_patterns_in_tail).
     '''
 
+    search_mode = 'forward'
+
     def detect(self, dir_name):
         #returns a set() of signals (Strings)
+        file_patterns = self.get_scan_patterns(dir_name)
+        if file_patterns is None:
+            raise NotImplementedError
+        matches = dict([(f, _find_patterns(f, p, self.search_mode)) for f, p in file_patterns.items()])
+        return self.signals_from_matches(dir_name, matches)
+
+    def get_scan_patterns(self, dir_name):
+        """
+        Returns a dict of {filename: set of (target_string, ignore_case)} to look for, or None if
+        this detector doesn't work by searching files for strings
+        """
+        return None
+
+    def signals_from_matches(self, dir_name, matches):
+        """
+        :param matches: dict of {filename: set of (target_string, ignore_case) found in the file}
+            for every file returned by get_scan_patterns(). The sets may also contain patterns
+            requested by other detectors.
+        Returns a set() of signals
+        """
         raise NotImplementedError
 
 
+class SignalScanner(object):
+    '''
+    Runs many SignalDetectors, possibly on different directories, reading every file at most once.
+    The patterns from all detectors interested in a file are merged and searched for together.
+    A file is only searched tail-first if every detector interested in it uses the 'tail' mode.
+    '''
+
+    def __init__(self):
+        self.jobs = []
+
+    def add(self, detector, dir_name):
+        self.jobs.append((detector, dir_name))
+
+    def add_all(self, detectors, dir_name):
+        for detector in detectors:
+            self.add(detector, dir_name)
+
+    def scan(self):
+        # all detectors resolve their files from the same directory listings
+        with dir_snapshot():
+            return self._scan()
+
+    def _scan(self):
+        signals = set()
+        file_patterns = {}
+        file_modes = {}
+        pattern_jobs = []
+        for detector, dir_name in self.jobs:
+            d_patterns = detector.get_scan_patterns(dir_name)
+            if d_patterns is None:
+                # not a pattern-based detector, let it do its own thing
+                signals.update(detector.detect(dir_name))
+                continue
+            pattern_jobs.append((detector, dir_name, d_patterns))
+            for filename, patterns in d_patterns.items():
+                file_patterns.setdefault(filename, set()).update(patterns)
+                file_modes.setdefault(filename, set()).add(detector.search_mode)
+
+        matches = {}
+        for filename, patterns in file_patterns.items():
+            search_mode = 'tail' if file_modes[filename] == set(['tail']) else 'forward'
+            matches[filename] = _find_patterns(filename, patterns, search_mode)
+
+        for detector, dir_name, d_patterns in pattern_jobs:
+            d_matches = dict([(f, matches[f]) for f in d_patterns])
+            signals.update(detector.signals_from_matches(dir_name, d_matches))
+
+        return signals
+
+
 class SignalDetectorList(list):
     '''
     Takes in a list of SignalDetectors() and provides a convenience method, detect_all(), that can merge the results of all the SignalDetectors()
     Very basic...
     '''
     def detect_all(self, dir_name):
-        signals = set()
-        for detector in self:
-            for signal in detector.detect(dir_name):
-                signals.add(signal)
-        return signals
+        scanner = SignalScanner()
+        scanner.add_all(self, dir_name)
+        return scanner.scan()
 
 class SignalDetectorSimple(SignalDetector):
     '''
     A convenience class for defining a Signal Detector where you just want to search for the presence (or absence) of a String in a file or list of files
     Makes it easy to detect errors, for example, that are directly printed to output files
     '''
-    def __init__(self, signames_targetstrings, filename_list, invert_search=False, ignore_case=True, ignore_nonexistent_file=True):
+    def __init__(self, signames_targetstrings, filename_list, invert_search=False, ignore_case=True, ignore_nonexistent_file=True,
+                 search_mode='forward'):
         '''
 
         :param signames_targetstrings: A dictionary of signal names (e.g. "ERR_1") to the target String searched for in the file ("SEVERE ERROR in calculation!")
@@ -76,7 +260,11 @@ class SignalDetectorSimple(SignalDetector):
         :param invert_search: Inverts search, e.g. error is True (signal is returned) when the target String is *NOT* present
         :param ignore_case: ignore case in target String
         :param ignore_nonexistent_file: if a file in filename_list doesn't exist, move on without returning any errors
+        :param search_mode: 'forward' to scan from the start of the file, stopping early once every target String is
+            found, or 'tail' when the target Strings are expected at the end of the file
         '''
+        if search_mode not in SEARCH_MODES:
+            raise ValueError('Unknown search_mode {}, must be one of {}'.format(search_mode, SEARCH_MODES))
         self.signames_targetstrings = signames_targetstrings
         #generate the reverse dictionary
         self.targetstrings_signames = dict([[v, k] for k, v in self.signames_targetstrings.items()])
@@ -85,26 +273,57 @@ class SignalDetectorSimple(SignalDetector):
         self.ignore_case = ignore_case
         self.ignore_nonexistent_file = ignore_nonexistent_file
         self.invert_search = invert_search
+        self.search_mode = search_mode
 
-    def detect(self, dir_name):
+    def get_scan_patterns(self, dir_name):
+        patterns = set([(s, self.ignore_case) for s in self.signames_targetstrings.values()])
+        file_patterns = {}
+        snapshot = get_dir_snapshot()
+        for filename in self.filename_list:
+            if not self.ignore_nonexistent_file or snapshot.exists(snapshot.zpath(os.path.join(dir_name, filename))):
+                file_patterns[snapshot.last_relax(os.path.join(dir_name, filename))] = patterns
+        return file_patterns
+
+    def signals_from_matches(self, dir_name, matches):
 
         signals = set()
 
-        for filename in self.filename_list:
+        for f, found in matches.items():
             #find the strings that match in the file
-            if not self.ignore_nonexistent_file or os.path.exists(zpath(os.path.join(dir_name, filename))):
-                f = last_relax(os.path.join(dir_name, filename))
-                errors = string_list_in_file(self.signames_targetstrings.values(), f, ignore_case=self.ignore_case)
-                if self.invert_search:
-                    errors_inverted = [item for item in self.targetstrings_signames.keys() if item not in errors]
-                    errors = errors_inverted
-
-                #add the signal names for those strings
-                for e in errors:
-                    signals.add(self.targetstrings_signames[e])
+            errors = [s for s in self.targetstrings_signames if (s, self.ignore_case) in found]
+            if self.invert_search:
+                errors_inverted = [item for item in self.targetstrings_signames.keys() if item not in errors]
+                errors = errors_inverted
+
+            #add the signal names for those strings
+            for e in errors:
+                signals.add(self.targetstrings_signames[e])
         return signals
 
 
+class SignalDetectorGlob(SignalDetector):
+    '''
+    Returns a single signal if any file matching a glob pattern (e.g. "*.error") in the directory
+    contains any of the target Strings
+    '''
+    def __init__(self, signal_name, target_strings, file_pattern="*.error", ignore_case=True):
+        self.signal_name = signal_name
+        self.target_strings = target_strings
+        self.file_pattern = file_pattern
+        self.ignore_case = ignore_case
+
+    def get_scan_patterns(self, dir_name):
+        patterns = set([(s, self.ignore_case) for s in self.target_strings])
+        return dict([(f, patterns) for f in get_dir_snapshot().glob(os.path.join(dir_name, self.file_pattern))])
+
+    def signals_from_matches(self, dir_name, matches):
+        for found in matches.values():
+            for s in self.target_strings:
+                if (s, self.ignore_case) in found:
+                    return set([self.signal_name])
+        return set()
+
+
 class VASPOutSignal(SignalDetectorSimple):
 
     def __init__(self):
@@ -136,85 +355,68 @@ class VASPOutSignal(SignalDetectorSimple):
         super(VASPOutSignal, self).__init__(err_code, ["vasp.out"])
 
 
-class HitAMemberSignal(SignalDetector):
-    def detect(self, dir_name):
+class HitAMemberSignal(SignalDetectorGlob):
+    def __init__(self):
         # Look for 'hit a member that was already found in another star'
         # in *.error
-        file_names = glob.glob("%s/*.error" % dir_name)
-        for file_name in file_names:
-            if string_list_in_file(["hit a member that was already found in another star"],
-                                          file_name, ignore_case=True):
-                return set(["HIT_A_MEMBER_FAIL"])
-        return set()
+        super(HitAMemberSignal, self).__init__(
+            "HIT_A_MEMBER_FAIL", ["hit a member that was already found in another star"])
 
 
-class WallTimeSignal(SignalDetector):
+class WallTimeSignal(SignalDetectorGlob):
 
-    def detect(self, dir_name):
+    def __init__(self):
         # Look for *.error
-        file_names = glob.glob(os.path.join(dir_name, "*.error"))
-        for file_name in file_names:
-            if string_list_in_file(["job killed: walltime", "PBS: job killed"], file_name,
-                                          ignore_case=True):
-                return set(["WALLTIME_EXCEEDED"])
-        return set()
+        super(WallTimeSignal, self).__init__(
+            "WALLTIME_EXCEEDED", ["job killed: walltime", "PBS: job killed"])
 
 
-class DiskSpaceExceededSignal(SignalDetector):
+class DiskSpaceExceededSignal(SignalDetectorGlob):
 
-    def detect(self, dir_name):
+    def __init__(self):
         # Look for *.error
-        file_names = glob.glob(os.path.join(dir_name, "*.error"))
-        for file_name in file_names:
-            if string_list_in_file(["No space left"], file_name,
-                                          ignore_case=True):
-                return set(["DISK_SPACE_EXCEEDED"])
-        return set()
+        super(DiskSpaceExceededSignal, self).__init__(
+            "DISK_SPACE_EXCEEDED", ["No space left"])
 
 
-class SegFaultSignal(SignalDetector):
+class SegFaultSignal(SignalDetectorGlob):
 
-    def detect(self, dir_name):
+    def __init__(self):
         """
-        Looks through all *.error files for (fault|segmentation)
+        Looks through all *.error files for segmentation faults
 
         Error in UKY looks like this:
             'forrtl: severe (174): SIGSEGV, segmentation fault occurred'
         """
-        file_names = glob.glob("%s/*.error" % dir_name)
-        rx = re.compile(r'segmentation', re.IGNORECASE)
-        for file_name in file_names:
-            with zopen(file_name, 'r') as f:
-                lines = f.readlines()
-                for line in lines:
-                    if rx.search(line) is not None:
-                        return set(["SEGFAULT"])
-        return set()
+        super(SegFaultSignal, self).__init__("SEGFAULT", ["segmentation"])
 
 
 class VASPInputsExistSignal(SignalDetector):
 
     def detect(self, dir_name):
-        names = [last_relax(os.path.join(dir_name, x)) for x in ['POSCAR', 'INCAR', 'KPOINTS', 'POTCAR']]
-        return set() if all([os.path.exists(file_name) for file_name in names]) and all([os.stat(file_name).st_size > 0 for file_name in names]) else set(["INPUTS_DONT_EXIST"])
+        snapshot = get_dir_snapshot()
+        names = [snapshot.last_relax(os.path.join(dir_name, x)) for x in ['POSCAR', 'INCAR', 'KPOINTS', 'POTCAR']]
+        return set() if all([snapshot.exists(file_name) for file_name in names]) and all([snapshot.getsize(file_name) > 0 for file_name in names]) else set(["INPUTS_DONT_EXIST"])
 
 
 class VASPOutputsExistSignal(SignalDetector):
 
     def detect(self, dir_name):
-
-        names = [last_relax(os.path.join(dir_name, x)) for x in ['OUTCAR', 'OSZICAR', 'vasprun.xml', 'vasp.out']]
-        return set() if all([os.path.exists(file_name) for file_name in names]) and os.stat(names[0]).st_size > 0 else set(["OUTPUTS_DONT_EXIST"])
+        snapshot = get_dir_snapshot()
+        names = [snapshot.last_relax(os.path.join(dir_name, x)) for x in ['OUTCAR', 'OSZICAR', 'vasprun.xml', 'vasp.out']]
+        return set() if all([snapshot.exists(file_name) for file_name in names]) and snapshot.getsize(names[0]) > 0 else set(["OUTPUTS_DONT_EXIST"])
 
 
 class VASPStartedCompletedSignal(SignalDetectorSimple):
 
     def __init__(self):
-        super(VASPStartedCompletedSignal, self).__init__({"VASP_HASNT_STARTED": "vasp", "VASP_HASNT_COMPLETED": "Voluntary context switches:"}, ["OUTCAR"], invert_search=True)
+        # "Voluntary context switches:" is only ever printed in the last few KB of the OUTCAR
+        super(VASPStartedCompletedSignal, self).__init__({"VASP_HASNT_STARTED": "vasp", "VASP_HASNT_COMPLETED": "Voluntary context switches:"}, ["OUTCAR"], invert_search=True,
+                                                         search_mode='tail')
 
 
 class Relax2ExistsSignal(SignalDetector):
 
     def detect(self, dir_name):
-        f_exists = 'relax2' in last_relax(os.path.join(dir_name, 'vasprun.xml'))
+        f_exists = 'relax2' in get_dir_snapshot().last_relax(os.path.join(dir_name, 'vasprun.xml'))
         return set() if f_exists else set(["NO_RELAX2"])
\ No newline at end of file
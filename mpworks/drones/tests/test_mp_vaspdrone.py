@@ -0,0 +1,132 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from matgendb import creator as matgendb_creator
+from pymongo.errors import BulkWriteError
+from mpworks.drones.mp_vaspdrone import MPVaspDrone
+from mpworks.drones.output_cache import get_vasprun
+from pymatgen.io.vasp.outputs import Vasprun
+
+
+class _Collection(object):
+    def __init__(self, bad_indices=()):
+        self.bad_indices = bad_indices  # bulk_write() requests that fail
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def find(self, *args, **kwargs):
+        return []
+
+    def update_one(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        if self.bad_indices:
+            raise BulkWriteError({'writeErrors': [{'index': i, 'code': 11000,
+                                                   'errmsg': 'E11000 duplicate key error'}
+                                                  for i in self.bad_indices]})
+
+
+class _Database(object):
+    def __init__(self, coll):
+        self.coll = coll
+
+    def __getitem__(self, name):
+        return self.coll
+
+
+class _IdAllocator(object):
+    def next_id(self):
+        return 1
+
+    def next_ids(self, n):
+        return range(1, n + 1)
+
+
+class DroneTestCase(TestCase):
+    """
+    A drone on band structure runs, with a fake database and post-processing
+    """
+
+    def setUp(self):
+        self.run_dirs = []
+        for i in range(3):
+            run_dir = tempfile.mkdtemp()
+            with open(os.path.join(run_dir, 'FW.json'), 'w') as f:
+                json.dump({'fw_id': i, 'spec': {'task_type': 'GGA band structure'}}, f)
+            with open(os.path.join(run_dir, 'vasprun.xml'), 'w') as f:
+                f.write('<modeling/>')
+            self.run_dirs.append(run_dir)
+
+        self.parses = []
+
+        def count_init(vasprun, filename, **kwargs):
+            self.parses.append((os.path.dirname(filename),
+                                bool(kwargs.get('parse_projected_eigen'))))
+
+        def get_task_doc(drone, path):
+            matgendb_creator.Vasprun(os.path.join(path, 'vasprun.xml'))
+            return {'dir_name': 'localhost:' + path, 'state': 'successful'}
+
+        def post_process(drone, path, d, db, launches_coll):
+            get_vasprun(os.path.join(path, 'vasprun.xml'), parse_projected_eigen=True)
+
+        self.patched = [(Vasprun, '__init__', count_init),
+                        (MPVaspDrone, 'get_task_doc', get_task_doc),
+                        (MPVaspDrone, '_post_process', post_process),
+                        (MPVaspDrone, '_get_db', lambda drone: _Database(self.coll)),
+                        (MPVaspDrone, '_get_task_id_allocator',
+                         staticmethod(lambda db: _IdAllocator()))]
+        self.saved = []
+        for cls, name, value in self.patched:
+            self.saved.append((cls, name, cls.__dict__.get(name)))
+            setattr(cls, name, value)
+        self.coll = _Collection()
+        self.drone = MPVaspDrone(parse_dos=False, simulate_mode=False,
+                                 update_duplicates=False)
+
+    def tearDown(self):
+        for cls, name, value in reversed(self.saved):
+            if value is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, value)
+        for run_dir in self.run_dirs:
+            shutil.rmtree(run_dir)
+
+
+class TestVasprunParses(DroneTestCase):
+    """
+    Counts the Vasprun constructions per directory: the pymatgen-db drone
+    parses vasprun.xml, and _post_process() parses it again with the
+    projections.
+    """
+
+    def _parses_of(self, run_dir):
+        return sorted([projected for d, projected in self.parses if d == run_dir])
+
+    def test_assimilate(self):
+        # one parse with the projections, shared by both
+        for run_dir in self.run_dirs:
+            self.drone.assimilate(run_dir)
+            self.assertEqual(self._parses_of(run_dir), [True])
+
+    def test_assimilate_many(self):
+        # the batch is post-processed after the parse scopes are gone: one
+        # plain parse and one with the projections, never two with them
+        results = list(self.drone.assimilate_many(self.run_dirs, batch_size=2))
+        self.assertEqual([r[0] for r in results], self.run_dirs)
+        for run_dir in self.run_dirs:
+            self.assertEqual(self._parses_of(run_dir), [False, True])
+
+
+class TestInsertBatch(DroneTestCase):
+    def test_failed_upsert(self):
+        # the other directories of the batch are still written and returned
+        self.coll.bad_indices = [1]
+        results = list(self.drone.assimilate_many(self.run_dirs, batch_size=3))
+        self.assertEqual([r[0] for r in results], [self.run_dirs[0], self.run_dirs[2]])
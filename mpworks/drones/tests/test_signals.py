@@ -0,0 +1,77 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from mpworks.drones.signals import SignalDetectorList, SignalScanner, \
+    VASPOutSignal, VASPStartedCompletedSignal, SegFaultSignal, \
+    WallTimeSignal, DiskSpaceExceededSignal, string_list_in_file, \
+    find_patterns_in_file, find_patterns_in_tail
+
+
+class TestSignalScanner(TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self._write("vasp.out", "running on 2 nodes\n BRMIX: very serious problems\n")
+        self._write("OUTCAR", " vasp.5.3.3 18Dez12\n ...\n Voluntary context switches: 12\n")
+        self._write("job.error", "forrtl: severe (174): SIGSEGV, Segmentation fault occurred\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def _write(self, filename, text):
+        with open(os.path.join(self.run_dir, filename), "w") as f:
+            f.write(text)
+
+    def test_detect_all(self):
+        sl = SignalDetectorList([VASPOutSignal(), VASPStartedCompletedSignal(),
+                                 SegFaultSignal(), WallTimeSignal()])
+        self.assertEqual(sl.detect_all(self.run_dir),
+                         set(["BROYDENMIX_FAIL", "SEGFAULT"]))
+
+    def test_same_as_individual_detectors(self):
+        detectors = [VASPOutSignal(), VASPStartedCompletedSignal(),
+                     SegFaultSignal(), DiskSpaceExceededSignal()]
+        scanner = SignalScanner()
+        scanner.add_all(detectors, self.run_dir)
+        individual = set()
+        for d in detectors:
+            individual.update(d.detect(self.run_dir))
+        self.assertEqual(scanner.scan(), individual)
+
+    def test_inverted_search(self):
+        self._write("OUTCAR", " vasp.5.3.3 18Dez12\n")
+        self.assertEqual(VASPStartedCompletedSignal().detect(self.run_dir),
+                         set(["VASP_HASNT_COMPLETED"]))
+
+    def test_string_list_in_file(self):
+        f = os.path.join(self.run_dir, "OUTCAR")
+        self.assertEqual(string_list_in_file(["VASP", "missing"], f), ["VASP"])
+        self.assertEqual(string_list_in_file(["VASP"], f, ignore_case=False), [])
+
+
+class TestTailSearch(TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        self.text = " vasp.5.3.3 18Dez12\n" + " loop\n" * 50000 + \
+            " Voluntary context switches: 12\n"
+        self.patterns = set([("vasp", True), ("Voluntary context switches:", True),
+                             ("missing", True)])
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_plain_file(self):
+        f = os.path.join(self.run_dir, "OUTCAR")
+        with open(f, "w") as out:
+            out.write(self.text)
+        self.assertEqual(find_patterns_in_tail(f, self.patterns, tail_bytes=1024),
+                         find_patterns_in_file(f, self.patterns))
+
+    def test_gzip_file(self):
+        f = os.path.join(self.run_dir, "OUTCAR.gz")
+        with gzip.open(f, "wb") as out:
+            out.write(self.text.encode("utf-8"))
+        self.assertEqual(find_patterns_in_tail(f, self.patterns, block_size=4096),
+                         set([("vasp", True), ("Voluntary context switches:", True)]))
@@ -6,13 +6,14 @@ import time
 from fireworks import FireTaskBase
 import json
 import os
-from pymongo import MongoClient
 from fireworks.core.firework import FWAction
 from fireworks.utilities.fw_serializers import FWSerializable
 from fireworks.utilities.fw_utilities import get_slug
 from monty.json import jsanitize
+from mpworks.db_utils.connection import get_database
+from mpworks.db_utils.gridfs_arrays import read_doc
 from mpworks.snl_utils.mpsnl import get_meta_from_structure
-from mpworks.workflows.wf_utils import get_block_part
+from mpworks.workflows.wf_utils import get_block_part, get_dir_snapshot
 import numpy as np
 from pymatgen import Composition
 from pymatgen.electronic_structure.bandstructure import BandStructure
@@ -124,8 +125,9 @@ class BoltztrapRunTask(FireTaskBase, FWSerializable):
         # get the band structure and nelect from files
         """
         prev_dir = get_loc(fw_spec['prev_vasp_dir'])
-        vasprun_loc = zpath(os.path.join(prev_dir, 'vasprun.xml'))
-        kpoints_loc = zpath(os.path.join(prev_dir, 'KPOINTS'))
+        snapshot = get_dir_snapshot()
+        vasprun_loc = snapshot.zpath(os.path.join(prev_dir, 'vasprun.xml'))
+        kpoints_loc = snapshot.zpath(os.path.join(prev_dir, 'KPOINTS'))
 
         vr = Vasprun(vasprun_loc)
         bs = vr.get_band_structure(kpoints_filename=kpoints_loc)
@@ -144,9 +146,8 @@ class BoltztrapRunTask(FireTaskBase, FWSerializable):
         db_path = os.path.join(db_dir, 'tasks_db.json')
         with open(db_path) as f:
             creds = json.load(f)
-            connection = MongoClient(creds['host'], creds['port'])
-            tdb = connection[creds['database']]
-            tdb.authenticate(creds['admin_user'], creds['admin_password'])
+            tdb = get_database(creds['host'], creds['port'], creds['database'],
+                               creds['admin_user'], creds['admin_password'])
 
             props = {"calculations": 1, "task_id": 1, "state": 1, "pseudo_potential": 1, "run_type": 1, "is_hubbard": 1, "hubbards": 1, "unit_cell_formula": 1}
             m_task = tdb.tasks.find_one({"dir_name": block_part}, props)
@@ -164,7 +165,7 @@ class BoltztrapRunTask(FireTaskBase, FWSerializable):
             bs_id = m_task['calculations'][0]['band_structure_fs_id']
             print bs_id, type(bs_id)
             fs = gridfs.GridFS(tdb, 'band_structure_fs')
-            bs_dict = json.loads(fs.get(bs_id).read())
+            bs_dict = read_doc(fs, bs_id, projections=False)
             bs_dict['structure'] = m_task['calculations'][0]['output']['crystal']
             bs = BandStructure.from_dict(bs_dict)
             print 'Band Structure found:', bool(bs)
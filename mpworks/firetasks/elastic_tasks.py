@@ -1,4 +1,3 @@
-from monty.os.path import zpath
 import os
 import json
 from pymongo import MongoClient
@@ -26,6 +25,7 @@ from mpworks.firetasks.snl_tasks import AddSNLTask
 from mpworks.snl_utils.mpsnl import MPStructureNL
 from pymatgen.core.structure import Structure
 from mpworks.workflows.wf_settings import QA_VASP, QA_DB, QA_VASP_SMALL
+from mpworks.workflows.wf_utils import get_dir_snapshot
 from pymatgen.io.vasp.inputs import Poscar, Kpoints
 
 def update_spec_force_convergence(spec, user_vasp_settings=None):
@@ -63,7 +63,7 @@ class SetupElastConstTask(FireTaskBase, FWSerializable):
     _fw_name = "Setup Elastic Constant Task"
 
     def run_task(self, fw_spec):
-        incar = Incar.from_file(zpath("INCAR"))
+        incar = Incar.from_file(get_dir_snapshot().zpath("INCAR"))
         incar.update({"ISIF": 2})
         incar.write_file("INCAR")
         return FWAction()
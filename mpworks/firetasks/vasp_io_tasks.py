@@ -9,19 +9,22 @@ import logging
 import os
 import shutil
 import sys
-from monty.os.path import zpath
+from custodian.vasp import handlers as custodian_handlers
 from custodian.vasp.handlers import UnconvergedErrorHandler
 from fireworks.core.launchpad import LaunchPad
 
 from fireworks.utilities.fw_serializers import FWSerializable
 from fireworks.core.firework import FireTaskBase, FWAction, Firework, Workflow
 from fireworks.utilities.fw_utilities import get_slug
+from mpworks.db_utils.connection import get_shared
 from mpworks.drones.mp_vaspdrone import MPVaspDrone
+from mpworks.drones.output_cache import cached_parsers, output_cache_scope
 from mpworks.dupefinders.dupefinder_vasp import DupeFinderVasp
 from mpworks.firetasks.custodian_task import get_custodian_task
 from mpworks.firetasks.vasp_setup_tasks import SetupUnconvergedHandlerTask
 from mpworks.workflows.wf_settings import QA_VASP, QA_DB, MOVE_TO_GARDEN_PROD, MOVE_TO_GARDEN_DEV
-from mpworks.workflows.wf_utils import last_relax, get_loc, move_to_garden
+from mpworks.workflows.wf_utils import last_relax, get_loc, move_to_garden, \
+    DirSnapshot
 from pymatgen import Composition
 from pymatgen.io.vasp.inputs import Incar, Poscar, Potcar, Kpoints
 from pymatgen.matproj.snl import StructureNL
@@ -79,18 +82,21 @@ class VaspCopyTask(FireTaskBase, FWSerializable):
 
     def run_task(self, fw_spec):
         prev_dir = get_loc(fw_spec['prev_vasp_dir'])
+        # prev_dir is only read from, so one listing of it (and of relax1/
+        # relax2) answers all the lookups below
+        snapshot = DirSnapshot()
 
         if '$ALL' in self.files:
-            self.files = os.listdir(prev_dir)
+            self.files = snapshot.listdir(prev_dir)
 
         for file in self.files:
-            prev_filename = last_relax(os.path.join(prev_dir, file))
+            prev_filename = snapshot.last_relax(os.path.join(prev_dir, file))
             dest_file = 'POSCAR' if file == 'CONTCAR' and self.use_contcar else file
             if prev_filename.endswith('.gz'):
                 dest_file += '.gz'
 
             print 'COPYING', prev_filename, dest_file
-            if self.missing_CHGCAR_OK and 'CHGCAR' in dest_file and not os.path.exists(zpath(prev_filename)):
+            if self.missing_CHGCAR_OK and 'CHGCAR' in dest_file and not snapshot.exists(snapshot.zpath(prev_filename)):
                 print 'Skipping missing CHGCAR'
             else:
                 shutil.copy2(prev_filename, dest_file)
@@ -126,6 +132,11 @@ class VaspToDBTask(FireTaskBase, FWSerializable):
         self.update_duplicates = self.get('update_duplicates', False)  # off so DOS/BS doesn't get entered twice
 
     def run_task(self, fw_spec):
+        # the unconverged check reuses the drone's parse of vasprun.xml
+        with output_cache_scope():
+            return self._run_task(fw_spec)
+
+    def _run_task(self, fw_spec):
         if '_fizzled_parents' in fw_spec and not 'prev_vasp_dir' in fw_spec:
             prev_dir = get_loc(fw_spec['_fizzled_parents'][0]['launches'][0]['launch_dir'])
             update_spec = {}  # add this later when creating new FW
@@ -167,7 +178,10 @@ class VaspToDBTask(FireTaskBase, FWSerializable):
                                 collection=db_creds['collection'], parse_dos=parse_dos,
                                 additional_fields=self.additional_fields,
                                 update_duplicates=self.update_duplicates)
-            t_id, d = drone.assimilate(prev_dir, launches_coll=LaunchPad.auto_load().launches)
+            # the LaunchPad (and its MongoClient) is shared by every DB
+            # insertion run in this process
+            lp = get_shared('launchpad', LaunchPad.auto_load)
+            t_id, d = drone.assimilate(prev_dir, launches_coll=lp.launches)
 
         mpsnl = d['snl_final'] if 'snl_final' in d else d['snl']
         snlgroup_id = d['snlgroup_id_final'] if 'snlgroup_id_final' in d else d['snlgroup_id']
@@ -188,8 +202,11 @@ class VaspToDBTask(FireTaskBase, FWSerializable):
             unconverged_tag = 'unconverged_handler--{}'.format(fw_spec['prev_task_type'])
             output_dir = last_relax(os.path.join(prev_dir, 'vasprun.xml'))
             ueh = UnconvergedErrorHandler(output_filename=output_dir)
+            # the drone has usually just parsed this vasprun.xml, reuse it
+            with cached_parsers(custodian_handlers):
+                unconverged = ueh.check()
             # TODO: make this a little more flexible
-            if ueh.check() and unconverged_tag not in fw_spec['run_tags']:
+            if unconverged and unconverged_tag not in fw_spec['run_tags']:
                 print 'Unconverged run! Creating dynamic FW...'
 
                 spec = {'prev_vasp_dir': prev_dir,
@@ -1,5 +1,4 @@
 import os
-from monty.os.path import zpath
 from custodian.vasp.handlers import UnconvergedErrorHandler
 from fireworks.utilities.fw_serializers import FWSerializable
 from fireworks.core.firework import FireTaskBase, FWAction
@@ -8,6 +7,7 @@ from pymatgen.io.vasp.inputs import VaspInput, Incar, Poscar, Kpoints, Potcar
 from pymatgen.io.vasp.sets import MPRelaxSet, MPStaticSet, MPNonSCFSet
 from pymatgen.symmetry.bandstructure import HighSymmKpath
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from mpworks.workflows.wf_utils import DirSnapshot
 
 __author__ = 'Wei Chen, Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -120,8 +120,9 @@ class SetupGGAUTask(FireTaskBase, FWSerializable):
         chgcar_start = False
         # read the VaspInput from the previous run
 
-        poscar = Poscar.from_file(zpath('POSCAR'))
-        incar = Incar.from_file(zpath('INCAR'))
+        snapshot = DirSnapshot()
+        poscar = Poscar.from_file(snapshot.zpath('POSCAR'))
+        incar = Incar.from_file(snapshot.zpath('INCAR'))
 
         # figure out what GGA+U values to use and override them
         # LDAU values to use
@@ -138,7 +139,7 @@ class SetupGGAUTask(FireTaskBase, FWSerializable):
 
 
         # start from the CHGCAR of previous run
-        if os.path.exists('CHGCAR'):
+        if snapshot.exists('CHGCAR'):
             incar['ICHARG'] = 1
             chgcar_start = True
 
@@ -0,0 +1,36 @@
+from pymongo import UpdateOne
+from fireworks.core.launchpad import LaunchPad
+from mpworks.db_utils.launches import BLOCK_PART_FIELD, ensure_launch_indices
+from mpworks.workflows.wf_utils import get_block_part
+
+'''
+Store the block part of launch_dir on every launch that doesn't have it yet,
+and build the (fw_id, block_part) index used by
+mpworks.db_utils.launches.find_launch_by_block_part.
+'''
+
+BATCH_SIZE = 1000
+
+
+def add_block_parts(launches_coll):
+    ensure_launch_indices(launches_coll)
+    requests = []
+    n = 0
+    for l in launches_coll.find({BLOCK_PART_FIELD: {'$exists': False},
+                                 'launch_dir': {'$ne': None}},
+                                {'launch_dir': 1}):
+        requests.append(UpdateOne({'_id': l['_id']},
+                                  {'$set': {BLOCK_PART_FIELD: get_block_part(l['launch_dir'])}}))
+        if len(requests) >= BATCH_SIZE:
+            launches_coll.bulk_write(requests, ordered=False)
+            n += len(requests)
+            requests = []
+            print 'UPDATED', n
+    if requests:
+        launches_coll.bulk_write(requests, ordered=False)
+        n += len(requests)
+    print 'DONE, updated {} launches'.format(n)
+
+
+if __name__ == '__main__':
+    add_block_parts(LaunchPad.auto_load().launches)
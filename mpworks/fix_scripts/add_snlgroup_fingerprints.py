@@ -0,0 +1,45 @@
+import os
+from pymongo import UpdateOne
+from mpworks.snl_utils.mpsnl import LazySNLGroup, has_reduced_primitive
+from mpworks.snl_utils.snl_mongo import SNLMongoAdapter, SNL_STRUCTURE_FIELDS, get_projection
+
+'''
+Store the canonical_fingerprint (see mpworks.snl_utils.mpsnl.get_structure_fingerprint)
+and the reduced primitive cell of the canonical SNL on every SNL group that
+doesn't have them yet. Groups without them are reduced again whenever they
+are loaded for grouping, so this only makes add_snl() faster. Large C-Ce
+groups, which are never fit, are left alone.
+'''
+
+BATCH_SIZE = 1000
+
+
+def add_fingerprints(snlgroups):
+    requests = []
+    n = 0
+    fields = ['snlgroup_id'] + ['canonical_snl.' + f for f in SNL_STRUCTURE_FIELDS]
+    for g in snlgroups.find({'$or': [{'canonical_fingerprint': {'$exists': False}},
+                                     {'canonical_snl.reduced_primitive': {'$exists': False}}]},
+                            get_projection(fields), no_cursor_timeout=True):
+        canonical_snl = LazySNLGroup(g).canonical_snl
+        if not has_reduced_primitive(canonical_snl.structure):
+            continue
+        requests.append(UpdateOne({'_id': g['_id']},
+                                  {'$set': {'canonical_fingerprint': canonical_snl.fingerprint,
+                                            'canonical_snl.reduced_primitive':
+                                                canonical_snl.reduced_primitive.as_dict()}}))
+        if len(requests) >= BATCH_SIZE:
+            snlgroups.bulk_write(requests, ordered=False)
+            n += len(requests)
+            requests = []
+            print 'UPDATED', n
+    if requests:
+        snlgroups.bulk_write(requests, ordered=False)
+        n += len(requests)
+    print 'DONE, updated {} SNL groups'.format(n)
+
+
+if __name__ == '__main__':
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    snl_f = os.path.join(module_dir, 'snl.yaml')
+    add_fingerprints(SNLMongoAdapter.from_file(snl_f).snlgroups)
@@ -33,13 +33,17 @@ if __name__ == '__main__':
     # query = {"icsd_id": {"$gte": 170623}}
     query = {}
 
-    for icsd_dict in db.icsd_2012_crystals.find(query, sort=[("icsd_id", ASCENDING)], timeout=False):
-        try:
-            snl = icsd_dict_to_snl(icsd_dict)
-            if snl:
-                snldb.add_snl(snl)
-        except:
-            traceback.print_exc()
-            print 'ERROR - icsd id:', icsd_dict['icsd_id']
+    def icsd_snls():
+        for icsd_dict in db.icsd_2012_crystals.find(query, sort=[("icsd_id", ASCENDING)], timeout=False):
+            try:
+                snl = icsd_dict_to_snl(icsd_dict)
+                if snl:
+                    yield snl
+            except:
+                traceback.print_exc()
+                print 'ERROR - icsd id:', icsd_dict['icsd_id']
+
+    # the import is sorted by icsd_id, so re-running it resumes where it stopped
+    snldb.add_snls(icsd_snls(), import_name='icsd_2012_crystals')
 
     print 'DONE'
@@ -2,7 +2,7 @@ import os
 import traceback
 import time
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 import yaml
 
 from mpworks.fix_scripts.legacy.mps_to_snl import mps_dict_to_snl
@@ -17,6 +17,7 @@ __date__ = 'May 08, 2013'
 
 
 RESET = False
+IMPORT_NAME = 'mps_to_snl'
 
 if __name__ == '__main__':
 
@@ -34,7 +35,7 @@ if __name__ == '__main__':
 
     snldb = SNLMongoAdapter.from_file(snl_f)
 
-    prev_ids = []  # MPS ids that we already took care of
+    prev_ids = set()  # MPS ids that we already took care of
 
     print 'INITIALIZING'
     if RESET:
@@ -42,20 +43,29 @@ if __name__ == '__main__':
         time.sleep(10)  # makes me sleep better at night
 
     else:
-        for mps in snldb.snl.find({}, {"about._materialsproject.deprecated.mps_ids": 1}):
-            prev_ids.extend(mps['about']['_materialsproject']['deprecated']['mps_ids'])
-
-    print 'PROCESSING'
-    for mps in db.mps.find(timeout=False):
-        try:
-            if not mps['mps_id'] in prev_ids:
+        # SNLs added by an earlier add_snls() run are handled by its resume,
+        # skipping them here would shift the chunks it resumes by
+        for mps in snldb.snl.find({"about._materialsproject.deprecated.mps_ids": {"$exists": True},
+                                   "_import.name": {"$ne": IMPORT_NAME}},
+                                  {"about._materialsproject.deprecated.mps_ids": 1}):
+            prev_ids.update(mps['about']['_materialsproject']['deprecated']['mps_ids'])
+
+    def mps_snls():
+        for mps in db.mps.find(sort=[("mps_id", ASCENDING)], timeout=False):
+            if mps['mps_id'] in prev_ids:
+                print 'SKIPPING', mps['mps_id']
+                continue
+            try:
                 snl = mps_dict_to_snl(mps)
                 if snl:
-                    snldb.add_snl(snl)
-            else:
-                print 'SKIPPING', mps['mps_id']
-        except:
-            traceback.print_exc()
-            print 'ERROR - mps id:', mps['mps_id']
+                    yield snl
+            except:
+                traceback.print_exc()
+                print 'ERROR - mps id:', mps['mps_id']
+
+    print 'PROCESSING'
+    # progress is recorded per chunk of the (sorted) input, so re-running
+    # this script resumes an interrupted import
+    snldb.add_snls(mps_snls(), import_name=IMPORT_NAME)
 
     print 'DONE'
@@ -0,0 +1,41 @@
+import os
+from pymongo import UpdateOne
+from mpworks.snl_utils.mpsnl import LazyMPStructureNL, SpeciesSNLRef
+from mpworks.snl_utils.snl_mongo import SNLMongoAdapter, SNL_STRUCTURE_FIELDS, get_projection
+
+'''
+Replace the species_snl copies embedded in SNL groups with species_refs
+(see mpworks.snl_utils.mpsnl.SpeciesSNLRef). Set SPECIES_SNL_BY_REFERENCE
+in mpworks.snl_utils.mpsnl to store new groups the same way.
+
+The group version is bumped, so that a concurrent add_snl() that loaded the
+group before the migration reloads it instead of pushing to species_snl.
+'''
+
+BATCH_SIZE = 1000
+
+
+def species_snl_to_refs(snlgroups):
+    requests = []
+    n = 0
+    fields = ['version'] + ['species_snl.' + f for f in SNL_STRUCTURE_FIELDS]
+    for g in snlgroups.find({'species_snl': {'$exists': True}, 'species_refs': {'$exists': False}},
+                            get_projection(fields), no_cursor_timeout=True):
+        refs = [SpeciesSNLRef.from_snl(LazyMPStructureNL(s)).as_dict() for s in g['species_snl']]
+        version = g.get('version', 0)
+        requests.append(UpdateOne({'_id': g['_id'], 'version': version if version else {'$in': [0, None]}},
+                                  {'$set': {'species_refs': refs}, '$unset': {'species_snl': ''},
+                                   '$inc': {'version': 1}}))
+        if len(requests) >= BATCH_SIZE:
+            n += snlgroups.bulk_write(requests, ordered=False).modified_count
+            requests = []
+            print 'UPDATED', n
+    if requests:
+        n += snlgroups.bulk_write(requests, ordered=False).modified_count
+    print 'DONE, updated {} SNL groups; run again if any group changed meanwhile'.format(n)
+
+
+if __name__ == '__main__':
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    snl_f = os.path.join(module_dir, 'snl.yaml')
+    species_snl_to_refs(SNLMongoAdapter.from_file(snl_f).snlgroups)
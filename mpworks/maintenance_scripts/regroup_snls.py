@@ -0,0 +1,21 @@
+from argparse import ArgumentParser
+from mpworks.snl_utils.regroup import REGROUP_TARGET, regroup
+from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
+
+'''
+Regroup all SNLs of the SNL database ($DB_LOC/snl_db.yaml) into a new
+collection, see mpworks.snl_utils.regroup. Run it again with the same
+--target to resume an interrupted run, and with --retry-failed to process
+the snlgroup_keys that failed once the run is finished. The new collection and its _diff
+collection can be reviewed before swapping them in for snlgroups.
+'''
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Regroup all SNLs into a new snlgroups collection')
+    parser.add_argument('--target', help='name of the new collection', default=REGROUP_TARGET)
+    parser.add_argument('--ncpus', help='number of processes', default=None, type=int)
+    parser.add_argument('--retry-failed', help='regroup the snlgroup_keys that failed in the finished run',
+                        action='store_true')
+    args = parser.parse_args()
+
+    regroup(SNLMongoAdapter.auto_load(), args.target, args.ncpus, args.retry_failed)
@@ -5,6 +5,7 @@ import os
 import sys
 from pymongo import MongoClient
 from fireworks.core.launchpad import LaunchPad
+from mpworks.db_utils.connection import get_shared
 from mpworks.drones.mp_vaspdrone import MPVaspDrone
 import multiprocessing
 import traceback
@@ -59,7 +60,7 @@ class TaskBuilder():
                 collection=self.collection, parse_dos=parse_dos,
                 additional_fields={},
                 update_duplicates=True)
-            t_id, d = drone.assimilate(dir_name, launches_coll=LaunchPad.auto_load().launches)
+            t_id, d = drone.assimilate(dir_name, launches_coll=get_shared('launchpad', LaunchPad.auto_load).launches)
 
 
             self.tasks.update({"task_id": t_id}, {"$set": {"snl_final": prev_info['snl_final'], "snlgroup_id_final": prev_info['snlgroup_id_final'], "snlgroup_changed": prev_info['snlgroup_changed']}})
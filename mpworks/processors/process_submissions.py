@@ -1,7 +1,14 @@
+import datetime
+import multiprocessing
 import time
 import traceback
+import uuid
+from fireworks.core.firework import Workflow
 from fireworks.core.launchpad import LaunchPad
+from pymongo import UpdateOne
+from mpworks.db_utils.locks import server_utcnow
 from mpworks.snl_utils.mpsnl import MPStructureNL
+from mpworks.submission.submission_events import SubmissionWatcher
 from mpworks.submission.submission_mongo import SubmissionMongoAdapter
 from mpworks.workflows.snl_to_wf import snl_to_wf
 from mpworks.workflows.snl_to_wf_elastic import snl_to_wf_elastic
@@ -17,6 +24,62 @@ __date__ = 'May 08, 2013'
 
 # Turn submissions into workflows, and updates the state of the submissions DB
 
+SUBMISSION_BATCH_SIZE = 100  # jobs claimed at a time by submit_new_workflows()
+WF_UPDATE_BATCH = 1000  # workflows handled per round of queries in update_changed_workflows()
+# the watermark of update_changed_workflows() is kept this far behind the
+# start of the last pass (on the clock of the FireWorks database server), to
+# allow for clock differences between the hosts writing the workflows
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+TERMINAL_STATES = ['COMPLETED', 'ERROR', 'REJECTED', 'CANCELLED']
+RECONCILE_INTERVAL = 300  # seconds between full passes of run_events()
+
+
+def get_rejection_reason(job):
+    """
+    Why a submission is rejected without being run, as (state_details,
+    message), or None if it can run.
+    """
+    if len(job['sites']) > SubmissionProcessor.MAX_SITES:
+        return 'too many sites', 'too many sites ({})'.format(len(job['sites']))
+    if not job['is_valid']:
+        return 'invalid structure (atoms too close)', 'invalid structure'
+    if len(set(NO_POTCARS) & set(job['elements'])) > 0:
+        return 'invalid structure (no POTCAR)', 'invalid element (No POTCAR)'
+    if not job['is_ordered']:
+        return 'invalid structure (disordered)', 'invalid structure'
+    return None
+
+
+def job_to_wf(job, snl=None):
+    """
+    Create the workflow of a submission
+    """
+    if snl is None:
+        snl = MPStructureNL.from_dict(job) if 'snl_id' in job else StructureNL.from_dict(job)
+    snl.data['_materialsproject'] = snl.data.get('_materialsproject', {})
+    snl.data['_materialsproject']['submission_id'] = job['submission_id']
+
+    # create a workflow
+    if "Elasticity" in snl.projects:
+        return snl_to_wf_elastic(snl, job['parameters'])
+    return snl_to_wf(snl, job['parameters'])
+
+
+def _build_wf(job):
+    # submit_new_workflows() pool worker: a job in; its workflow dict, or
+    # the reason it is rejected, or the error raised out
+    submission_id = job['submission_id']
+    try:
+        snl = MPStructureNL.from_dict(job) if 'snl_id' in job else StructureNL.from_dict(job)
+        formula = snl.structure.formula
+        rejection = get_rejection_reason(job)
+        if rejection:
+            return submission_id, formula, None, rejection, None
+        return submission_id, formula, job_to_wf(job, snl).to_dict(), None, None
+    except:
+        return submission_id, None, None, None, traceback.format_exc()
+
+
 class SubmissionProcessor():
     MAX_SITES = 200
 
@@ -26,18 +89,63 @@ class SubmissionProcessor():
         self.jobs = sma.jobs
         self.launchpad = launchpad
 
-    def run(self, sleep_time=None, infinite=False):
+    def run(self, sleep_time=None, infinite=False, batch_size=None, ncpus=None):
         sleep_time = sleep_time if sleep_time else 30
         while True:
-            self.submit_all_new_workflows()
+            self.submit_all_new_workflows(batch_size, ncpus)
             print "Updating existing workflows..."
-            self.update_existing_workflows()  # for updating the display
+            self.update_changed_workflows()  # for updating the display
             if not infinite:
                 break
             print 'sleeping', sleep_time
             time.sleep(sleep_time)
 
-    def submit_all_new_workflows(self):
+    def run_events(self, reconcile_interval=None, batch_size=None, ncpus=None):
+        """
+        Event-driven version of run(): new submissions are processed as soon
+        as they are submitted (see SubmissionWatcher), and a full pass, which
+        also updates the state of existing workflows, is made every
+        reconcile_interval seconds. Runs forever.
+        """
+        reconcile_interval = reconcile_interval if reconcile_interval else RECONCILE_INTERVAL
+        watcher = SubmissionWatcher(self.sma)  # before the first pass, not to miss events
+        print 'Waiting for submissions with a {}'.format(watcher.mode)
+        # one pool for all the wake-ups
+        pool = multiprocessing.Pool(ncpus) if batch_size else None
+        next_reconcile = 0
+        try:
+            while True:
+                self.submit_all_new_workflows(batch_size, ncpus, pool)
+                if time.time() >= next_reconcile:
+                    print "Updating existing workflows..."
+                    self.update_changed_workflows()
+                    next_reconcile = time.time() + reconcile_interval
+                watcher.wait(max(next_reconcile - time.time(), 0))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def submit_all_new_workflows(self, batch_size=None, ncpus=None, pool=None):
+        """
+        :param batch_size: (int) if set, claim and build this many jobs at a
+            time with submit_new_workflows(), in a pool of ncpus processes
+        :param pool: (multiprocessing.Pool) a pool to use instead of creating
+            one
+        """
+        if batch_size:
+            own_pool = pool is None
+            if own_pool:
+                pool = multiprocessing.Pool(ncpus)
+            try:
+                while self.submit_new_workflows(batch_size, pool):
+                    pass
+            finally:
+                if own_pool:
+                    pool.close()
+                    pool.join()
+            return
+
         last_id = -1
         while last_id:
             last_id = self.submit_new_workflow()
@@ -52,48 +160,105 @@ class SubmissionProcessor():
                     snl = MPStructureNL.from_dict(job)
                 else:
                     snl = StructureNL.from_dict(job)
-                if len(snl.structure.sites) > SubmissionProcessor.MAX_SITES:
-                    self.sma.update_state(submission_id, 'REJECTED', 'too many sites', {})
-                    print 'REJECTED WORKFLOW FOR {} - too many sites ({})'.format(
-                        snl.structure.formula, len(snl.structure.sites))
-                elif not job['is_valid']:
-                    self.sma.update_state(submission_id, 'REJECTED',
-                                          'invalid structure (atoms too close)', {})
-                    print 'REJECTED WORKFLOW FOR {} - invalid structure'.format(
-                        snl.structure.formula)
-                elif len(set(NO_POTCARS) & set(job['elements'])) > 0:
-                    self.sma.update_state(submission_id, 'REJECTED',
-                                          'invalid structure (no POTCAR)', {})
-                    print 'REJECTED WORKFLOW FOR {} - invalid element (No POTCAR)'.format(
-                        snl.structure.formula)
-                elif not job['is_ordered']:
-                    self.sma.update_state(submission_id, 'REJECTED',
-                                          'invalid structure (disordered)', {})
-                    print 'REJECTED WORKFLOW FOR {} - invalid structure'.format(
-                        snl.structure.formula)
+                rejection = get_rejection_reason(job)
+                if rejection:
+                    self.sma.update_state(submission_id, 'REJECTED', rejection[0], {})
+                    print 'REJECTED WORKFLOW FOR {} - {}'.format(snl.structure.formula, rejection[1])
                 else:
-                    snl.data['_materialsproject'] = snl.data.get('_materialsproject', {})
-                    snl.data['_materialsproject']['submission_id'] = submission_id
-
-                    # create a workflow
-                    if "Elasticity" in snl.projects:
-                        wf=snl_to_wf_elastic(snl, job['parameters'])
-                    else:
-                        wf = snl_to_wf(snl, job['parameters'])
+                    wf = job_to_wf(job, snl)
                     self.launchpad.add_wf(wf)
                     print 'ADDED WORKFLOW FOR {}'.format(snl.structure.formula)
             except:
-                self.jobs.find_and_modify({'submission_id': submission_id},
-                                          {'$set': {'state': 'ERROR'}})
+                self._set_error(submission_id)
                 traceback.print_exc()
 
             return submission_id
 
+    def claim_new_jobs(self, n):
+        """
+        Move up to n SUBMITTED jobs to WAITING and return them. Each job is
+        claimed by one processor only, even with several running.
+        """
+        claim_id = uuid.uuid4().hex
+        submission_ids = [j['submission_id'] for j in
+                          self.jobs.find({'state': 'SUBMITTED'}, {'submission_id': 1},
+                                         sort=[('submission_id', 1)]).limit(n)]
+        if not submission_ids:
+            return []
+        self.jobs.update_many({'submission_id': {'$in': submission_ids}, 'state': 'SUBMITTED'},
+                              {'$set': {'state': 'WAITING', 'claim_id': claim_id}})
+        return list(self.jobs.find({'claim_id': claim_id}))
+
+    def submit_new_workflows(self, batch_size=SUBMISSION_BATCH_SIZE, pool=None):
+        """
+        Batched version of submit_new_workflow(): claims up to batch_size
+        jobs, builds their workflows (in the pool, if given) and adds them to
+        the LaunchPad together. An error only affects the job it comes from.
+
+        :return: the number of jobs claimed
+        """
+        jobs = self.claim_new_jobs(batch_size)
+        if not jobs:
+            return 0
+        results = pool.map(_build_wf, jobs) if pool else map(_build_wf, jobs)
+
+        wfs = []
+        for submission_id, formula, wf_dict, rejection, error in results:
+            if error:
+                self._set_error(submission_id)
+                print 'ERROR for submission {}:\n{}'.format(submission_id, error)
+            elif rejection:
+                self.sma.update_state(submission_id, 'REJECTED', rejection[0], {})
+                print 'REJECTED WORKFLOW FOR {} - {}'.format(formula, rejection[1])
+            else:
+                wfs.append((submission_id, formula, Workflow.from_dict(wf_dict)))
+        self._add_wfs(wfs)
+        return len(jobs)
+
+    def _add_wfs(self, wfs):
+        # wfs: (submission_id, formula, Workflow)
+        if not wfs:
+            return
+        if hasattr(self.launchpad, 'bulk_add_wfs'):
+            try:
+                self.launchpad.bulk_add_wfs([wf for submission_id, formula, wf in wfs])
+                for submission_id, formula, wf in wfs:
+                    print 'ADDED WORKFLOW FOR {}'.format(formula)
+                return
+            except:
+                traceback.print_exc()
+                print 'Bulk insertion failed, adding workflows one by one'
+
+        for submission_id, formula, wf in wfs:
+            try:
+                # workflows the failed bulk insertion did write have their
+                # final fw_ids; it writes the workflows before the fireworks
+                fw_id = wf.fws[0].fw_id
+                old_wf = self.launchpad.workflows.find_one({'nodes': fw_id}, {'nodes': 1}) \
+                    if fw_id > 0 else None
+                if old_wf:
+                    nodes = old_wf['nodes']
+                    if self.launchpad.fireworks.find({'fw_id': {'$in': nodes}}).count() == len(nodes):
+                        print 'ADDED WORKFLOW FOR {}'.format(formula)
+                        continue
+                    # partially written, add it again from scratch
+                    self.launchpad.workflows.delete_one({'_id': old_wf['_id']})
+                    self.launchpad.fireworks.delete_many({'fw_id': {'$in': nodes}})
+                self.launchpad.add_wf(wf)
+                print 'ADDED WORKFLOW FOR {}'.format(formula)
+            except:
+                self._set_error(submission_id)
+                traceback.print_exc()
+
+    def _set_error(self, submission_id):
+        self.jobs.find_and_modify({'submission_id': submission_id},
+                                  {'$set': {'state': 'ERROR'}})
+
     def update_existing_workflows(self):
         # updates the state of existing workflows by querying the FireWorks database
         # this is an optional step that updates the submissions db with jobs info
         # it is useful for the frontend display but not needed for workflow execution
-        for submission in self.jobs.find({'state': {'$nin': ['COMPLETED', 'ERROR', 'REJECTED', 'CANCELLED']}},
+        for submission in self.jobs.find({'state': {'$nin': TERMINAL_STATES}},
                                          {'submission_id': 1}):
             submission_id = submission['submission_id']
             try:
@@ -103,6 +268,87 @@ class SubmissionProcessor():
                 traceback.print_exc()
         
 
+    def update_changed_workflows(self):
+        """
+        Incremental version of update_existing_workflows(): only workflows
+        updated since the last pass (the watermark, kept in the
+        processor_state collection of the submissions db) are looked at, a
+        batch of workflows at a time with a few queries per batch, and the
+        submissions are updated with bulk writes.
+        """
+        processor_state = self.sma.database.processor_state
+        # not the local clock, which may be off by more than WATERMARK_OVERLAP
+        started = server_utcnow(self.launchpad.workflows)
+        watermark = (processor_state.find_one({'_id': 'workflows_watermark'}) or {}).get('updated_on')
+
+        query = {'metadata.submission_id': {'$exists': True}}
+        if watermark:
+            query['updated_on'] = {'$gte': watermark}
+        batch = []
+        for wf in self.launchpad.workflows.find(query, {'metadata.submission_id': 1, 'state': 1,
+                                                        'nodes': 1, 'updated_on': 1, '_id': 0}):
+            batch.append(wf)
+            if len(batch) >= WF_UPDATE_BATCH:
+                self._update_wf_batch(batch)
+                batch = []
+        if batch:
+            self._update_wf_batch(batch)
+
+        processor_state.update_one({'_id': 'workflows_watermark'},
+                                   {'$set': {'updated_on': started - WATERMARK_OVERLAP}},
+                                   upsert=True)
+
+    def _update_wf_batch(self, wfs):
+        # like update_wf_state() for a batch of workflows
+        latest = {}
+        for wf in wfs:
+            submission_id = wf['metadata']['submission_id']
+            if submission_id not in latest or wf['updated_on'] > latest[submission_id]['updated_on']:
+                latest[submission_id] = wf
+
+        # only the most recent workflow of a (resubmitted) submission counts
+        for d in self.launchpad.workflows.aggregate([
+                {'$match': {'metadata.submission_id': {'$in': list(latest)}}},
+                {'$group': {'_id': '$metadata.submission_id', 'updated_on': {'$max': '$updated_on'}}}]):
+            if d['_id'] in latest and latest[d['_id']]['updated_on'] < d['updated_on']:
+                del latest[d['_id']]
+
+        open_ids = set([j['submission_id'] for j in
+                        self.jobs.find({'submission_id': {'$in': list(latest)},
+                                        'state': {'$nin': TERMINAL_STATES}},
+                                       {'submission_id': 1})])
+        latest = dict([(s_id, wf) for s_id, wf in latest.items() if s_id in open_ids])
+        if not latest:
+            return
+
+        # (prev_task_type, task_id) of the first launch of each completed
+        # DB insertion firework that has them
+        task_of_fw = {}
+        nodes = [fw_id for wf in latest.values() for fw_id in wf['nodes']]
+        for d in self.launchpad.fireworks.aggregate([
+                {'$match': {'fw_id': {'$in': nodes}, 'spec.task_type': 'VASP db insertion',
+                            'state': 'COMPLETED'}},
+                {'$project': {'_id': 0, 'fw_id': 1, 'launches': 1}},
+                {'$unwind': {'path': '$launches', 'includeArrayIndex': 'launch_idx'}},
+                {'$lookup': {'from': self.launchpad.launches.name, 'localField': 'launches',
+                             'foreignField': 'launch_id', 'as': 'launch'}},
+                {'$unwind': '$launch'},
+                {'$project': {'fw_id': 1, 'launch_idx': 1,
+                              'prev_task_type': '$launch.action.update_spec.prev_task_type',
+                              'task_id': '$launch.action.stored_data.task_id'}},
+                {'$match': {'prev_task_type': {'$exists': True}, 'task_id': {'$exists': True}}},
+                {'$sort': {'fw_id': 1, 'launch_idx': 1}}]):
+            if d['fw_id'] not in task_of_fw:
+                task_of_fw[d['fw_id']] = (d['prev_task_type'], d['task_id'])
+
+        requests = []
+        for submission_id, wf in latest.items():
+            tasks = dict([task_of_fw[fw_id] for fw_id in wf['nodes'] if fw_id in task_of_fw])
+            requests.append(UpdateOne({'submission_id': submission_id},
+                                      {'$set': {'state': wf['state'], 'state_details': '(none)',
+                                                'task_dict': tasks}}))
+        self.jobs.bulk_write(requests, ordered=False)
+
     def update_wf_state(self, submission_id):
         # state of the workflow
         tasks = {}
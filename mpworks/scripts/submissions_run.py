@@ -27,10 +27,16 @@ def go_submissions():
     parser = ArgumentParser(description=m_description)
     parser.add_argument('--sleep', help='sleep time between loops', default=None, type=int)
     parser.add_argument('--infinite', help='loop infinite times', action='store_true')
+    parser.add_argument('--batch', help='claim and build workflows for this many submissions at a time', default=None, type=int)
+    parser.add_argument('--ncpus', help='processes building workflows in batch mode', default=None, type=int)
+    parser.add_argument('--events', help='react to new submissions as they come in (runs forever; --sleep is the time between full passes)', action='store_true')
     args = parser.parse_args()
 
     sp = SubmissionProcessor.auto_load()
-    sp.run(args.sleep, args.infinite)
+    if args.events:
+        sp.run_events(args.sleep, args.batch, args.ncpus)
+    else:
+        sp.run(args.sleep, args.infinite, args.batch, args.ncpus)
 
 if __name__ == '__main__':
     go_submissions()
\ No newline at end of file
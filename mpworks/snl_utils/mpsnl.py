@@ -1,4 +1,8 @@
 import datetime
+import hashlib
+import json
+from fractions import gcd
+from functools import reduce
 from pymatgen import Structure, MontyDecoder, Molecule, Composition
 from pymatgen.analysis.structure_matcher import StructureMatcher, ElementComparator, SpeciesComparator
 from pymatgen.matproj.snl import StructureNL
@@ -12,6 +16,26 @@ __date__ = 'Apr 24, 2013'
 
 # TODO: document
 
+# relative tolerance on the volume-normalized reduced lattice lengths when
+# prefiltering candidates for a StructureMatcher fit with ltol=0.2; kept at
+# twice ltol so that the prefilter never rejects a structure that could fit
+FINGERPRINT_LTOL = 0.4
+
+# keep the species SNLs of new groups as SpeciesSNLRefs (snl_id and species
+# decorations) instead of embedded copies of the SNLs. Groups already stored
+# keep their mode; fix_scripts/species_snl_to_refs.py converts them.
+SPECIES_SNL_BY_REFERENCE = False
+
+# use default Structure Matcher params from April 24, 2013, as suggested by Shyue
+# we are using the ElementComparator() because this is how we want to group results.
+# primitive_cell=True as far as results go, but the matchers are given structures
+# already reduced with get_reduced_primitive(), see fit_reduced()
+GROUP_MATCHER = StructureMatcher(ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=False, scale=True,
+                                 attempt_supercell=False, comparator=ElementComparator())
+# species groups additionally distinguish oxidation states and spins
+SPECIES_MATCHER = StructureMatcher(ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=False, scale=True,
+                                   attempt_supercell=False, comparator=SpeciesComparator())
+
 
 def get_meta_from_structure(structure):
     comp = structure.composition
@@ -30,6 +54,95 @@ def get_meta_from_structure(structure):
     return meta
 
 
+def get_reduced_primitive(structure):
+    """
+    Niggli-reduced primitive cell, as used by StructureMatcher(primitive_cell=True)
+    """
+    prim = structure.get_reduced_structure(reduction_algo='niggli').get_primitive_structure()
+    return prim.get_reduced_structure(reduction_algo='niggli')
+
+
+def fit_reduced(prim1, prim2, matcher=GROUP_MATCHER):
+    """
+    Fit two structures reduced with get_reduced_primitive(), e.g. the
+    reduced_primitive of (Lazy)MPStructureNLs. Gives the same result as a
+    primitive_cell=True fit of the original structures, without reducing
+    them again for every pair.
+
+    :param matcher: GROUP_MATCHER, SPECIES_MATCHER or another StructureMatcher
+        with primitive_cell=False
+    """
+    return matcher.fit(prim1, prim2)
+
+
+def get_structure_fingerprint(structure):
+    """
+    Cheap invariants of a structure that any structure it can match (with the
+    grouping StructureMatcher) must share, within tolerance:
+    - nsites_prim: the number of sites in the primitive cell
+    - lattice: the sorted Niggli-reduced lattice lengths of the primitive
+      cell, divided by the cube root of the volume per atom
+    - vpa: the volume per atom. Not used for filtering since the grouping
+      matcher scales volumes, but handy for queries.
+    """
+    return get_reduced_fingerprint(get_reduced_primitive(structure))
+
+
+def get_reduced_fingerprint(prim):
+    """
+    get_structure_fingerprint() of a structure already reduced with
+    get_reduced_primitive()
+    """
+    nsites = len(prim)
+    vpa = prim.volume / nsites
+    scale = vpa ** (1.0 / 3)
+    return {'nsites_prim': nsites, 'vpa': vpa,
+            'lattice': sorted([x / scale for x in prim.lattice.abc])}
+
+
+def fingerprints_compatible(fp1, fp2, ltol=FINGERPRINT_LTOL):
+    """
+    False if two structures with these fingerprints certainly don't match
+    """
+    if fp1['nsites_prim'] != fp2['nsites_prim']:
+        return False
+    for l1, l2 in zip(fp1['lattice'], fp2['lattice']):
+        if abs(l1 - l2) > ltol * max(l1, l2):
+            return False
+    return True
+
+
+def is_large_c_ce(structure1, structure2):
+    """
+    C-Ce structures with more than 1500 sites are never fit
+    """
+    comp = structure1.composition
+    chemsys = '-'.join(sorted(set([e.symbol for e in comp.elements])))
+    return (structure1.num_sites > 1500 or structure2.num_sites > 1500) and chemsys == 'C-Ce'
+
+
+def has_reduced_primitive(structure):
+    """
+    Whether the grouping code stores (and fits by) the reduced primitive cell
+    of a structure: not for Molecules, and not for the large C-Ce structures
+    that are never fit.
+    """
+    return isinstance(structure, Structure) and not is_large_c_ce(structure, structure)
+
+
+def get_grouping_doc(snl):
+    """
+    The document of an (Lazy)MPStructureNL as the grouping code stores it (in
+    the snl collection and in snlgroups documents): as_dict() plus the
+    reduced_primitive, so that it is only computed once per SNL.
+    """
+    d = snl.as_dict()
+    if 'reduced_primitive' not in d and has_reduced_primitive(snl.structure):
+        d = dict(d)
+        d['reduced_primitive'] = snl.reduced_primitive.as_dict()
+    return d
+
+
 def has_species_properties(structure):
     for site in structure:
         for species in site.species_and_occu:
@@ -37,6 +150,70 @@ def has_species_properties(structure):
                 return True
 
 
+def get_species_decorations(structure):
+    """
+    The distinct decorated species (e.g. 'Fe2+,spin=5') of a structure
+    """
+    return sorted(set([str(sp) for site in structure for sp in site.species_and_occu]))
+
+
+def get_species_signature(structure):
+    """
+    A hash of the reduced multiset of site species (decorated species and
+    occupancies), i.e. the site counts divided by their gcd. Structures that
+    SPECIES_MATCHER can fit have the same signature, whatever their cells.
+    """
+    counts = {}
+    for site in structure:
+        species = json.dumps(sorted([(str(sp), round(occu, 6))
+                                     for sp, occu in site.species_and_occu.items()]))
+        counts[species] = counts.get(species, 0) + 1
+    divisor = reduce(gcd, counts.values())
+    multiset = sorted([(species, n / divisor) for species, n in counts.items()])
+    return hashlib.sha1(json.dumps(multiset).encode('utf-8')).hexdigest()
+
+
+class SpeciesSNLRef(object):
+    """
+    The SNL of a species group, stored by reference: its snl_id and species
+    decorations. The SNL is only loaded, through loader(snl_id), when a
+    species-level fit needs its structure.
+    """
+
+    def __init__(self, snl_id, decorations, loader=None, snl=None):
+        self.snl_id = snl_id
+        self.decorations = decorations
+        self.loader = loader
+        self._snl = snl
+
+    @property
+    def snl(self):
+        if self._snl is None:
+            if self.loader is None:
+                raise ValueError('No loader to get SNL {}!'.format(self.snl_id))
+            self._snl = self.loader(self.snl_id)
+        return self._snl
+
+    @property
+    def structure(self):
+        return self.snl.structure
+
+    @property
+    def reduced_primitive(self):
+        return self.snl.reduced_primitive
+
+    def as_dict(self):
+        return {'snl_id': self.snl_id, 'decorations': self.decorations}
+
+    @staticmethod
+    def from_dict(d, loader=None):
+        return SpeciesSNLRef(d['snl_id'], d['decorations'], loader)
+
+    @staticmethod
+    def from_snl(snl):
+        return SpeciesSNLRef(snl.snl_id, get_species_decorations(snl.structure), snl=snl)
+
+
 class MPStructureNL(StructureNL):
     # adds snl_id, spacegroup, and autometa properties to StructureNL.
 
@@ -58,6 +235,20 @@ class MPStructureNL(StructureNL):
     def snlgroup_key(self):
         return self.snl_autometa['reduced_cell_formula_abc'] + "--" + str(self.sg_num)
 
+    @property
+    def reduced_primitive(self):
+        # computed on first use and stored with the SNL by the grouping code
+        # (get_grouping_doc()); a primitive cell reduction isn't free
+        if getattr(self, '_reduced_primitive', None) is None:
+            self._reduced_primitive = get_reduced_primitive(self.structure)
+        return self._reduced_primitive
+
+    @property
+    def fingerprint(self):
+        if getattr(self, '_fingerprint', None) is None:
+            self._fingerprint = get_reduced_fingerprint(self.reduced_primitive)
+        return self._fingerprint
+
     def as_dict(self):
         m_dict = super(MPStructureNL, self).as_dict()
         m_dict.update(self.snl_autometa)
@@ -78,12 +269,15 @@ class MPStructureNL(StructureNL):
 
         structure = Structure.from_dict(d) if "lattice" in d \
             else Molecule.from_dict(d)
-        return MPStructureNL(structure, a["authors"],
-                             projects=a.get("projects", None),
-                             references=a.get("references", ""),
-                             remarks=a.get("remarks", None), data=data,
-                             history=a.get("history", None),
-                             created_at=created_at)
+        mpsnl = MPStructureNL(structure, a["authors"],
+                              projects=a.get("projects", None),
+                              references=a.get("references", ""),
+                              remarks=a.get("remarks", None), data=data,
+                              history=a.get("history", None),
+                              created_at=created_at)
+        if "reduced_primitive" in d:
+            mpsnl._reduced_primitive = Structure.from_dict(d["reduced_primitive"])
+        return mpsnl
 
     @staticmethod
     def from_snl(snl, snl_id, sg_num, sg_symbol, hall, xtal_system, lattice_type, pointgroup):
@@ -105,9 +299,17 @@ class MPStructureNL(StructureNL):
         return MPStructureNL.from_dict(snl2.as_dict())
 
 
+def species_by_reference(d):
+    """
+    Whether an snlgroups document keeps its species SNLs by reference
+    """
+    return 'species_refs' in d or (not d.get('species_snl') and SPECIES_SNL_BY_REFERENCE)
+
+
 class SNLGroup():
     def __init__(self, snlgroup_id, canonical_snl, all_snl_ids=None, species_snl=None,
-                 species_groups=None):
+                 species_groups=None, canonical_fingerprint=None, version=0,
+                 species_by_reference=None, species_signatures=None):
         # Auto fields
         self.created_at = datetime.datetime.utcnow()
         self.updated_at = datetime.datetime.utcnow()
@@ -123,37 +325,131 @@ class SNLGroup():
         # For snl with species properties
         self.species_snl = species_snl if species_snl else []
         self.species_groups = species_groups if species_groups else {}
+        self.species_by_reference = SPECIES_SNL_BY_REFERENCE if species_by_reference is None \
+            else species_by_reference
+        # get_species_signature() of each species group's SNL
+        self.species_signatures = species_signatures if species_signatures else {}
 
         # if the canonical SNL has species properties, it belongs in the species group
         if has_species_properties(canonical_snl.structure) and not species_snl:
-            self.species_snl.append(canonical_snl)
+            self.species_snl.append(self._species_entry(canonical_snl))
             self.species_groups[canonical_snl.snl_id] = [canonical_snl.snl_id]
+            self.species_signatures[canonical_snl.snl_id] = get_species_signature(canonical_snl.structure)
 
         # Convenience fields
         self.canonical_structure = canonical_snl.structure
         self.snl_autometa = get_meta_from_structure(self.canonical_structure)
+        if canonical_fingerprint:
+            canonical_snl._fingerprint = canonical_fingerprint
+
+        # bumped on every write of the stored group, see get_update()
+        self.version = version
+        self._clear_changes()
 
     def as_dict(self):
         d = self.snl_autometa
         d['created_at'] = self.created_at
         d['updated_at'] = self.updated_at
         d['snlgroup_id'] = self.snlgroup_id
-        d['canonical_snl'] = self.canonical_snl.as_dict()
+        d['canonical_snl'] = get_grouping_doc(self.canonical_snl)
         d['all_snl_ids'] = self.all_snl_ids
         d['num_snl'] = len(self.all_snl_ids)
-        d['species_snl'] = [s.as_dict() for s in self.species_snl]
+        d[self._species_field] = [self._species_entry_dict(s) for s in self.species_snl]
         d['species_groups'] = dict([(str(k), v) for k, v in self.species_groups.iteritems()])
+        d['species_signatures'] = dict([(str(k), v) for k, v in self.species_signatures.iteritems()])
         d['snlgroup_key'] = self.canonical_snl.snlgroup_key
+        if has_reduced_primitive(self.canonical_structure):
+            d['canonical_fingerprint'] = self.canonical_snl.fingerprint
+        d['version'] = self.version
         return d
 
+    @staticmethod
+    def _species_entry_dict(entry):
+        return entry.as_dict() if isinstance(entry, SpeciesSNLRef) else get_grouping_doc(entry)
+
+    @property
+    def _species_field(self):
+        return 'species_refs' if self.species_by_reference else 'species_snl'
+
+    def _species_entry(self, snl):
+        return SpeciesSNLRef.from_snl(snl) if self.species_by_reference else snl
+
+    def _clear_changes(self):
+        # what add_if_belongs() changed since the group was loaded or saved
+        self._new_snl_ids = []
+        self._new_species_snl = []
+        self._new_species_members = {}
+        self._new_species_signatures = []
+
+    def _get_species_signature(self, snl):
+        # groups stored before signatures existed get them on first use
+        if snl.snl_id not in self.species_signatures:
+            self.species_signatures[snl.snl_id] = get_species_signature(snl.structure)
+            self._new_species_signatures.append(snl.snl_id)
+        return self.species_signatures[snl.snl_id]
+
+    def version_query(self):
+        """
+        Selects the stored group, as long as nobody else has updated it since
+        it was loaded
+        """
+        return {'snlgroup_id': self.snlgroup_id,
+                'version': self.version if self.version else {'$in': [0, None]}}
+
+    def get_update(self):
+        """
+        An update document applying the changes made by add_if_belongs() to
+        the stored group: the new snl_ids and species SNLs are pushed rather
+        than rewriting the whole group. Use with version_query(), then call
+        mark_saved().
+        """
+        new_species = [s.snl_id for s in self._new_species_snl]
+        to_set = {'updated_at': self.updated_at}
+        if has_reduced_primitive(self.canonical_structure):
+            to_set['canonical_fingerprint'] = self.canonical_snl.fingerprint
+        for spec_group in new_species:
+            to_set['species_groups.{}'.format(spec_group)] = self.species_groups[spec_group]
+        for spec_group in self._new_species_signatures:
+            to_set['species_signatures.{}'.format(spec_group)] = self.species_signatures[spec_group]
+        to_push = {}
+        if self._new_snl_ids:
+            to_push['all_snl_ids'] = {'$each': self._new_snl_ids}
+        if self._new_species_snl:
+            to_push[self._species_field] = {'$each': [self._species_entry_dict(s)
+                                                      for s in self._new_species_snl]}
+        for spec_group, snl_ids in self._new_species_members.items():
+            if spec_group not in new_species:
+                to_push['species_groups.{}'.format(spec_group)] = {'$each': snl_ids}
+
+        update = {'$set': to_set,
+                  '$inc': {'num_snl': len(self._new_snl_ids), 'version': 1}}
+        if to_push:
+            update['$push'] = to_push
+        return update
+
+    def mark_saved(self):
+        self.version = (self.version or 0) + 1
+        self._clear_changes()
+
     @classmethod
-    def from_dict(cls, d):
-        sp_snl = [MPStructureNL.from_dict(s) for s in d['species_snl']] if 'species_snl' in d else None
+    def from_dict(cls, d, species_loader=None):
+        """
+        :param species_loader: for groups storing species SNLs by reference,
+            a function giving the (Lazy)MPStructureNL of an snl_id
+        """
+        by_reference = species_by_reference(d)
+        if by_reference:
+            sp_snl = [SpeciesSNLRef.from_dict(s, species_loader) for s in d.get('species_refs', [])]
+        else:
+            sp_snl = [MPStructureNL.from_dict(s) for s in d['species_snl']] if 'species_snl' in d else None
         # to account for no int keys in Mongo dicts
         species_groups = dict([(int(k), v) for k, v in d['species_groups'].iteritems()]) if 'species_groups' in d else None
+        species_signatures = dict([(int(k), v) for k, v in d.get('species_signatures', {}).iteritems()])
 
         return SNLGroup(d['snlgroup_id'], MPStructureNL.from_dict(d['canonical_snl']),
-                        d['all_snl_ids'], sp_snl, species_groups)
+                        d['all_snl_ids'], sp_snl, species_groups,
+                        d.get('canonical_fingerprint'), d.get('version', 0), by_reference,
+                        species_signatures)
 
     def add_if_belongs(self, cand_snl):
 
@@ -166,11 +462,7 @@ class SNLGroup():
             return False, None
 
         # filter out large C-Ce structures
-        comp = cand_snl.structure.composition
-        elsyms = sorted(set([e.symbol for e in comp.elements]))
-        chemsys = '-'.join(elsyms)
-        if (
-                cand_snl.structure.num_sites > 1500 or self.canonical_structure.num_sites > 1500) and chemsys == 'C-Ce':
+        if is_large_c_ce(cand_snl.structure, self.canonical_structure):
             print 'SKIPPING LARGE C-Ce'
             return False, None
 
@@ -179,38 +471,183 @@ class SNLGroup():
             print 'WARNING: add_if_belongs() has detected that you are trying to add the same SNL id twice!'
             return False, None
 
-        #try a structure fit to the canonical structure
-
-        # use default Structure Matcher params from April 24, 2013, as suggested by Shyue
-        # we are using the ElementComparator() because this is how we want to group results
-        sm = StructureMatcher(ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=True, scale=True,
-                              attempt_supercell=False, comparator=ElementComparator())
+        # skip the fit if the primitive cells clearly differ
+        if not fingerprints_compatible(cand_snl.fingerprint, self.canonical_snl.fingerprint):
+            return False, None
 
-        if not sm.fit(cand_snl.structure, self.canonical_structure):
+        #try a structure fit to the canonical structure
+        if not fit_reduced(cand_snl.reduced_primitive, self.canonical_snl.reduced_primitive):
             return False, None
 
         # everything checks out, add to the group
+        return True, self.add_member(cand_snl)
+
+    def add_member(self, cand_snl):
+        """
+        Add an SNL known to belong to the group, and to its species group if
+        it has species properties. Returns the species group (or None).
+        """
         self.all_snl_ids.append(cand_snl.snl_id)
+        self._new_snl_ids.append(cand_snl.snl_id)
 
         # now that we are in the group, if there are site properties we need to check species_groups
         # e.g., if there is another SNL in the group with the same site properties, e.g. MAGMOM
         spec_group = None
 
         if has_species_properties(cand_snl.structure):
+            # only fit species groups with the same species multiset
+            cand_signature = get_species_signature(cand_snl.structure)
             for snl in self.species_snl:
-                sms = StructureMatcher(ltol=0.2, stol=0.3, angle_tol=5, primitive_cell=True, scale=True,
-                              attempt_supercell=False, comparator=SpeciesComparator())
-                if sms.fit(cand_snl.structure, snl.structure):
+                if self._get_species_signature(snl) != cand_signature:
+                    continue
+                if fit_reduced(cand_snl.reduced_primitive, snl.reduced_primitive, SPECIES_MATCHER):
                     spec_group = snl.snl_id
                     self.species_groups[snl.snl_id].append(cand_snl.snl_id)
+                    self._new_species_members.setdefault(snl.snl_id, []).append(cand_snl.snl_id)
                     break
 
             # add a new species group
             if not spec_group:
                 self.species_groups[cand_snl.snl_id] = [cand_snl.snl_id]
-                self.species_snl.append(cand_snl)
+                self.species_signatures[cand_snl.snl_id] = cand_signature
+                self._new_species_signatures.append(cand_snl.snl_id)
+                entry = self._species_entry(cand_snl)
+                self.species_snl.append(entry)
+                self._new_species_snl.append(entry)
                 spec_group = cand_snl.snl_id
 
         self.updated_at = datetime.datetime.utcnow()
 
-        return True, spec_group
+        return spec_group
+
+
+class LazyMPStructureNL(object):
+    """
+    An MPStructureNL document that is only decoded as far as it is used.
+
+    snl_id, sg_num and snlgroup_key are read straight from the document and
+    the structure is built on first access. Anything else (authors, history,
+    references, ...) decodes the complete MPStructureNL, which needs the
+    whole document. as_dict() returns the document as it was loaded.
+    """
+
+    def __init__(self, d):
+        self._d = d
+        self._structure = None
+        self._reduced_primitive = None
+        self._mpsnl = None
+        self._fingerprint = None
+
+    @property
+    def snl_id(self):
+        return self._d['about']['_materialsproject']['snl_id']
+
+    @property
+    def sg_num(self):
+        return self._d['about']['_materialsproject']['spacegroup']['number']
+
+    @property
+    def snlgroup_key(self):
+        if 'snlgroup_key' in self._d:
+            return self._d['snlgroup_key']
+        return self.snl_autometa['reduced_cell_formula_abc'] + "--" + str(self.sg_num)
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = Structure.from_dict(self._d)
+        return self._structure
+
+    @property
+    def snl_autometa(self):
+        return get_meta_from_structure(self.structure)
+
+    @property
+    def reduced_primitive(self):
+        if self._reduced_primitive is None:
+            if 'reduced_primitive' in self._d:
+                self._reduced_primitive = Structure.from_dict(self._d['reduced_primitive'])
+            else:
+                self._reduced_primitive = get_reduced_primitive(self.structure)
+        return self._reduced_primitive
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = get_reduced_fingerprint(self.reduced_primitive)
+        return self._fingerprint
+
+    def decode(self):
+        """
+        The full MPStructureNL
+        """
+        if self._mpsnl is None:
+            self._mpsnl = MPStructureNL.from_dict(self._d)
+        return self._mpsnl
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.decode(), name)
+
+    def as_dict(self):
+        return self._d
+
+
+class LazySNLGroup(SNLGroup, object):
+    """
+    An SNLGroup read from a (possibly projected) snlgroups document, whose
+    canonical SNL and species SNLs are LazyMPStructureNLs (or SpeciesSNLRefs
+    loaded with species_loader).
+
+    Matching (add_if_belongs) needs only the fields in
+    snl_mongo.SNLGROUP_MATCH_FIELDS. A group loaded with a projection
+    must be written back with get_update(), never as_dict().
+    """
+
+    def __init__(self, d, species_loader=None):
+        self._d = d
+        self.species_loader = species_loader
+        self.species_by_reference = species_by_reference(d)
+        self.snlgroup_id = d['snlgroup_id']
+        self.all_snl_ids = d.get('all_snl_ids', [])
+        self.species_groups = dict([(int(k), v) for k, v in d['species_groups'].iteritems()]) \
+            if 'species_groups' in d else {}
+        self.species_signatures = dict([(int(k), v) for k, v in d.get('species_signatures', {}).iteritems()])
+        self.created_at = d.get('created_at')
+        self.updated_at = d.get('updated_at')
+        self.version = d.get('version', 0)
+        self._canonical_snl = None
+        self._species_snl = None
+        self._clear_changes()
+
+    @property
+    def canonical_snl(self):
+        if self._canonical_snl is None:
+            self._canonical_snl = LazyMPStructureNL(self._d['canonical_snl'])
+            self._canonical_snl._fingerprint = self._d.get('canonical_fingerprint')
+        return self._canonical_snl
+
+    @property
+    def canonical_structure(self):
+        return self.canonical_snl.structure
+
+    @property
+    def species_snl(self):
+        if self._species_snl is None:
+            if self.species_by_reference:
+                self._species_snl = [SpeciesSNLRef.from_dict(s, self.species_loader)
+                                     for s in self._d.get('species_refs', [])]
+            else:
+                self._species_snl = [LazyMPStructureNL(s) for s in self._d.get('species_snl', [])]
+        return self._species_snl
+
+    @property
+    def snl_autometa(self):
+        return self.canonical_snl.snl_autometa
+
+    def decode(self):
+        """
+        The full SNLGroup; needs the whole document
+        """
+        return SNLGroup.from_dict(self._d, self.species_loader)
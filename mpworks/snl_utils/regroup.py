@@ -0,0 +1,258 @@
+import multiprocessing
+import traceback
+from collections import Counter, OrderedDict
+from itertools import islice
+from pymongo import ASCENDING
+from mpworks.db_utils.id_allocator import get_id_allocator
+from mpworks.snl_utils.mpsnl import LazyMPStructureNL, SNLGroup, fingerprints_compatible, \
+    fit_reduced, has_species_properties, is_large_c_ce
+
+'''
+Offline regrouping of all SNLs, e.g. after the grouping tolerances changed,
+or after fix_bad_crystals/modify_snl left groups inconsistent.
+
+regroup() streams the snl collection sorted by snlgroup_key and clusters each
+snlgroup_key partition in a process pool. Two SNLs end up in the same group if
+a chain of StructureMatcher fits connects them (union-find), so unlike
+build_groups() the result doesn't depend on the order in which SNLs were
+added. The SNL with the lowest snl_id of a group is its canonical SNL.
+
+The groups are written to a new collection; the snlgroups collection is not
+modified. A new group keeps the snlgroup_id of the old group it shares the
+most SNLs with, if that id is still free. The <target>_diff collection gets
+one entry per new group (unchanged, changed or new compared to the old
+groups) and one per old group that has no successor (removed).
+
+Progress is checkpointed in the regroup_checkpoints collection after each
+partition. Running regroup() again with the same target resumes after the
+last partition written. Partitions that raised an error are listed in the
+checkpoint ('failed'); their old groups are not reported as removed, and
+once the run is finished regroup(..., retry_failed=True) processes them
+again.
+
+Partitions use the stored snlgroup_key, i.e. the stored spacegroups: after a
+change of SPACEGROUP_TOLERANCE, the spacegroups of the SNLs must be updated
+first.
+'''
+
+REGROUP_TARGET = 'snlgroups_regrouped'  # default name of the new collection
+PARTITIONS_PER_CPU = 4  # partitions read ahead per process
+
+
+def _may_match(snl1, snl2):
+    # the cheap checks of SNLGroup.add_if_belongs()
+    if snl1.structure.is_ordered != snl2.structure.is_ordered:
+        return False
+    if is_large_c_ce(snl1.structure, snl2.structure):
+        return False
+    return fingerprints_compatible(snl1.fingerprint, snl2.fingerprint)
+
+
+def cluster_snls(snls):
+    """
+    Union-find clustering of (Lazy)MPStructureNLs that share an snlgroup_key.
+
+    :return: lists of indices into snls; each list is sorted, and the lists
+        are sorted by their first index
+    """
+    parents = list(range(len(snls)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i in range(len(snls)):
+        for j in range(i + 1, len(snls)):
+            root_i, root_j = find(i), find(j)
+            if root_i == root_j or not _may_match(snls[i], snls[j]):
+                continue
+            if fit_reduced(snls[i].reduced_primitive, snls[j].reduced_primitive):
+                # the root is always the lowest index of a cluster
+                parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    clusters = OrderedDict()
+    for i in range(len(snls)):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+
+def _regroup_partition(args):
+    # pool worker: the SNL documents of one snlgroup_key in, group documents
+    # (without snlgroup_id) out
+    snlgroup_key, snl_docs = args
+    try:
+        snls = sorted([LazyMPStructureNL(d) for d in snl_docs], key=lambda s: s.snl_id)
+        groups = []
+        for members in cluster_snls(snls):
+            group = SNLGroup(None, snls[members[0]].decode())
+            for i in members[1:]:
+                # species SNLs may get embedded in the group
+                snl = snls[i].decode() if has_species_properties(snls[i].structure) else snls[i]
+                group.add_member(snl)
+            groups.append(group.as_dict())
+        return snlgroup_key, groups, None
+    except:
+        return snlgroup_key, None, traceback.format_exc()
+
+
+def _partitions(snl_coll, query):
+    snlgroup_key, docs = None, []
+    for snl_d in snl_coll.find(query, {'_id': 0}, sort=[('snlgroup_key', ASCENDING)],
+                               no_cursor_timeout=True):
+        if docs and snl_d['snlgroup_key'] != snlgroup_key:
+            yield snlgroup_key, docs
+            docs = []
+        snlgroup_key = snl_d['snlgroup_key']
+        docs.append(snl_d)
+    if docs:
+        yield snlgroup_key, docs
+
+
+class _OldGroups(object):
+    # the snlgroup_id, members and canonical SNL of every old group
+
+    def __init__(self, snlgroups):
+        self.members = {}
+        self.canonical = {}
+        self.keys = {}
+        self.group_of = {}
+        for sg in snlgroups.find({}, {'snlgroup_id': 1, 'all_snl_ids': 1, 'snlgroup_key': 1,
+                                      'canonical_snl.snl_id': 1, '_id': 0}):
+            self.members[sg['snlgroup_id']] = set(sg['all_snl_ids'])
+            self.canonical[sg['snlgroup_id']] = sg['canonical_snl']['snl_id']
+            self.keys[sg['snlgroup_id']] = sg.get('snlgroup_key')
+            for snl_id in sg['all_snl_ids']:
+                self.group_of[snl_id] = sg['snlgroup_id']
+
+    def diff(self, group, claimed, get_new_id):
+        """
+        Set the snlgroup_id of a new group document and return its diff entry
+        """
+        snl_ids = set(group['all_snl_ids'])
+        counts = Counter([self.group_of[s] for s in snl_ids if s in self.group_of])
+        snlgroup_id = None
+        for old_id, n in counts.most_common():
+            if old_id not in claimed:
+                snlgroup_id = old_id
+                break
+        old_snl_ids = self.members.get(snlgroup_id, set())
+        if snlgroup_id is None:
+            snlgroup_id = get_new_id()
+            status = 'new'
+        elif old_snl_ids == snl_ids and self.canonical[snlgroup_id] == group['canonical_snl']['snl_id']:
+            status = 'unchanged'
+        else:
+            status = 'changed'
+        claimed.add(snlgroup_id)
+        group['snlgroup_id'] = snlgroup_id
+        return {'snlgroup_id': snlgroup_id, 'snlgroup_key': group['snlgroup_key'],
+                'status': status, 'old_snlgroup_ids': sorted(counts),
+                'added_snl_ids': sorted(snl_ids - old_snl_ids),
+                'removed_snl_ids': sorted(old_snl_ids - snl_ids)}
+
+
+def regroup(sma, target=REGROUP_TARGET, ncpus=None, retry_failed=False):
+    """
+    Regroup all SNLs of an SNLMongoAdapter into the collection target, see
+    the module docstring.
+
+    :param sma: SNLMongoAdapter
+    :param target: (str) name of the new snlgroups collection
+    :param ncpus: (int) processes for the clustering, default all
+    :param retry_failed: (bool) process the partitions that failed in the
+        finished run into target again
+    """
+    new_groups = sma.database[target]
+    diff = sma.database[target + '_diff']
+    checkpoints = sma.database.regroup_checkpoints
+    new_groups.ensure_index('snlgroup_id', unique=True)
+    new_groups.ensure_index('snlgroup_key')
+    diff.ensure_index('snlgroup_key')
+
+    checkpoint = checkpoints.find_one({'_id': target}) or {}
+    last_key = checkpoint.get('last_key')
+    if retry_failed:
+        if not checkpoint.get('finished'):
+            raise ValueError('Finish regrouping into {} before retrying failed partitions'.format(target))
+        failed_keys = sorted([f['snlgroup_key'] for f in checkpoint.get('failed', [])])
+        if not failed_keys:
+            print 'No failed partitions to retry for {}'.format(target)
+            return
+        print 'RETRYING {} failed partitions'.format(len(failed_keys))
+        new_groups.delete_many({'snlgroup_key': {'$in': failed_keys}})
+        diff.delete_many({'snlgroup_key': {'$in': failed_keys}})
+        query = {'snlgroup_key': {'$in': failed_keys}}
+    elif checkpoint.get('finished'):
+        print 'Regrouping into {} is already finished'.format(target)
+        return
+    elif last_key is None:
+        new_groups.delete_many({})
+        diff.delete_many({})
+        query = {}
+    else:
+        # redo the partition that was being written when the last run stopped
+        print 'RESUMING after snlgroup_key {}'.format(last_key)
+        new_groups.delete_many({'snlgroup_key': {'$gt': last_key}})
+        diff.delete_many({'snlgroup_key': {'$gt': last_key}})
+        query = {'snlgroup_key': {'$gt': last_key}}
+
+    old_groups = _OldGroups(sma.snlgroups)
+    claimed = set([sg['snlgroup_id'] for sg in new_groups.find({}, {'snlgroup_id': 1})])
+
+    id_allocator = get_id_allocator(sma.id_assigner, {}, 'next_snlgroup_id')
+    pool = multiprocessing.Pool(ncpus)
+    window = PARTITIONS_PER_CPU * (ncpus or multiprocessing.cpu_count())
+    try:
+        partitions = _partitions(sma.snl, query)
+        while True:
+            # only read ahead a few partitions, the snl collection doesn't fit in memory
+            batch = list(islice(partitions, window))
+            if not batch:
+                break
+            for snlgroup_key, groups, error in pool.imap(_regroup_partition, batch):
+                if retry_failed:
+                    # the partition's old entry goes; a new one if it fails again
+                    checkpoints.update_one({'_id': target},
+                                           {'$pull': {'failed': {'snlgroup_key': snlgroup_key}}})
+                    update = {}
+                else:
+                    update = {'$set': {'last_key': snlgroup_key}}
+                if error:
+                    print 'ERROR - could not regroup {}:\n{}'.format(snlgroup_key, error)
+                    update['$push'] = {'failed': {'snlgroup_key': snlgroup_key, 'error': error}}
+                else:
+                    diffs = [old_groups.diff(g, claimed, id_allocator.next_id) for g in groups]
+                    new_groups.insert_many(groups)
+                    diff.insert_many(diffs)
+                if update:
+                    checkpoints.update_one({'_id': target}, update, upsert=True)
+    finally:
+        pool.close()
+        pool.join()
+
+    # old groups without a successor; those of failed partitions weren't
+    # regrouped at all
+    failed_keys = set([f['snlgroup_key'] for f in
+                       (checkpoints.find_one({'_id': target}) or {}).get('failed', [])])
+    diff.delete_many({'status': 'removed'})
+    removed = [old_id for old_id in old_groups.members
+               if old_id not in claimed and old_groups.keys[old_id] not in failed_keys]
+    removed_snl_ids = set([s for old_id in removed for s in old_groups.members[old_id]])
+    new_group_of = {}
+    for sg in new_groups.find({}, {'snlgroup_id': 1, 'all_snl_ids': 1}):
+        for snl_id in sg['all_snl_ids']:
+            if snl_id in removed_snl_ids:
+                new_group_of[snl_id] = sg['snlgroup_id']
+    diffs = [{'snlgroup_id': old_id, 'status': 'removed',
+              'new_snlgroup_ids': sorted(set([new_group_of[s] for s in old_groups.members[old_id]
+                                              if s in new_group_of]))}
+             for old_id in removed]
+    if diffs:
+        diff.insert_many(diffs)
+    checkpoints.update_one({'_id': target}, {'$set': {'finished': True}}, upsert=True)
+    print 'DONE, {} groups in {} ({} old groups removed)'.format(new_groups.count(), target,
+                                                                len(removed))
+    if failed_keys:
+        print 'WARNING - {} partitions failed, retry them with retry_failed=True'.format(len(failed_keys))
@@ -1,11 +1,17 @@
-import time
 import os
 import traceback
 import datetime
-from pymongo import MongoClient, DESCENDING
+import multiprocessing
+from itertools import islice
+from pymongo import DESCENDING, InsertOne
 from fireworks.utilities.fw_serializers import FWSerializable
-from mpworks.snl_utils.mpsnl import MPStructureNL, SNLGroup
-from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+from mpworks.db_utils.connection import get_client, get_database, run_once
+from mpworks.db_utils.id_allocator import get_id_allocator
+from mpworks.db_utils.locks import LeaseLock
+from mpworks.snl_utils.mpsnl import MPStructureNL, SNLGroup, LazyMPStructureNL, LazySNLGroup, \
+    get_grouping_doc, has_reduced_primitive
+from mpworks.snl_utils.symmetry_cache import SPACEGROUP_TOLERANCE, get_symmetry
+from pymatgen.matproj.snl import StructureNL
 
 
 __author__ = 'Anubhav Jain'
@@ -15,8 +21,44 @@ __maintainer__ = 'Anubhav Jain'
 __email__ = 'ajain@lbl.gov'
 __date__ = 'Apr 24, 2013'
 
-# Parameters for spacegroup and mps_unique_id determination
-SPACEGROUP_TOLERANCE = 0.1  # as suggested by Shyue, 6/19/2012
+IMPORT_CHUNK_SIZE = 500  # SNLs per chunk (and per bulk write) in add_snls()
+GROUP_UPDATE_TRIES = 5  # attempts to add an SNL to a group that keeps changing
+
+# fields of an SNL document needed for its structure, id and snlgroup_key
+SNL_STRUCTURE_FIELDS = ['lattice', 'sites', 'snl_id', 'snlgroup_key', 'about._materialsproject',
+                        'reduced_primitive']
+# fields of an snlgroups document needed to match an SNL against the group
+SNLGROUP_MATCH_FIELDS = ['snlgroup_id', 'snlgroup_key', 'all_snl_ids', 'species_refs',
+                         'species_groups', 'species_signatures', 'canonical_fingerprint', 'created_at',
+                         'updated_at', 'version'] + \
+                        ['canonical_snl.' + f for f in SNL_STRUCTURE_FIELDS] + \
+                        ['species_snl.' + f for f in SNL_STRUCTURE_FIELDS]
+
+
+def get_projection(fields):
+    """
+    A find() projection for only these fields; None for whole documents
+    """
+    return dict([(f, 1) for f in fields]) if fields is not None else None
+
+
+def get_mpsnl(snl, snl_id):
+    """
+    Run the symmetry analysis of an SNL and turn it into an MPStructureNL.
+    """
+    sg = get_symmetry(snl.structure, SPACEGROUP_TOLERANCE)
+    return MPStructureNL.from_snl(snl, snl_id, sg['number'], sg['symbol'], sg['hall'],
+                                  sg['crystal_system'], sg['lattice_type'], sg['point_group'])
+
+
+def _mpsnl_dict(args):
+    # add_snls() pool worker: dicts in and out, so that only plain data is pickled
+    snl_d, snl_id = args
+    try:
+        # the reduced primitive cell is computed here, in the pool
+        return get_grouping_doc(get_mpsnl(StructureNL.from_dict(snl_d), snl_id)), None
+    except:
+        return None, traceback.format_exc()
 
 
 class SNLMongoAdapter(FWSerializable):
@@ -28,21 +70,26 @@ class SNLMongoAdapter(FWSerializable):
         self.username = username
         self.password = password
 
-        self.connection = MongoClient(host, port, j=False)
-        self.database = self.connection[db]
-        if self.username:
-            self.database.authenticate(username, password)
+        self.connection = get_client(host, port, j=False)
+        self.database = get_database(host, port, db, username, password,
+                                     j=False)
 
         self.snl = self.database.snl
         self.snlgroups = self.database.snlgroups
         self.id_assigner = self.database.id_assigner
+        self.locks = self.database.snl_locks
+        self.imports = self.database.snl_imports
 
-        self._update_indices()
+        # indices only need to be ensured once per process, not every time
+        # an adapter is auto_load()-ed
+        run_once(('snl_indices', host, port, db), self._update_indices)
 
     def _reset(self):
         self.restart_id_assigner_at(1, 1)
         self.snl.remove()
         self.snlgroups.remove()
+        self.locks.remove()
+        self.imports.remove()
 
     def _update_indices(self):
         self.snl.ensure_index('snl_id', unique=True)
@@ -54,6 +101,8 @@ class SNLMongoAdapter(FWSerializable):
         self.snl.ensure_index('autometa.reduced_cell_formula_abc')
         self.snl.ensure_index('autometa.is_ordered')
         self.snl.ensure_index('about._icsd.icsd_id')
+        self.snl.ensure_index([('_import.name', 1), ('_import.chunk', 1)], sparse=True)
+        self.snl.ensure_index('snlgroup_key')
 
         self.snlgroups.ensure_index('snlgroup_id', unique=True)
         self.snlgroups.ensure_index('all_snl_ids')
@@ -66,66 +115,237 @@ class SNLMongoAdapter(FWSerializable):
         self.snlgroups.ensure_index('autometa.reduced_cell_formula_abc')
         self.snlgroups.ensure_index('autometa.is_ordered')
         self.snlgroups.ensure_index('canonical_snl.about._icsd.icsd_id')
+        self.snlgroups.ensure_index([('snlgroup_key', 1), ('canonical_fingerprint.nsites_prim', 1)])
 
     def _get_next_snl_id(self):
-        snl_id = self.id_assigner.find_and_modify(
-            query={}, update={'$inc': {'next_snl_id': 1}})['next_snl_id']
-        return snl_id
+        # ids are reserved in blocks per process, see db_utils/id_allocator.py
+        return get_id_allocator(self.id_assigner, {}, 'next_snl_id').next_id()
 
     def _get_next_snlgroup_id(self):
-        snlgroup_id = self.id_assigner.find_and_modify(
-            query={},
-            update={'$inc': {'next_snlgroup_id': 1}})['next_snlgroup_id']
-        return snlgroup_id
+        return get_id_allocator(self.id_assigner, {}, 'next_snlgroup_id').next_id()
 
     def restart_id_assigner_at(self, next_snl_id, next_snlgroup_id):
+        # other processes using this db must be restarted afterwards, they
+        # may still hold blocks of old ids (see db_utils/id_allocator.py)
         self.id_assigner.remove()
         self.id_assigner.insert(
             {"next_snl_id": next_snl_id, "next_snlgroup_id": next_snlgroup_id})
+        for field in ['next_snl_id', 'next_snlgroup_id']:
+            get_id_allocator(self.id_assigner, {}, field).reset()
 
     def add_snl(self, snl, force_new=False, snlgroup_guess=None):
         try:
-            self.lock_db()
             snl_id = self._get_next_snl_id()
-
-            spstruc = snl.structure.copy()
-            spstruc.remove_oxidation_states()
-            sf = SpacegroupAnalyzer(spstruc, SPACEGROUP_TOLERANCE)
-            sf.get_space_group_operations()
-            sgnum = sf.get_space_group_number() if sf.get_space_group_number() \
-                else -1
-            sgsym = sf.get_space_group_symbol() if sf.get_space_group_symbol() \
-                else 'unknown'
-            sghall = sf.get_hall() if sf.get_hall() else 'unknown'
-            sgxtal = sf.get_crystal_system() if sf.get_crystal_system() \
-                else 'unknown'
-            sglatt = sf.get_lattice_type() if sf.get_lattice_type() else 'unknown'
-            sgpoint = sf.get_point_group_symbol()
-
-            mpsnl = MPStructureNL.from_snl(snl, snl_id, sgnum, sgsym, sghall,
-                                           sgxtal, sglatt, sgpoint)
-            snlgroup, add_new, spec_group = self.add_mpsnl(mpsnl, force_new, snlgroup_guess)
-            self.release_lock()
+            mpsnl = get_mpsnl(snl, snl_id)
+            # an SNL can only join a group with the same snlgroup_key, so
+            # only inserts with the same key need to wait for each other
+            with self.group_lock(mpsnl.snlgroup_key):
+                snlgroup, add_new, spec_group = self.add_mpsnl(mpsnl, force_new, snlgroup_guess)
             return mpsnl, snlgroup.snlgroup_id, spec_group
         except:
-            self.release_lock()
             traceback.print_exc()
             raise ValueError("Error while adding SNL!")
 
 
+    def add_snls(self, snls, import_name=None, chunk_size=IMPORT_CHUNK_SIZE, ncpus=None):
+        """
+        Bulk version of add_snl() for imports of many SNLs.
+
+        The SNLs are processed in chunks: the symmetry analysis of a chunk
+        runs in a process pool, the SNLs are bucketed by snlgroup_key and each
+        bucket is matched in memory against the existing groups with that key
+        and against the new groups of the same chunk. New SNLs and group
+        changes are then written with bulk operations.
+
+        With an import_name, the import can be resumed by calling add_snls()
+        again with the same name and the same input: finished chunks are
+        skipped, and SNLs already written for an interrupted chunk are reused
+        rather than added twice.
+
+        :param snls: an iterable of StructureNL, e.g. a generator reading from
+            another database
+        :param import_name: (str) name under which progress is recorded
+        :param chunk_size: (int) SNLs per chunk
+        :param ncpus: (int) processes for the symmetry analysis, default all
+        :return: a list of (snl_id, snlgroup_id) of the SNLs added by this call
+        """
+        done = set()
+        if import_name:
+            progress = self.imports.find_one({'_id': import_name}) or {}
+            done = set(progress.get('chunks_done', []))
+
+        added = []
+        pool = multiprocessing.Pool(ncpus)
+        try:
+            snls = iter(snls)
+            chunk_idx = 0
+            while True:
+                chunk = list(islice(snls, chunk_size))
+                if not chunk:
+                    break
+                if chunk_idx in done:
+                    print 'SKIPPING finished chunk {} of import {}'.format(chunk_idx, import_name)
+                else:
+                    added.extend(self._add_snl_chunk(chunk, import_name, chunk_idx, pool))
+                    if import_name:
+                        self.imports.update_one({'_id': import_name},
+                                                {'$addToSet': {'chunks_done': chunk_idx}},
+                                                upsert=True)
+                chunk_idx += 1
+        finally:
+            pool.close()
+            pool.join()
+        return added
+
+    def _add_snl_chunk(self, chunk, import_name, chunk_idx, pool):
+        # SNLs of this chunk written by an earlier, interrupted run
+        existing = {}
+        if import_name:
+            for snl_d in self.snl.find({'_import.name': import_name, '_import.chunk': chunk_idx}):
+                existing[snl_d['_import']['index']] = MPStructureNL.from_dict(snl_d)
+
+        todo = [i for i in range(len(chunk)) if i not in existing]
+        snl_ids = get_id_allocator(self.id_assigner, {}, 'next_snl_id').next_ids(len(todo))
+        results = pool.map(_mpsnl_dict, [(chunk[i].as_dict(), snl_id)
+                                         for i, snl_id in zip(todo, snl_ids)])
+
+        new_docs = []
+        to_group = []
+        for i, (mpsnl_d, error) in zip(todo, results):
+            if mpsnl_d is None:
+                print 'ERROR - could not add SNL {} of chunk {}:\n{}'.format(i, chunk_idx, error)
+                continue
+            mpsnl = MPStructureNL.from_dict(mpsnl_d)
+            snl_d = get_grouping_doc(mpsnl)
+            snl_d['snl_timestamp'] = datetime.datetime.utcnow().isoformat()
+            if import_name:
+                snl_d['_import'] = {'name': import_name, 'chunk': chunk_idx, 'index': i}
+            new_docs.append(snl_d)
+            to_group.append(mpsnl)
+
+        if existing:
+            # SNLs that also made it into a group before the interruption are done
+            grouped = set()
+            for sg in self.snlgroups.find({'all_snl_ids': {'$in': [s.snl_id for s in existing.values()]}},
+                                          {'all_snl_ids': 1}):
+                grouped.update(sg['all_snl_ids'])
+            to_group.extend([s for s in existing.values() if s.snl_id not in grouped])
+
+        if new_docs:
+            self.snl.insert_many(new_docs, ordered=True)
+
+        buckets = {}
+        for mpsnl in to_group:
+            buckets.setdefault(mpsnl.snlgroup_key, []).append(mpsnl)
+
+        added = []
+        for snlgroup_key in sorted(buckets):
+            with self.group_lock(snlgroup_key):
+                added.extend(self._group_bucket(snlgroup_key, buckets[snlgroup_key]))
+        return added
+
+    def _group_bucket(self, snlgroup_key, mpsnls):
+        # must be called with the lock on snlgroup_key held
+        groups = list(self.find_snlgroups({'snlgroup_key': snlgroup_key},
+                                          sort=[("num_snl", DESCENDING)]))
+        changed = set()
+        new_groups = set()
+        added = []
+        for mpsnl in sorted(mpsnls, key=lambda s: s.snl_id):
+            snlgroup = None
+            for sg in groups:
+                match_found, spec_group = sg.add_if_belongs(mpsnl)
+                if match_found:
+                    snlgroup = sg
+                    changed.add(sg.snlgroup_id)
+                    break
+            if snlgroup is None:
+                snlgroup = SNLGroup(self._get_next_snlgroup_id(), mpsnl)
+                groups.append(snlgroup)
+                new_groups.add(snlgroup.snlgroup_id)
+            added.append((mpsnl.snl_id, snlgroup.snlgroup_id))
+
+        requests = [InsertOne(sg.as_dict()) for sg in groups if sg.snlgroup_id in new_groups]
+        if requests:
+            self.snlgroups.bulk_write(requests, ordered=True)
+        for sg in groups:
+            # new groups were inserted with all their members, including the
+            # ones that joined after the group was created
+            if sg.snlgroup_id in changed and sg.snlgroup_id not in new_groups and \
+                    not self._update_group(sg):
+                # changed by somebody else since it was loaded; add its new
+                # SNLs one by one instead
+                members = [snl_id for snl_id, snlgroup_id in added if snlgroup_id == sg.snlgroup_id]
+                for mpsnl in mpsnls:
+                    if mpsnl.snl_id in members:
+                        snlgroup, add_new, spec_group = self.build_groups(
+                            mpsnl, snlgroup_guess=sg.snlgroup_id)
+                        added[added.index((mpsnl.snl_id, sg.snlgroup_id))] = \
+                            (mpsnl.snl_id, snlgroup.snlgroup_id)
+        return added
+
+    def find_snls(self, query, fields=SNL_STRUCTURE_FIELDS, **kwargs):
+        """
+        Iterate over LazyMPStructureNLs of the SNLs matching query, loading
+        only fields (None for whole documents). kwargs are passed to find().
+        """
+        for snl_d in self.snl.find(query, get_projection(fields), **kwargs):
+            yield LazyMPStructureNL(snl_d)
+
+    def find_snlgroups(self, query, fields=SNLGROUP_MATCH_FIELDS, **kwargs):
+        """
+        Iterate over LazySNLGroups of the SNL groups matching query, loading
+        only fields (None for whole documents). kwargs are passed to find().
+        """
+        for sg in self.snlgroups.find(query, get_projection(fields), **kwargs):
+            yield LazySNLGroup(sg, self.get_lazy_snl)
+
+    def find_snlgroup(self, query, fields=SNLGROUP_MATCH_FIELDS):
+        sg = self.snlgroups.find_one(query, get_projection(fields))
+        return LazySNLGroup(sg, self.get_lazy_snl) if sg else None
+
+    def get_lazy_snl(self, snl_id, fields=SNL_STRUCTURE_FIELDS):
+        """
+        A LazyMPStructureNL, e.g. to load species SNLs stored by reference
+        """
+        snl_d = self.snl.find_one({'snl_id': snl_id}, get_projection(fields))
+        if not snl_d:
+            raise ValueError('SNL {} not found!'.format(snl_id))
+        return LazyMPStructureNL(snl_d)
+
     def add_mpsnl(self, mpsnl, force_new=False, snlgroup_guess=None):
-        snl_d = mpsnl.as_dict()
+        snl_d = get_grouping_doc(mpsnl)
         snl_d['snl_timestamp'] = datetime.datetime.utcnow().isoformat()
         self.snl.insert_one(snl_d)
         return self.build_groups(mpsnl, force_new, snlgroup_guess)
 
+    def _update_group(self, snlgroup):
+        """
+        Write the changes made to a loaded group. Returns False (and writes
+        nothing) if the stored group was updated by somebody else meanwhile.
+        """
+        result = self.snlgroups.update_one(snlgroup.version_query(), snlgroup.get_update())
+        if result.matched_count != 1:
+            return False
+        snlgroup.mark_saved()
+        return True
+
     def _add_if_belongs(self, snlgroup, mpsnl, testing_mode):
-        match_found, spec_group = snlgroup.add_if_belongs(mpsnl)
+        for n_tried in range(GROUP_UPDATE_TRIES):
+            if snlgroup is None:
+                # deleted or merged into another group meanwhile
+                return False, None
+            match_found, spec_group = snlgroup.add_if_belongs(mpsnl)
+            if not match_found or testing_mode or self._update_group(snlgroup):
+                break
+            # the group was updated since it was loaded, try again on a fresh copy
+            snlgroup = self.find_snlgroup({'snlgroup_id': snlgroup.snlgroup_id})
+        else:
+            raise ValueError('Could not update SNL group {} after {} tries!'.format(
+                snlgroup.snlgroup_id, GROUP_UPDATE_TRIES))
+
         if match_found:
             print 'MATCH FOUND, grouping (snl_id, snlgroup): {}'.format((mpsnl.snl_id, snlgroup.snlgroup_id))
-            if not testing_mode:
-		self.snlgroups.update_one({'snlgroup_id': snlgroup.snlgroup_id}, {'$set': snlgroup.as_dict()})
-
         return match_found, spec_group
 
     def build_groups(self, mpsnl, force_new=False, snlgroup_guess=None, testing_mode=False):
@@ -134,15 +354,19 @@ class SNLMongoAdapter(FWSerializable):
         match_found = False
         if not force_new:
             if snlgroup_guess:
-                sgp = self.snlgroups.find_one({'snlgroup_id': snlgroup_guess})
-                snlgroup = SNLGroup.from_dict(sgp)
+                snlgroup = self.find_snlgroup({'snlgroup_id': snlgroup_guess})
                 match_found, spec_group = self._add_if_belongs(snlgroup, mpsnl, testing_mode)
 
             if not match_found:
-                # look at all potential matches
-                for entry in self.snlgroups.find({'snlgroup_key': mpsnl.snlgroup_key},
-                                                 sort=[("num_snl", DESCENDING)]):
-                    snlgroup = SNLGroup.from_dict(entry)
+                # look at all potential matches; groups whose primitive cell
+                # has a different number of sites can't match. Groups without
+                # a fingerprint yet (see fix_scripts/add_snlgroup_fingerprints.py)
+                # are always candidates.
+                query = {'snlgroup_key': mpsnl.snlgroup_key}
+                if has_reduced_primitive(mpsnl.structure):
+                    query['$or'] = [{'canonical_fingerprint.nsites_prim': mpsnl.fingerprint['nsites_prim']},
+                                    {'canonical_fingerprint': {'$exists': False}}]
+                for snlgroup in self.find_snlgroups(query, sort=[("num_snl", DESCENDING)]):
                     match_found, spec_group = self._add_if_belongs(snlgroup, mpsnl, testing_mode)
                     if match_found:
                         break
@@ -162,29 +386,22 @@ class SNLMongoAdapter(FWSerializable):
 
     def switch_canonical_snl(self, snlgroup_id, canonical_mpsnl):
         sgp = self.snlgroups.find_one({'snlgroup_id': snlgroup_id})
-        snlgroup = SNLGroup.from_dict(sgp)
+        snlgroup = SNLGroup.from_dict(sgp, self.get_lazy_snl)
 
         all_snl_ids = [sid for sid in snlgroup.all_snl_ids]
         if canonical_mpsnl.snl_id not in all_snl_ids:
             raise ValueError('Canonical SNL must already be in snlgroup to switch!')
 
-        new_group = SNLGroup(snlgroup_id, canonical_mpsnl, all_snl_ids)
+        new_group = SNLGroup(snlgroup_id, canonical_mpsnl, all_snl_ids,
+                             version=snlgroup.version + 1,
+                             species_by_reference=snlgroup.species_by_reference)
         self.snlgroups.update({'snlgroup_id': snlgroup_id}, new_group.as_dict())
 
-    def lock_db(self, n_tried=0, n_max_tries=10):
-        x = self.id_assigner.find_and_modify(query={}, update={'$set':{'lock': True}}, fields={'lock':1})
-        if 'lock' in x and x['lock']:
-            # x is original object
-            if n_tried < n_max_tries:
-                time.sleep(30)
-                n_tried += 1
-                # DB was already locked by another process in a race condition
-                self.lock_db(n_tried=n_tried, n_max_tries=n_max_tries)
-            else:
-                raise ValueError('DB locked by another process! Could not lock even after {} minutes!'.format(n_max_tries/60))
-
-    def release_lock(self):
-        self.id_assigner.update_many({}, {'$set':{'lock': False}})
+    def group_lock(self, snlgroup_key):
+        """
+        A lease lock on the SNL groups with this snlgroup_key.
+        """
+        return LeaseLock(self.locks, snlgroup_key)
 
     def to_dict(self):
         """
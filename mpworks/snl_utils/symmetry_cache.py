@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+'''
+Memoized spacegroup analysis.
+
+The same structures get analyzed over and over: once when the SNL is added,
+again by the check_snl spacegroup checks, and again whenever a checker or an
+import is re-run. get_symmetry() runs SpacegroupAnalyzer once per structure
+and tolerance, and keeps the result in an in-memory LRU cache. Results can
+additionally be persisted in a Mongo collection (set_persistent_backend()),
+so that they survive the process.
+
+Structures are keyed by a hash of their lattice and their sorted sites, with
+oxidation states removed as for the analysis itself; two structures with the
+same key are the same crystal to within the rounding used for the hash. The
+key also holds the tolerance and the pymatgen and spglib versions, so that
+persisted results are not reused after an upgrade that could change them.
+'''
+
+# Parameters for spacegroup and mps_unique_id determination
+SPACEGROUP_TOLERANCE = 0.1  # as suggested by Shyue, 6/19/2012
+
+SYMMETRY_CACHE_SIZE = 10000  # results kept in memory
+HASH_DECIMALS = 6  # rounding of lattice parameters and coordinates for the hash
+
+
+def _get_library_versions():
+    import pymatgen
+    versions = ['pymatgen-{}'.format(getattr(pymatgen, '__version__', 'unknown'))]
+    try:
+        import spglib
+        version = getattr(spglib, '__version__', None)
+        if version is None:
+            version = '.'.join([str(v) for v in spglib.get_version()])
+        versions.append('spglib-{}'.format(version))
+    except ImportError:
+        versions.append('spglib-unknown')  # e.g. the pyspglib bundled with old pymatgen
+    return ','.join(versions)
+
+
+LIBRARY_VERSIONS = _get_library_versions()
+
+
+def structure_hash(structure):
+    """
+    A hash of the lattice and of the sorted (species, fractional coords) of
+    the sites, ignoring oxidation states.
+    """
+    lattice = [[round(x, HASH_DECIMALS) for x in row] for row in structure.lattice.matrix.tolist()]
+    sites = []
+    for site in structure:
+        species = sorted([(getattr(sp, 'symbol', str(sp)), round(occu, HASH_DECIMALS))
+                          for sp, occu in site.species_and_occu.items()])
+        coords = [round(x % 1.0, HASH_DECIMALS) % 1.0 for x in site.frac_coords.tolist()]
+        sites.append([species, coords])
+    sites.sort()
+    return hashlib.sha1(json.dumps([lattice, sites]).encode('utf-8')).hexdigest()
+
+
+def analyze_symmetry(structure, symprec=SPACEGROUP_TOLERANCE):
+    """
+    Run SpacegroupAnalyzer, calling each getter once.
+
+    :return: a dict with the number, symbol, hall, crystal_system,
+        lattice_type and point_group of the spacegroup. Missing values are
+        -1 (number) or 'unknown'.
+    """
+    spstruc = structure.copy()
+    spstruc.remove_oxidation_states()
+    sf = SpacegroupAnalyzer(spstruc, symprec)
+    sf.get_space_group_operations()
+    return {'number': sf.get_space_group_number() or -1,
+            'symbol': sf.get_space_group_symbol() or 'unknown',
+            'hall': sf.get_hall() or 'unknown',
+            'crystal_system': sf.get_crystal_system() or 'unknown',
+            'lattice_type': sf.get_lattice_type() or 'unknown',
+            'point_group': sf.get_point_group_symbol()}
+
+
+class SymmetryCache(object):
+    """
+    LRU cache of analyze_symmetry() results, optionally backed by a Mongo
+    collection.
+    """
+
+    def __init__(self, maxsize=SYMMETRY_CACHE_SIZE, collection=None):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.set_collection(collection)
+
+    def set_collection(self, collection):
+        self._collection = collection
+        self._pid = os.getpid()
+
+    @property
+    def collection(self):
+        # a forked child (e.g. an add_snls() pool worker) must not use the
+        # parent's MongoClient; it falls back to its in-memory cache
+        return self._collection if self._pid == os.getpid() else None
+
+    def get(self, structure, symprec=SPACEGROUP_TOLERANCE):
+        key = '{}:{}:{}'.format(structure_hash(structure), symprec, LIBRARY_VERSIONS)
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+                return dict(self._entries[key])
+
+        symmetry = None
+        collection = self.collection
+        if collection is not None:
+            doc = collection.find_one({'_id': key})
+            symmetry = doc['symmetry'] if doc else None
+        if symmetry is None:
+            symmetry = analyze_symmetry(structure, symprec)
+            if collection is not None:
+                collection.replace_one({'_id': key}, {'_id': key, 'symmetry': symmetry},
+                                       upsert=True)
+
+        with self._lock:
+            self._entries[key] = symmetry
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dict(symmetry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = SymmetryCache()
+
+
+def set_persistent_backend(collection):
+    """
+    Also store (and look up) symmetry results in this Mongo collection, e.g.
+    SNLMongoAdapter.database.symmetry_cache. None to go back to memory only.
+    """
+    _cache.set_collection(collection)
+
+
+def get_symmetry(structure, symprec=SPACEGROUP_TOLERANCE):
+    """
+    Cached version of analyze_symmetry()
+    """
+    return _cache.get(structure, symprec)
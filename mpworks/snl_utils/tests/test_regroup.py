@@ -0,0 +1,155 @@
+import unittest
+from unittest import TestCase
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from mpworks.snl_utils import regroup as regroup_module
+from mpworks.snl_utils.regroup import cluster_snls, regroup
+
+
+class _SNL(object):
+    def __init__(self, reduced_primitive):
+        self.reduced_primitive = reduced_primitive
+
+
+class _Pool(object):
+    # a serial multiprocessing.Pool
+    def __init__(self, processes=None):
+        pass
+
+    def imap(self, func, iterable):
+        return map(func, iterable)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class _Multiprocessing(object):
+    Pool = _Pool
+
+    @staticmethod
+    def cpu_count():
+        return 1
+
+
+class _IdAllocator(object):
+    def __init__(self):
+        self.last_id = 100
+
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+
+class _Adapter(object):
+    # the parts of an SNLMongoAdapter regroup() uses
+    def __init__(self, database):
+        self.database = database
+        self.snl = database.snl
+        self.snlgroups = database.snlgroups
+        self.id_assigner = database.id_assigner
+
+
+class RegroupTestCase(TestCase):
+    def setUp(self):
+        self.saved = {}
+
+    def patch(self, name, value):
+        self.saved[name] = getattr(regroup_module, name)
+        setattr(regroup_module, name, value)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(regroup_module, name, value)
+
+
+class TestClusterSNLs(RegroupTestCase):
+    def test_chains_merge(self):
+        # SNLs fit when their "structures" differ by at most 1, so 0, 1 and
+        # 2 end up in one group through 1 although 0 and 2 don't fit
+        self.patch('_may_match', lambda snl1, snl2: True)
+        self.patch('fit_reduced', lambda s1, s2: abs(s1 - s2) <= 1)
+        snls = [_SNL(0), _SNL(5), _SNL(2), _SNL(1), _SNL(9)]
+        self.assertEqual(cluster_snls(snls), [[0, 2, 3], [1], [4]])
+
+    def test_cheap_checks_first(self):
+        self.patch('_may_match', lambda snl1, snl2: False)
+        self.patch('fit_reduced', lambda s1, s2: self.fail('fit without a cheap match'))
+        self.assertEqual(cluster_snls([_SNL(0), _SNL(0)]), [[0], [1]])
+
+
+class TestRegroup(RegroupTestCase):
+    """
+    Regroups snlgroup_keys A (SNLs 1 and 2, old groups 10 and 14), B (SNL 3,
+    old group 11) and C (SNL 4, old group 12); SNL 7 of group 14 is gone.
+    """
+
+    def setUp(self):
+        RegroupTestCase.setUp(self)
+        if mongomock is None:
+            raise unittest.SkipTest('mongomock is not installed')
+        self.sma = _Adapter(mongomock.MongoClient().db)
+        self.sma.snl.insert_many([{'snl_id': snl_id, 'snlgroup_key': key}
+                                  for snl_id, key in [(1, 'A'), (2, 'A'), (3, 'B'), (4, 'C')]])
+        self.sma.snlgroups.insert_many([
+            {'snlgroup_id': snlgroup_id, 'snlgroup_key': key, 'all_snl_ids': snl_ids,
+             'canonical_snl': {'snl_id': snl_ids[0]}}
+            for snlgroup_id, key, snl_ids in [(10, 'A', [1, 2]), (14, 'A', [7]),
+                                              (11, 'B', [3]), (12, 'C', [4])]])
+
+        self.failing_keys = set(['B'])
+
+        def regroup_partition(args):
+            # one group per snlgroup_key
+            snlgroup_key, snl_docs = args
+            if snlgroup_key in self.failing_keys:
+                return snlgroup_key, None, 'Traceback: no fit for {}'.format(snlgroup_key)
+            snl_ids = sorted([d['snl_id'] for d in snl_docs])
+            return snlgroup_key, [{'snlgroup_key': snlgroup_key, 'all_snl_ids': snl_ids,
+                                   'canonical_snl': {'snl_id': snl_ids[0]}}], None
+
+        allocator = _IdAllocator()
+        self.patch('_regroup_partition', regroup_partition)
+        self.patch('multiprocessing', _Multiprocessing)
+        self.patch('get_id_allocator', lambda coll, query, field: allocator)
+
+    def _checkpoint(self):
+        return self.sma.database.regroup_checkpoints.find_one({'_id': 'new'})
+
+    def _group_ids(self):
+        return sorted([sg['snlgroup_id'] for sg in self.sma.database.new.find()])
+
+    def _diff(self, status):
+        return sorted([d['snlgroup_id'] for d in self.sma.database.new_diff.find({'status': status})])
+
+    def test_failed_partition_and_retry(self):
+        self.assertRaises(ValueError, regroup, self.sma, 'new', 1, True)
+
+        regroup(self.sma, 'new', 1)
+        checkpoint = self._checkpoint()
+        self.assertTrue(checkpoint['finished'])
+        self.assertEqual([f['snlgroup_key'] for f in checkpoint['failed']], ['B'])
+        self.assertEqual(self._group_ids(), [10, 12])
+        # group 11 wasn't regrouped, it isn't removed
+        self.assertEqual(self._diff('removed'), [14])
+        self.assertEqual(self._diff('changed'), [])
+
+        self.failing_keys = set()
+        regroup(self.sma, 'new', 1, retry_failed=True)
+        self.assertEqual(self._checkpoint()['failed'], [])
+        self.assertEqual(self._group_ids(), [10, 11, 12])
+        self.assertEqual(self._diff('unchanged'), [10, 11, 12])
+        self.assertEqual(self._diff('removed'), [14])
+
+    def test_failing_again(self):
+        regroup(self.sma, 'new', 1)
+        regroup(self.sma, 'new', 1, retry_failed=True)
+        self.assertEqual([f['snlgroup_key'] for f in self._checkpoint()['failed']], ['B'])
+        self.assertEqual(self._group_ids(), [10, 12])
+        self.assertEqual(self._diff('removed'), [14])
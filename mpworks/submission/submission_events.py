@@ -0,0 +1,124 @@
+import datetime
+import time
+from pymongo import CursorType, DESCENDING
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+'''
+Notification of new submissions, for an event-driven SubmissionProcessor.
+
+SubmissionWatcher follows the jobs collection with a change stream when the
+server supports it (replica sets, including a single-node one, and pymongo
+>= 3.6). Otherwise, e.g. on a standalone mongod, it tails the capped
+submission_events collection, to which SubmissionMongoAdapter writes an event
+for every submitted or resubmitted job.
+
+Events only wake the processor up; the jobs collection stays the source of
+truth, so a lost event delays a submission until the next reconciliation pass
+at worst.
+'''
+
+SUBMISSION_EVENTS = 'submission_events'  # name of the capped collection
+SUBMISSION_EVENTS_SIZE = 10 * 1024 * 1024  # bytes
+AWAIT_MS = 1000  # server-side wait of each change stream / tailable cursor poll
+
+# jobs inserted, or set back to SUBMITTED by SubmissionMongoAdapter.resubmit()
+JOB_EVENTS_PIPELINE = [{'$match': {'$or': [
+    {'operationType': 'insert'},
+    {'operationType': 'update', 'updateDescription.updatedFields.state': 'SUBMITTED'}]}}]
+
+
+def ensure_events_collection(database):
+    """
+    Create the capped submission_events collection if it doesn't exist
+    """
+    if SUBMISSION_EVENTS not in database.collection_names():
+        try:
+            database.create_collection(SUBMISSION_EVENTS, capped=True,
+                                       size=SUBMISSION_EVENTS_SIZE)
+        except CollectionInvalid:
+            pass  # created in the meantime
+    return database[SUBMISSION_EVENTS]
+
+
+def emit_submission_events(database, submission_ids, event='submitted'):
+    """
+    Write one event per submission_id to the submission_events collection
+    """
+    now = datetime.datetime.utcnow()
+    docs = [{'submission_id': s_id, 'event': event, 'time': now} for s_id in submission_ids]
+    if docs:
+        database[SUBMISSION_EVENTS].insert_many(docs, ordered=False)
+
+
+class SubmissionWatcher(object):
+    """
+    Waits for new submissions, see the module docstring. Events that arrive
+    while nobody is waiting are kept, so the watcher should be created before
+    the first pass over the jobs collection.
+    """
+
+    def __init__(self, sma, use_change_streams=True):
+        self.sma = sma
+        self.events = ensure_events_collection(sma.database)
+        self._open(use_change_streams)
+
+    def _open(self, use_change_streams):
+        self._stream = None
+        self._cursor = None
+        self._last_event = None
+        if use_change_streams:
+            try:
+                self._stream = self.sma.jobs.watch(JOB_EVENTS_PIPELINE, max_await_time_ms=AWAIT_MS)
+            except (AttributeError, OperationFailure):
+                self._stream = None  # old pymongo, or not a replica set
+        if self._stream is None:
+            last = self.events.find_one({}, {'_id': 1}, sort=[('$natural', DESCENDING)])
+            self._last_event = last['_id'] if last else None
+
+    @property
+    def mode(self):
+        return 'change stream' if self._stream is not None else 'tailable cursor'
+
+    def wait(self, timeout):
+        """
+        Block until a submission event arrives or timeout seconds have passed.
+
+        :return: True if there was an event
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if self._stream is not None:
+                    if self._stream.try_next() is not None:
+                        return True
+                elif self._next_event():
+                    return True
+            except PyMongoError:
+                # start over from the current state of the collection; the
+                # caller's pass picks up whatever was missed
+                self._reopen()
+                return True
+        return False
+
+    def _next_event(self):
+        if self._cursor is None or not self._cursor.alive:
+            query = {'_id': {'$gt': self._last_event}} if self._last_event else {}
+            self._cursor = self.events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+            self._cursor.max_await_time_ms(AWAIT_MS)
+        try:
+            doc = next(self._cursor)
+        except StopIteration:
+            if not self._cursor.alive:
+                # e.g. a tailable cursor on an empty capped collection dies
+                # at once; don't spin
+                time.sleep(AWAIT_MS / 1000.0)
+            return False
+        self._last_event = doc['_id']
+        return True
+
+    def _reopen(self):
+        use_change_streams = self._stream is not None
+        for c in [self._stream, self._cursor]:
+            if c is not None:
+                c.close()
+        self._open(use_change_streams)
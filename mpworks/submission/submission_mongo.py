@@ -1,11 +1,17 @@
 import json
+import multiprocessing
 import os
 import datetime
+import traceback
 
-from pymongo import MongoClient, DESCENDING
+from pymongo import DESCENDING
+from mpworks.db_utils.connection import get_client, get_database, run_once
+from mpworks.db_utils.id_allocator import get_id_allocator
 from mpworks.snl_utils.mpsnl import MPStructureNL
 from mpworks.snl_utils.snl_mongo import SNLMongoAdapter
-from pymatgen import Composition
+from mpworks.submission.submission_events import emit_submission_events, \
+    ensure_events_collection
+from pymatgen import Composition, Structure
 
 import yaml
 
@@ -22,6 +28,7 @@ __date__ = 'Apr 26, 2013'
 DATETIME_HANDLER = lambda obj: obj.isoformat() \
     if isinstance(obj, datetime.datetime) else None
 YAML_STYLE = False  # False = YAML is formatted as blocks
+POOL_MIN_SNLS = 100  # submit_snls() computes the metadata in a pool from this many SNLs on
 
 
 def reconstitute_dates(obj_dict):
@@ -62,6 +69,20 @@ def get_meta_from_structure(structure):
             'is_valid': bool(structure.is_valid())} # guard against pymatgen returning numpy.bool_ nonsense
     return meta
 
+
+def _get_job_doc(snl):
+    # submit_snls() pool worker: the SNL dict with the metadata and sorted
+    # structure submit_snl() adds to a job, or the error raised
+    try:
+        d = snl.as_dict()
+        if 'is_valid' not in d:
+            d.update(get_meta_from_structure(snl.structure))
+        d.update(snl.structure.get_sorted_structure().as_dict())
+        return d, None
+    except:
+        return None, traceback.format_exc()
+
+
 class SubmissionMongoAdapter(object):
     # This is the user interface to submissions
 
@@ -73,15 +94,14 @@ class SubmissionMongoAdapter(object):
         self.username = username
         self.password = password
 
-        self.connection = MongoClient(host, port, j=False)
-        self.database = self.connection[db]
-        if self.username:
-            self.database.authenticate(username, password)
+        self.connection = get_client(host, port, j=False)
+        self.database = get_database(host, port, db, username, password,
+                                     j=False)
 
         self.jobs = self.database.jobs
         self.id_assigner = self.database.id_assigner
 
-        self._update_indices()
+        run_once(('submission_indices', host, port, db), self._update_indices)
 
     def _reset(self):
         self._restart_id_assigner_at(1)
@@ -91,15 +111,18 @@ class SubmissionMongoAdapter(object):
         self.jobs.ensure_index('submission_id', unique=True)
         self.jobs.ensure_index('state')
         self.jobs.ensure_index('submitter_email')
+        self.jobs.ensure_index('claim_id', sparse=True)
+        ensure_events_collection(self.database)
 
     def _get_next_submission_id(self):
-        return self.id_assigner.find_and_modify(
-            query={}, update={'$inc': {'next_submission_id': 1}})[
-                'next_submission_id']
+        return get_id_allocator(self.id_assigner, {}, 'next_submission_id').next_id()
 
     def _restart_id_assigner_at(self, next_submission_id):
+        # other processes using this db must be restarted afterwards, they
+        # may still hold blocks of old ids (see db_utils/id_allocator.py)
         self.id_assigner.remove()
         self.id_assigner.insert({"next_submission_id": next_submission_id})
+        get_id_allocator(self.id_assigner, {}, 'next_submission_id').reset()
 
     def submit_snl(self, snl, submitter_email, parameters=None):
         parameters = parameters if parameters else {}
@@ -119,8 +142,67 @@ class SubmissionMongoAdapter(object):
         d.update(sorted_structure.as_dict())
 
         self.jobs.insert(d)
+        emit_submission_events(self.database, [d['submission_id']])
         return d['submission_id']
 
+    def submit_snls(self, snls, submitter_email, parameters=None, ncpus=None):
+        """
+        Bulk version of submit_snl(). The metadata are computed in a pool of
+        ncpus processes (for POOL_MIN_SNLS SNLs or more), the submission ids
+        are reserved as one block and the jobs are inserted together. Jobs
+        that SubmissionProcessor would reject are inserted as REJECTED right
+        away, and an SNL whose job can't be built is stored as a job in ERROR
+        state, with the traceback in its state_details.
+
+        :return: the submission_ids, in the order of snls
+        """
+        # imported here, process_submissions imports this module
+        from mpworks.processors.process_submissions import get_rejection_reason
+        parameters = parameters if parameters else {}
+
+        snls = list(snls)
+        if not snls:
+            return []
+        if ncpus == 1 or len(snls) < POOL_MIN_SNLS:
+            results = list(map(_get_job_doc, snls))
+        else:
+            pool = multiprocessing.Pool(ncpus)
+            try:
+                results = pool.map(_get_job_doc, snls, chunksize=10)
+            finally:
+                pool.close()
+                pool.join()
+
+        submission_ids = get_id_allocator(self.id_assigner, {},
+                                          'next_submission_id').next_ids(len(snls))
+        submitted_at = datetime.datetime.utcnow().isoformat()
+        docs = []
+        accepted = []
+        for (d, error), submission_id in zip(results, submission_ids):
+            d = d if d else {}
+            d['submitter_email'] = submitter_email
+            d['parameters'] = dict(parameters)
+            d['state'] = 'SUBMITTED'
+            d['state_details'] = {}
+            d['task_dict'] = {}
+            d['submission_id'] = submission_id
+            d['submitted_at'] = submitted_at
+            rejection = None if error else get_rejection_reason(d)
+            if error:
+                print 'ERROR for submission {}:\n{}'.format(submission_id, error)
+                d['state'] = 'ERROR'
+                d['state_details'] = {'error': error}
+            elif rejection:
+                d['state'] = 'REJECTED'
+                d['state_details'] = rejection[0]
+            else:
+                accepted.append(submission_id)
+            docs.append(d)
+
+        self.jobs.insert_many(docs)
+        emit_submission_events(self.database, accepted)
+        return submission_ids
+
     def resubmit(self, submission_id, snl_db=None):
         # see if an SNL object has already been created
         if not snl_db:
@@ -141,7 +223,7 @@ class SubmissionMongoAdapter(object):
             updates['parameters'].update({"mpsnl": mpsnl.as_dict(), "snlgroup_id": snlgroup_id})
 
         self.jobs.find_and_modify({'submission_id': submission_id}, {'$set': updates})
-
+        emit_submission_events(self.database, [submission_id], 'resubmitted')
 
     def cancel_submission(self, submission_id):
         # TODO: implement me
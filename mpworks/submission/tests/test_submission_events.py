@@ -0,0 +1,60 @@
+import unittest
+from unittest import TestCase
+
+try:
+    import pymongo
+    from mpworks.submission.submission_events import SubmissionWatcher, emit_submission_events
+except ImportError:
+    pymongo = None
+
+TEST_DB = 'mpworks_unittest_submission_events'
+
+
+class _Adapter(object):
+    # the parts of a SubmissionMongoAdapter the watcher uses
+    def __init__(self, database):
+        self.database = database
+        self.jobs = database.jobs
+
+
+class TestSubmissionWatcher(TestCase):
+    """
+    Needs a mongod on localhost:27017
+    """
+
+    def setUp(self):
+        if pymongo is None:
+            raise unittest.SkipTest('pymongo is not installed')
+        self.client = pymongo.MongoClient('localhost', 27017, serverSelectionTimeoutMS=500)
+        try:
+            self.client.admin.command('ping')
+        except pymongo.errors.PyMongoError:
+            raise unittest.SkipTest('no mongod on localhost:27017')
+        self.client.drop_database(TEST_DB)
+        self.sma = _Adapter(self.client[TEST_DB])
+
+    def tearDown(self):
+        self.client.drop_database(TEST_DB)
+        self.client.close()
+
+    def test_tailable_cursor(self):
+        emit_submission_events(self.sma.database, [1])
+        watcher = SubmissionWatcher(self.sma, use_change_streams=False)
+        self.assertEqual(watcher.mode, 'tailable cursor')
+        # events from before the watcher was created are not reported
+        self.assertFalse(watcher.wait(0.5))
+        emit_submission_events(self.sma.database, [2, 3])
+        self.assertTrue(watcher.wait(5))
+        self.assertTrue(watcher.wait(5))
+        self.assertFalse(watcher.wait(0.5))
+
+    def test_change_stream(self):
+        watcher = SubmissionWatcher(self.sma)
+        if watcher.mode != 'change stream':
+            raise unittest.SkipTest('mongod is not a replica set')
+        self.sma.jobs.insert_one({'submission_id': 1, 'state': 'SUBMITTED'})
+        self.assertTrue(watcher.wait(5))
+        self.sma.jobs.update_one({'submission_id': 1}, {'$set': {'state': 'WAITING'}})
+        self.assertFalse(watcher.wait(1))
+        self.sma.jobs.update_one({'submission_id': 1}, {'$set': {'state': 'SUBMITTED'}})
+        self.assertTrue(watcher.wait(5))
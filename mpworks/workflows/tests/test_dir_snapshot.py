@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from monty.os.path import zpath
+from mpworks.workflows.wf_utils import DirSnapshot, dir_snapshot, get_dir_snapshot
+
+
+class TestDirSnapshot(TestCase):
+    def setUp(self):
+        self.run_dir = tempfile.mkdtemp()
+        for f in ['INCAR', 'OUTCAR.gz', 'CHGCAR.relax1', 'CHGCAR.relax2',
+                  os.path.join('relax1', 'OUTCAR'),
+                  os.path.join('relax2', 'vasprun.xml.gz'), 'vasp.error']:
+            path = os.path.join(self.run_dir, f)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f_out:
+                f_out.write('data')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def test_last_relax(self):
+        snapshot = DirSnapshot()
+        self.assertEqual(snapshot.last_relax(os.path.join(self.run_dir, 'vasprun.xml')),
+                         os.path.join(self.run_dir, 'relax2', 'vasprun.xml.gz'))
+        self.assertEqual(snapshot.last_relax(os.path.join(self.run_dir, 'OUTCAR')),
+                         os.path.join(self.run_dir, 'OUTCAR.gz'))
+        self.assertEqual(snapshot.last_relax(os.path.join(self.run_dir, 'CHGCAR')),
+                         os.path.join(self.run_dir, 'CHGCAR.relax2'))
+        self.assertEqual(snapshot.last_relax(os.path.join(self.run_dir, 'POTCAR')),
+                         os.path.join(self.run_dir, 'POTCAR'))
+
+    def test_zpath_and_sizes(self):
+        snapshot = DirSnapshot()
+        for f in ['INCAR', 'OUTCAR', 'POTCAR']:
+            path = os.path.join(self.run_dir, f)
+            self.assertEqual(snapshot.zpath(path), zpath(path))
+        self.assertEqual(snapshot.getsize(os.path.join(self.run_dir, 'INCAR')), 4)
+        self.assertEqual(snapshot.getsize(os.path.join(self.run_dir, 'POTCAR')), 0)
+        self.assertTrue(snapshot.isdir(os.path.join(self.run_dir, 'relax1')))
+        self.assertFalse(snapshot.isdir(os.path.join(self.run_dir, 'INCAR')))
+        self.assertFalse(snapshot.isdir(os.path.join(self.run_dir, 'relax3')))
+        self.assertEqual(snapshot.glob(os.path.join(self.run_dir, '*.error')),
+                         [os.path.join(self.run_dir, 'vasp.error')])
+
+    def test_scope(self):
+        with dir_snapshot() as snapshot:
+            self.assertIs(get_dir_snapshot(), snapshot)
+            with dir_snapshot() as inner:
+                self.assertIs(inner, snapshot)
+        self.assertIsNot(get_dir_snapshot(), snapshot)
@@ -15,6 +15,13 @@ QA_CONTROL = {'nnodes': 1, 'nodes': 1, 'walltime': '00:30:00'}
 MOVE_TO_GARDEN_DEV = False
 MOVE_TO_GARDEN_PROD = False
 
+# store DOS and band structures in GridFS as typed arrays (db_utils/gridfs_arrays.py) instead of
+# compressed JSON. Anything reading dos_fs/band_structure_fs must then go through gridfs_arrays.read_doc
+GRIDFS_ARRAY_FORMAT = False
+
+# keep the per-stage timings of task insertion (drones/perf.py) in the '_perf' key of task docs
+STORE_PERF_DATA = False
+
 GARDEN = '/project/projectdirs/matgen/garden'
 
 RUN_LOCS = [GARDEN, GARDEN+'/dev',
@@ -1,10 +1,13 @@
+import fnmatch
 import glob
 import logging
 import os
 import shlex
 import shutil
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 
 import subprocess
 
@@ -12,6 +15,14 @@ import re
 from monty.os.path import zpath
 from mpworks.workflows.wf_settings import RUN_LOCS, GARDEN
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # the backport, for python 2
+    except ImportError:
+        scandir = None
+
 
 __author__ = 'Anubhav Jain'
 __copyright__ = 'Copyright 2013, The Materials Project'
@@ -29,26 +40,155 @@ def j_decorate(m_dict):
     return m_dict
 
 
-def last_relax(filename):
-    # for old runs
-    m_dir = os.path.dirname(filename)
-    m_file = os.path.basename(filename)
+# extensions tried by monty.os.path.zpath, in the same order
+ZPATH_EXTENSIONS = ['', '.gz', '.GZ', '.bz2', '.BZ2', '.z', '.Z']
+
+_snapshot_local = threading.local()
+
+
+class DirSnapshot(object):
+    """
+    Answers existence, size and zpath/last_relax queries for files from a
+    single listing of each directory, instead of one stat() per candidate
+    name. On a parallel filesystem every one of those stat() calls is a
+    metadata round trip, and resolving the few VASP files of a run directory
+    (relax1/, relax2/, *.relax*, .gz variants) used to need dozens of them.
+
+    Listings are taken on first use and never refreshed, so a snapshot must
+    only be used while the directories it looks at are not being modified.
+    Use dir_snapshot() to scope one. Whether an entry is a directory is only
+    looked up when isdir() asks for it.
+    """
+
+    def __init__(self):
+        # directory -> {name: DirEntry, or None without scandir}, None if
+        # not a directory
+        self._listings = {}
+        self._isdirs = {}
+        self._sizes = {}
+
+    def _listing(self, m_dir):
+        m_dir = os.path.abspath(m_dir)
+        if m_dir not in self._listings:
+            try:
+                if scandir is not None:
+                    listing = dict([(e.name, e) for e in scandir(m_dir)])
+                else:
+                    listing = dict.fromkeys(os.listdir(m_dir))
+            except OSError:
+                listing = None
+            self._listings[m_dir] = listing
+        return self._listings[m_dir]
+
+    def exists(self, path):
+        path = os.path.abspath(path)
+        m_dir, name = os.path.split(path)
+        if not name:
+            return os.path.exists(path)  # the filesystem root
+        listing = self._listing(m_dir)
+        return listing is not None and name in listing
+
+    def isdir(self, path):
+        path = os.path.abspath(path)
+        if path not in self._isdirs:
+            m_dir, name = os.path.split(path)
+            listing = self._listing(m_dir)
+            if not listing or name not in listing:
+                self._isdirs[path] = False
+            elif listing[name] is not None:
+                # scandir usually knows without a stat()
+                self._isdirs[path] = listing[name].is_dir()
+            else:
+                self._isdirs[path] = os.path.isdir(path)
+        return self._isdirs[path]
+
+    def getsize(self, path):
+        """
+        Size of the file at path, 0 if it doesn't exist.
+        """
+        path = os.path.abspath(path)
+        if path not in self._sizes:
+            self._sizes[path] = os.stat(path).st_size if self.exists(path) else 0
+        return self._sizes[path]
+
+    def listdir(self, m_dir):
+        listing = self._listing(m_dir)
+        if listing is None:
+            raise OSError('Not a directory: {}'.format(m_dir))
+        return sorted(listing.keys())
+
+    def glob(self, pattern):
+        """
+        Like glob.glob(), for patterns with wildcards in the file name only.
+        """
+        m_dir, name_pattern = os.path.split(pattern)
+        listing = self._listing(m_dir or '.')
+        if listing is None:
+            return []
+        # like glob, '*' does not match a leading dot
+        return [os.path.join(m_dir, name) for name in sorted(listing)
+                if fnmatch.fnmatch(name, name_pattern) and
+                (not name.startswith('.') or name_pattern.startswith('.'))]
+
+    def zpath(self, filename):
+        """
+        Same as monty.os.path.zpath()
+        """
+        for ext in ZPATH_EXTENSIONS:
+            if self.exists(filename + ext):
+                return filename + ext
+        return filename
 
-    if os.path.exists(zpath(os.path.join(m_dir, 'relax2', m_file))):
-        return zpath(os.path.join(m_dir, 'relax2', m_file))
+    def last_relax(self, filename):
+        # for old runs
+        m_dir = os.path.dirname(filename)
+        m_file = os.path.basename(filename)
 
-    elif os.path.exists(zpath(filename)):
-        return zpath(filename)
+        if self.exists(self.zpath(os.path.join(m_dir, 'relax2', m_file))):
+            return self.zpath(os.path.join(m_dir, 'relax2', m_file))
 
-    relaxations = glob.glob('%s.relax*' % filename)
-    if relaxations:
-        return sorted(relaxations)[-1]
+        elif self.exists(self.zpath(filename)):
+            return self.zpath(filename)
 
-    # backup for old runs
-    elif os.path.exists(zpath(os.path.join(m_dir, 'relax1', m_file))):
-        return zpath(os.path.join(m_dir, 'relax1', m_file))
+        relaxations = self.glob('%s.relax*' % filename)
+        if relaxations:
+            return sorted(relaxations)[-1]
 
-    return filename
+        # backup for old runs
+        elif self.exists(self.zpath(os.path.join(m_dir, 'relax1', m_file))):
+            return self.zpath(os.path.join(m_dir, 'relax1', m_file))
+
+        return filename
+
+
+@contextmanager
+def dir_snapshot():
+    """
+    Within this block, get_dir_snapshot() (and so last_relax()) answer from
+    the same DirSnapshot. Nested blocks reuse the outer snapshot.
+    """
+    current = getattr(_snapshot_local, 'snapshot', None)
+    if current is not None:
+        yield current
+        return
+    _snapshot_local.snapshot = DirSnapshot()
+    try:
+        yield _snapshot_local.snapshot
+    finally:
+        _snapshot_local.snapshot = None
+
+
+def get_dir_snapshot():
+    """
+    The DirSnapshot of the current dir_snapshot() block, or else a new one
+    that is not shared with anybody.
+    """
+    current = getattr(_snapshot_local, 'snapshot', None)
+    return current if current is not None else DirSnapshot()
+
+
+def last_relax(filename):
+    return get_dir_snapshot().last_relax(filename)
 
 
 def orig(filename):